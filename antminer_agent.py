@@ -0,0 +1,51 @@
+"""
+Runs the monitoring agent on its own, without the web app.
+
+    $ python antminer_agent.py [--config agent.env]
+
+The config file holds KEY=VALUE lines with the same settings as the
+environment (see app/views/config.py), the environment wins when both are
+set. Run the web app with AGENT_EMBEDDED=0 next to it, and WEB_READ_ONLY=1
+for a pure read-only frontend. SIGTERM and SIGINT stop the agent after the
+current miner.
+"""
+import argparse
+import os
+import signal
+
+
+def load_config_file(path):
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            key, _, value = line.partition('=')
+            os.environ.setdefault(key.strip(), value.strip().strip('"\''))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Antminer monitoring agent")
+    parser.add_argument('--config', help="file with KEY=VALUE settings")
+    args = parser.parse_args()
+    if args.config:
+        load_config_file(args.config)
+
+    # The settings are read when the app is imported.
+    from app import logger
+    from app.views.agent import Agent
+
+    agent = Agent()
+
+    def handle_signal(signum, frame):
+        logger.info("Received signal {}, stopping the agent".format(signum))
+        agent.stop()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+    logger.info("Agent started (pid {})".format(os.getpid()))
+    agent.run()
+
+
+if __name__ == '__main__':
+    main()
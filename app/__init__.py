@@ -1,15 +1,20 @@
 from flask import Flask, url_for
-from flask_sqlalchemy import SQLAlchemy
 import logging
 import os
 
+from app.database import Database
+from app.views import config
+from app.views.templating import bytecode_cache
+
 __version__ = "v0.3.0"
 basedir = os.path.abspath(os.path.dirname(__file__))
 app = Flask(__name__)
+# Set before app.jinja_env is first used, which creates the environment.
+app.jinja_options = dict(app.jinja_options, bytecode_cache=bytecode_cache)
 app.config['SECRET_KEY'] = 'super secret key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'db/app.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = config.DATABASE_URI or 'sqlite:///' + os.path.join(basedir, 'db/app.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = True
-db = SQLAlchemy(app)
+db = Database(app)
 
 gunicorn_error_logger = logging.getLogger('gunicorn.error')
 app.logger.handlers.extend(gunicorn_error_logger.handlers)
@@ -42,9 +47,4 @@ def remove_leading_slash(path):
     return path
 app.jinja_env.globals.update(url_for_ex=url_for_ex)
 
-# Global variable for agent
-last_status_is_ok = True
-last_run_time = 0
-AGENT_INTERVAL_SECS = 5*60
-
-from app.views import antminer, antminer_json
+from app.views import antminer, antminer_json, bulk, debug, export, fleet_api, ingest, thresholds
@@ -0,0 +1,106 @@
+"""
+Storage setup: SQLite in WAL mode with one writer connection and a pool of
+read connections per process, or any other database SQLAlchemy supports
+(PostgreSQL) through DATABASE_URI.
+"""
+import sqlite3
+import threading
+
+import sqlalchemy
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+from app.views import config
+
+
+def is_sqlite_file(info):
+    return info.drivername.startswith('sqlite') and info.database not in (None, '', ':memory:')
+
+
+@event.listens_for(Engine, "connect")
+def _configure_sqlite(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    # Readers see the last commit and never wait for the writer, the writer
+    # never waits for the readers.
+    cursor.execute('PRAGMA journal_mode=WAL')
+    # Durable at every checkpoint instead of every commit, which is enough
+    # with WAL: a power loss can lose the last commits, not corrupt the DB.
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA cache_size=-{:d}'.format(config.SQLITE_CACHE_KB))
+    cursor.close()
+
+
+class RoutingSession(SignallingSession):
+    """ Reads go to the read pool. From its first write (a flush or an
+    INSERT/UPDATE/DELETE statement) to its commit or rollback, a transaction
+    uses the writer connection only, so it reads what it wrote.
+    """
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        writer = self.db.get_writer_engine(self.app)
+        if writer is not None:
+            if self._flushing or isinstance(clause, UpdateBase):
+                self.info['writing'] = True
+            if self.info.get('writing'):
+                return writer
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _end_writing(session, transaction):
+    if transaction.parent is None:
+        session.info.pop('writing', None)
+
+
+class Database(SQLAlchemy):
+    """ SQLAlchemy with the SQLite connections set up for concurrent use. """
+
+    def __init__(self, *args, **kwargs):
+        self.writer_lock = threading.Lock()
+        # app -> writer engine, None when the database needs none
+        self.writer_engines = {}
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def sqlite_options(self, options):
+        connect_args = options.setdefault('connect_args', {})
+        # Pooled connections are used by one thread at a time, but not always
+        # the same one.
+        connect_args['check_same_thread'] = False
+        connect_args['timeout'] = config.SQLITE_BUSY_TIMEOUT_SECS
+
+    def apply_driver_hacks(self, app, info, options):
+        if is_sqlite_file(info):
+            options.setdefault('pool_size', config.DB_READ_POOL_SIZE)
+            options['poolclass'] = QueuePool
+            self.sqlite_options(options)
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+    def get_writer_engine(self, app=None):
+        """ The engine of the single writer connection of the process. """
+        app = self.get_app(app)
+        if app in self.writer_engines:
+            return self.writer_engines[app]
+        with self.writer_lock:
+            if app not in self.writer_engines:
+                info = self.get_engine(app).url
+                writer = None
+                if is_sqlite_file(info):
+                    options = dict(poolclass=QueuePool, pool_size=1, max_overflow=0,
+                                   pool_timeout=config.SQLITE_BUSY_TIMEOUT_SECS)
+                    self.sqlite_options(options)
+                    writer = sqlalchemy.create_engine(info, **options)
+                self.writer_engines[app] = writer
+            return self.writer_engines[app]
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
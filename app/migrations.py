@@ -0,0 +1,330 @@
+"""
+Versioned schema migrations, applied in place by update_db.py.
+
+The version of the schema is SQLite's user_version. Every migration must be
+safe to run again: when one is interrupted the next update_db.py run starts
+it over (or resumes it, for table copies) before moving on.
+"""
+import numbers
+import time
+from collections import namedtuple
+
+from sqlalchemy import Boolean, Float, Integer, MetaData, Numeric
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from app import db
+from app.models import MinerModel
+from app.views.miner_adapter import ModelType
+
+# Rows copied per transaction when a table has to be rebuilt. Each batch is
+# committed, so the app can keep writing in between.
+BATCH_SIZE = 20000
+# Seconds between two progress lines of a table copy
+PROGRESS_INTERVAL_SECS = 5
+REBUILD_SUFFIX = '__rebuild'
+# Ids of the rows updated or deleted during a rebuild, by triggers on the old
+# table.
+CHANGES_SUFFIX = '__changes'
+
+Migration = namedtuple('Migration', 'version description apply')
+
+# Miner models the app supports, refreshed by every update.
+SUPPORTED_MODELS = [
+    dict(model=ModelType.L3Plus.value, chips='72,72,72,72', temp_keys='temp2_', description='Litecoin Miner 504 MH/s', hashrate_value=504, hashrate_unit='MH/s', hashrate_unit_in_api='MH/s', high_temp=70, max_fan_rpm=7125, watts=800),
+    dict(model=ModelType.S9.value, chips='63,63,63', temp_keys='temp2_', description='Bitcoin Miner 13.5 TH/s', hashrate_value=13.5, hashrate_unit='TH/s', hashrate_unit_in_api='GH/s', high_temp=85, max_fan_rpm=7125, watts=1323),
+    dict(model=ModelType.D3.value, chips='60,60,60', temp_keys='temp2_', description='DASH Miner 17 GH/s', hashrate_value=17, hashrate_unit='GH/s', hashrate_unit_in_api='MH/s', high_temp=80, max_fan_rpm=7125, watts=1200),
+    dict(model=ModelType.Avalon741.value, chips='88', temp_keys='', description='Avalon 741 - 7 TH/s', hashrate_value=7, hashrate_unit='TH/s', hashrate_unit_in_api='GH/s', high_temp=90, max_fan_rpm=0, watts=1150),
+    dict(model=ModelType.Avalon821.value, chips='104', temp_keys='', description='Avalon 821 - 11 TH/s', hashrate_value=10, hashrate_unit='TH/s', hashrate_unit_in_api='GH/s', high_temp=90, max_fan_rpm=0, watts=1200),
+    dict(model=ModelType.GekkoScience.value, chips='1', temp_keys='', description='GekkoScience 2PAC Rev2 BM1384', hashrate_value=15, hashrate_unit='GH/s', hashrate_unit_in_api='MH/s', high_temp=0, max_fan_rpm=0, watts=5),
+    dict(model=ModelType.AntRouterR1LTC.value, chips='1', temp_keys='', description='L1-RTC Router', hashrate_value=1.29, hashrate_unit="MH/s", hashrate_unit_in_api='MH/s', high_temp=0, max_fan_rpm=0, watts=4),
+]
+
+# Value given to the existing rows when a NOT NULL column is added.
+COLUMN_DEFAULTS = {
+    ('miner', 'count'): 1,
+}
+
+
+def report(message):
+    print("[INFO] {}".format(message))
+
+
+class sqlite_connection(object):
+    """ Raw sqlite3 connection in autocommit mode: the migrations issue
+    BEGIN/COMMIT themselves so that DDL is transactional too.
+    """
+
+    def __enter__(self):
+        self.connection = db.engine.raw_connection()
+        self.isolation_level = self.connection.connection.isolation_level
+        self.connection.connection.isolation_level = None
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # Back to the pool as it was
+        self.connection.connection.isolation_level = self.isolation_level
+        self.connection.close()
+        return False
+
+
+class transaction(object):
+    """ BEGIN IMMEDIATE ... COMMIT, or ROLLBACK on error. """
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+        return False
+
+
+def schema_version(connection):
+    return connection.execute('PRAGMA user_version').fetchone()[0]
+
+
+def set_schema_version(connection, version):
+    connection.execute('PRAGMA user_version = {:d}'.format(version))
+
+
+def quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def ddl(element):
+    return str(element.compile(dialect=db.engine.dialect)).strip()
+
+
+def default_of(table, column):
+    if (table.name, column.name) in COLUMN_DEFAULTS:
+        return COLUMN_DEFAULTS[(table.name, column.name)]
+    if column.default is not None and column.default.is_scalar:
+        return column.default.arg
+    if isinstance(column.type, (Integer, Float, Numeric, Boolean)):
+        return 0
+    return ''
+
+
+def literal(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, numbers.Number):
+        return repr(value)
+    return "'{}'".format(str(value).replace("'", "''"))
+
+
+def source_of(table, column, columns):
+    """ What to copy into column when rebuilding table. """
+    if column.name in columns:
+        return quote(column.name)
+    if column.nullable:
+        return 'NULL'
+    return literal(default_of(table, column))
+
+
+def existing_columns(connection, table_name):
+    """ name -> (notnull, default) of the columns of a table in the DB. """
+    return dict((row[1], (row[3], row[4])) for row in connection.execute(
+        'PRAGMA table_info({})'.format(quote(table_name))))
+
+
+def existing_indexes(connection):
+    return set(row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'"))
+
+
+def needs_rebuild(table, columns):
+    """ True when the table can't be brought up to date with ALTER TABLE. """
+    for name, (notnull, default) in columns.items():
+        # A column the app doesn't know about would make its inserts fail.
+        if name not in table.c and notnull and default is None:
+            return True
+    for column in table.columns:
+        if column.name not in columns and (column.primary_key or column.unique):
+            return True
+    return False
+
+
+def add_columns(connection, table, columns):
+    with transaction(connection):
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            definition = "{} {}".format(quote(column.name), column.type.compile(dialect=db.engine.dialect))
+            if not column.nullable:
+                definition += " NOT NULL DEFAULT {}".format(literal(default_of(table, column)))
+            report("Adding column {}.{}".format(table.name, column.name))
+            connection.execute('ALTER TABLE {} ADD COLUMN {}'.format(quote(table.name), definition))
+
+
+def rebuild_table(connection, table, columns, batch_size=BATCH_SIZE):
+    """ Copies the table into a new one with the schema of the model, in
+    batches of batch_size rows ordered by id, then swaps them.
+
+    The old table stays in use until the swap. Triggers on it record the ids
+    of the rows updated or deleted meanwhile, the swap copies those rows
+    again along with the rows added meanwhile and renames the new table, in
+    one transaction. An interrupted copy resumes where it stopped.
+    """
+    new_name = table.name + REBUILD_SUFFIX
+    changes_name = table.name + CHANGES_SUFFIX
+    metadata = MetaData()
+    for other in db.metadata.sorted_tables:
+        other.tometadata(metadata, name=new_name if other is table else None)
+    new_table = metadata.tables[new_name]
+    # The indexes keep their names, they are created after the swap.
+    new_table.indexes = set()
+
+    names = [column.name for column in table.columns]
+    targets = ", ".join(quote(name) for name in names)
+    sources = ", ".join(source_of(table, table.c[name], columns) for name in names)
+    insert = 'INSERT INTO {} ({}) SELECT {} FROM {}'.format(quote(new_name), targets, sources, quote(table.name))
+    copy = insert + ' WHERE id > ? ORDER BY id LIMIT ?'
+    changed = 'SELECT id FROM {}'.format(quote(changes_name))
+
+    with transaction(connection):
+        tables = set(row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        if new_name in tables and changes_name not in tables:
+            # Left by a copy that didn't track the changes, its rows may be
+            # stale.
+            connection.execute('DROP TABLE {}'.format(quote(new_name)))
+            tables.discard(new_name)
+        if new_name not in tables:
+            connection.execute(ddl(CreateTable(new_table)))
+        connection.execute('CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY)'.format(quote(changes_name)))
+        connection.execute(
+            'CREATE TRIGGER IF NOT EXISTS {} AFTER UPDATE ON {} BEGIN '
+            'INSERT OR IGNORE INTO {changes} (id) VALUES (OLD.id); '
+            'INSERT OR IGNORE INTO {changes} (id) VALUES (NEW.id); END'.format(
+                quote(table.name + '__rebuild_update'), quote(table.name), changes=quote(changes_name)))
+        connection.execute(
+            'CREATE TRIGGER IF NOT EXISTS {} AFTER DELETE ON {} BEGIN '
+            'INSERT OR IGNORE INTO {} (id) VALUES (OLD.id); END'.format(
+                quote(table.name + '__rebuild_delete'), quote(table.name), quote(changes_name)))
+    total = connection.execute('SELECT COUNT(*) FROM {}'.format(quote(table.name))).fetchone()[0]
+    last_id = connection.execute('SELECT MAX(id) FROM {}'.format(quote(new_name))).fetchone()[0] or 0
+    copied = connection.execute('SELECT COUNT(*) FROM {}'.format(quote(new_name))).fetchone()[0]
+    report("Rebuilding table {} ({} rows{})".format(table.name, total,
+                                                   ", resuming after {}".format(copied) if copied else ""))
+
+    def replay_changes():
+        """ Copies again the rows changed since they were copied, gone when
+        they were deleted. Runs in a transaction.
+        """
+        connection.execute('DELETE FROM {} WHERE id IN ({})'.format(quote(new_name), changed))
+        # The rows after last_id are copied as new ones.
+        connection.execute(insert + ' WHERE id IN ({}) AND id <= ?'.format(changed), (last_id,))
+        connection.execute('DELETE FROM {}'.format(quote(changes_name)))
+
+    start = last_report = time.time()
+    while True:
+        with transaction(connection):
+            count = connection.execute(copy, (last_id, batch_size)).rowcount
+            last_id = connection.execute('SELECT MAX(id) FROM {}'.format(quote(new_name))).fetchone()[0] or 0
+        copied += count
+        if count < batch_size:
+            break
+        if time.time() - last_report >= PROGRESS_INTERVAL_SECS:
+            last_report = time.time()
+            report("  {}: {}/{} rows ({:.0f}%, {:.0f} rows/s)".format(
+                table.name, copied, total, 100.0 * copied / max(total, 1), copied / (last_report - start)))
+
+    # What changed during the copy, so that the swap only has the last ones
+    # to replay.
+    with transaction(connection):
+        replay_changes()
+    with transaction(connection):
+        replay_changes()
+        # Whatever the app inserted during the copy
+        while connection.execute(copy, (last_id, batch_size)).rowcount:
+            last_id = connection.execute('SELECT MAX(id) FROM {}'.format(quote(new_name))).fetchone()[0]
+        # Drops the triggers along with it
+        connection.execute('DROP TABLE {}'.format(quote(table.name)))
+        connection.execute('DROP TABLE {}'.format(quote(changes_name)))
+        connection.execute('ALTER TABLE {} RENAME TO {}'.format(quote(new_name), quote(table.name)))
+    report("  {}: done in {:.1f}s".format(table.name, time.time() - start))
+
+
+def sync_schema(connection, batch_size=BATCH_SIZE):
+    """ Creates the missing tables, columns and indexes of the models. """
+    tables = set(row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            report("Creating table {}".format(table.name))
+            with transaction(connection):
+                connection.execute(ddl(CreateTable(table)))
+            continue
+        columns = existing_columns(connection, table.name)
+        if needs_rebuild(table, columns):
+            rebuild_table(connection, table, columns, batch_size)
+        elif any(column.name not in columns for column in table.columns):
+            add_columns(connection, table, columns)
+
+    indexes = existing_indexes(connection)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in indexes:
+                # Can take a while on a big table, it's one statement though.
+                report("Creating index {}".format(index.name))
+                with transaction(connection):
+                    connection.execute(ddl(CreateIndex(index)))
+
+
+# Append new migrations at the end, never change the version of an existing
+# one.
+MIGRATIONS = [
+    Migration(1, "Bring the tables up to date with the models, without dropping them", sync_schema),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def is_sqlite():
+    return db.engine.dialect.name == 'sqlite'
+
+
+def migrate(batch_size=BATCH_SIZE):
+    """ Applies the pending migrations, returns how many there were. """
+    if not is_sqlite():
+        # Versioned migrations are SQLite only, other databases just get the
+        # tables they are missing.
+        report("Not an SQLite database, creating the missing tables only")
+        db.create_all()
+        return 0
+    with sqlite_connection() as connection:
+        current = schema_version(connection)
+        pending = [migration for migration in MIGRATIONS if migration.version > current]
+        report("Schema version {}, {} migration(s) to apply".format(current, len(pending)))
+        for migration in pending:
+            report("Migration {}: {}".format(migration.version, migration.description))
+            start = time.time()
+            migration.apply(connection, batch_size)
+            with transaction(connection):
+                set_schema_version(connection, migration.version)
+            report("Migration {} done in {:.1f}s".format(migration.version, time.time() - start))
+        return len(pending)
+
+
+def stamp_latest():
+    """ Marks a database created from the models as up to date. """
+    if not is_sqlite():
+        return
+    with sqlite_connection() as connection:
+        set_schema_version(connection, LATEST_VERSION)
+
+
+def refresh_models():
+    """ Adds the supported miner models and updates the existing ones in
+    place, models that are no longer supported are kept for their miners.
+    """
+    existing = dict((model.model, model) for model in MinerModel.query.all())
+    for fields in SUPPORTED_MODELS:
+        model = existing.get(fields['model'])
+        if model is None:
+            report("Adding model {}".format(fields['model']))
+            db.session.add(MinerModel(**fields))
+            continue
+        for name, value in fields.items():
+            setattr(model, name, value)
+    db.session.commit()
@@ -1,3 +1,5 @@
 from .miner import Miner
 from .miner_model import MinerModel
 from .miner_event import MinerEvent
+from .miner_threshold import MinerThreshold
+from .chain_snapshot import ChainSnapshot
@@ -0,0 +1,23 @@
+from app import db
+
+
+class ChainSnapshot(db.Model):
+    """ State of the chips of one ASIC chain, stored only when it changed.
+
+    bad_bits and inactive_bits are hex bitmaps, bit i is chip i of the chain
+    ('x' and '-' in chain_acs). time is in epoch seconds.
+    """
+    __table_args__ = (db.Index('ix_chain_snapshot_miner_chain_time', 'miner_id', 'chain', 'time'),
+                      db.Index('ix_chain_snapshot_time', 'time'))
+
+    id = db.Column(db.Integer, primary_key=True)
+    miner_id = db.Column(db.Integer, db.ForeignKey('miner.id'), nullable=False)
+    chain = db.Column(db.Integer, nullable=False)
+    time = db.Column(db.Float, nullable=False)
+    chip_count = db.Column(db.Integer, nullable=False)
+    bad_bits = db.Column(db.String(64), nullable=False)
+    inactive_bits = db.Column(db.String(64), nullable=False)
+
+    def __repr__(self):
+        return "ChainSnapshot(miner_id={}, chain={}, time={}, bad_bits='{}', inactive_bits='{}')".format(
+            self.miner_id, self.chain, self.time, self.bad_bits, self.inactive_bits)
@@ -10,6 +10,8 @@ class Miner(db.Model):
     # TODO: There is no current way of setting this through the interface
     count = db.Column(db.Integer, nullable=False)
     miner_event = db.relationship('MinerEvent', backref='miner', lazy=True, cascade="all, delete-orphan")
+    thresholds = db.relationship('MinerThreshold', backref='miner', lazy=True, cascade="all, delete-orphan")
+    chain_snapshots = db.relationship('ChainSnapshot', backref='miner', lazy=True, cascade="all, delete-orphan")
 
     def __repr__(self):
         return "Miner(ip='{}', model='{}', remarks='{}')".format(self.ip, self.model, self.remarks)
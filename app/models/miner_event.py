@@ -2,12 +2,14 @@ from app import db
 from datetime import datetime
 
 class MinerEvent(db.Model):
+    __table_args__ = (db.Index('ix_miner_event_miner_id_timestamp', 'miner_id', 'timestamp'),)
+
     id = db.Column(db.Integer, primary_key=True)
     miner_id = db.Column(db.Integer, db.ForeignKey('miner.id'),
         nullable=False)
     event_type = db.Column(db.String(10), nullable=False)
     message = db.Column(db.String(100), nullable=False)
-    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.now())
+    timestamp = db.Column(db.DateTime, nullable=False, default=datetime.now)
 
     def __repr__(self):
         return "MinerModel(model='{}', chips={}, description='{}')".format(self.model, self.chips, self.description)
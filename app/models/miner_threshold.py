@@ -0,0 +1,19 @@
+from app import db
+
+
+class MinerThreshold(db.Model):
+    """ Overrides the default threshold of a health rule for every miner of a
+    model (model_id set) or for a single miner (miner_id set).
+    """
+    __table_args__ = (db.UniqueConstraint('rule', 'model_id', 'miner_id'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    rule = db.Column(db.String(32), nullable=False)
+    value = db.Column(db.Float, nullable=False)
+    model_id = db.Column(db.Integer, db.ForeignKey('miner_model.id'), nullable=True)
+    model = db.relationship("MinerModel")
+    miner_id = db.Column(db.Integer, db.ForeignKey('miner.id'), nullable=True)
+
+    def __repr__(self):
+        return "MinerThreshold(rule='{}', value={}, model_id={}, miner_id={})".format(
+            self.rule, self.value, self.model_id, self.miner_id)
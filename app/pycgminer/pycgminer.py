@@ -2,6 +2,11 @@ import socket
 import json
 import sys
 
+from app.views.circuit_breaker import CircuitOpen, breaker
+from app.views.latency import RPC, latency
+from app.views.perf import perf, wall_clock
+from app.views.rpc_gate import rpc_gate
+
 
 class CgminerAPI(object):
     """ Cgminer RPC API wrapper. """
@@ -16,31 +21,81 @@ class CgminerAPI(object):
         send a command (a json encoded dict) and
         receive the response (and decode it).
         """
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(1)
+        try:
+            # One command at a time per miner, identical reads are shared.
+            received = rpc_gate.call(self.host, command, arg, lambda: self._exchange(command, arg))
+        except CircuitOpen as e:
+            return self._stale(command, arg, str(e))
+        except Exception as e:
+            return dict({'STATUS': [{'STATUS': 'error', 'description': e}]})
+        return self._decode(received)
+
+    def _decode(self, received):
+        # the null byte makes json decoding unhappy
+        # also add a comma on the output of the `stats` command by replacing '}{' with '},{'
+        with perf.timer('json_decode', self.host):
+            return json.loads(received[:-1].replace('}{', '},{'))
+
+    def _stale(self, command, arg, refusal):
+        """ The last reply of a read command the miner isn't asked for, with
+        STALE set to why. An error when it never answered it.
+        """
+        received = rpc_gate.last_reply(self.host, command, arg)
+        if received is None:
+            return dict({'STATUS': [{'STATUS': 'error', 'description': refusal}]})
+        reply = self._decode(received)
+        reply['STALE'] = refusal
+        return reply
+
+    def _exchange(self, command, arg):
+        """ Sends the command and returns the raw reply. Raises CircuitOpen
+        when the miner isn't to be called.
+        """
+        # Only checked for the calls that reach the miner: every call the
+        # breaker lets through reports back to it below.
+        refusal = breaker.refusal(self.host)
+        if refusal is not None:
+            raise CircuitOpen(refusal)
 
+        sock = None
+        connected = False
+        start = wall_clock()
         try:
-            sock.connect((self.host, self.port))
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(latency.timeout(self.host, RPC, connect=True))
+            with perf.timer('connect', self.host):
+                sock.connect((self.host, self.port))
+            connected = True
+            sock.settimeout(latency.timeout(self.host, RPC))
             payload = {"command": command}
             if arg is not None:
                 # Parameter must be converted to basestring (no int)
                 payload.update({'parameter': arg})
 
-            if sys.version_info.major == 2:
-                sock.send(json.dumps(payload))
-            if sys.version_info.major == 3:
-                sock.send(bytes(json.dumps(payload), 'utf-8'))
-                sock.send(bytes(json.dumps(payload),'utf-8'))
-            received = self._receive(sock)
+            with perf.timer('send', self.host):
+                if sys.version_info.major == 2:
+                    sock.send(json.dumps(payload))
+                if sys.version_info.major == 3:
+                    sock.send(bytes(json.dumps(payload), 'utf-8'))
+                    sock.send(bytes(json.dumps(payload),'utf-8'))
+            with perf.timer('receive', self.host):
+                received = self._receive(sock)
+            if not received:
+                # Not an answer, it mustn't be shown as the last one.
+                raise socket.error("Connection closed without a reply")
         except Exception as e:
-            return dict({'STATUS': [{'STATUS': 'error', 'description': e}]})
+            if isinstance(e, socket.timeout):
+                latency.record_timeout(self.host, RPC, connect=not connected)
+            breaker.failure(self.host, str(e) or type(e).__name__)
+            raise
         else:
-            # the null byte makes json decoding unhappy
-            # also add a comma on the output of the `stats` command by replacing '}{' with '},{'
-            return json.loads(received[:-1].replace('}{', '},{'))
+            latency.record(self.host, RPC, wall_clock() - start)
+            breaker.success(self.host)
+            return received
         finally:
             # sock.shutdown(socket.SHUT_RDWR)
-            sock.close()
+            if sock is not None:
+                sock.close()
 
     def _receive(self, sock, size=4096):
         msg = ''
@@ -0,0 +1,329 @@
+import threading
+import time
+
+import requests
+
+import config
+from app import db, logger
+from app.models import Miner, MinerEvent
+from app.views.aggregates import FleetAggregates, make_contribution
+from app.views.alerts import AlertEngine
+from app.views.anomaly import create_anomaly_detector
+from app.views.archive import create_archive
+from app.views.chains import chain_history
+from app.views.circuit_breaker import breaker
+from app.views.clock import system_clock
+from app.views.latency import HTTP, latency
+from app.views.leader import LeaderLock, publish_agent_status
+from app.views.miner_adapter import get_miner_status
+from app.views.model_catalog import model_catalog
+from app.views.notifier import create_dispatcher
+from app.views.perf import perf, wall_clock
+from app.views.profiler import profiler
+from app.views.rpc_gate import rpc_gate
+from app.views.rules import rule_engine
+from app.views.snapshot import SnapshotWriter, make_down_record, make_records
+from app.views.templating import template_env
+from app.views.uplink import create_uplink
+
+
+def render_without_request(template_name, **template_vars):
+    """
+    Usage is the same as flask.render_template:
+
+    render_without_request('my_template.html', var1='foo', var2='bar')
+    """
+    with perf.timer('render'):
+        template = template_env.get_template(template_name)
+        return template.render(**template_vars)
+
+
+def try_http_connect(miners, stop_event=None):
+    failed_miners = []
+    for miner in miners:
+        if stop_event is not None and stop_event.is_set():
+            break
+        # Have a small retry loop.
+        for i in range(0, 10):
+            try:
+                url = "http://{}".format(miner.ip)
+                start = wall_clock()
+                r = requests.get(url, timeout=(latency.timeout(miner.ip, HTTP, connect=True),
+                                               latency.timeout(miner.ip, HTTP)))
+                latency.record(miner.ip, HTTP, wall_clock() - start)
+                if r.status_code >= 500:
+                    failed_miners.append(miner)
+                break
+            except Exception as e:
+                if isinstance(e, requests.exceptions.Timeout):
+                    # The next try waits longer for a slow reply
+                    latency.record_timeout(miner.ip, HTTP,
+                                           connect=isinstance(e, requests.exceptions.ConnectTimeout))
+                # If an exception, just really consider it
+                # if its the last one, otherwise lets try
+                # again after sleeping a bit.
+                if i == 9:
+                    logger.warning("Error while connecting to {}".format(e.message))
+                    failed_miners.append(miner)
+                elif stop_event is not None:
+                    stop_event.wait(1)
+                else:
+                    time.sleep(1)
+
+    return failed_miners
+
+# Some troubleshooting queries:
+# select m.ip, count(*) count from miner_event me inner join miner m on me.miner_id=m.id group by m.ip order by count desc;
+def log_miner_event(miner, event_type, message):
+    try:
+        logger.debug("Miner:{} type:{} message:{}".format(miner.ip, event_type, message))
+        miner_event = MinerEvent(
+            miner_id=miner.id, event_type=event_type, message=message)
+        db.session.add(miner_event)
+        db.session.commit()
+    except Exception as e:
+        # there could be many types of exceptions such as: IntegrityError , database being locket, etc.
+        db.session.rollback()
+        logger.error("Error while logging event. Message:{}".format(e.message))
+
+
+def store_chain_snapshots(rows):
+    if not rows:
+        return
+    try:
+        db.session.add_all(rows)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        # Reloaded from the DB on the next sweep, so the changes are stored then.
+        chain_history.invalidate()
+        logger.error("Error while storing chain snapshots. Message:{}".format(e.message))
+
+
+def send_alert_digest(dispatcher, digest):
+    body_html = render_without_request("messages.html", messages=digest.messages())
+    body_plain = "Monitoring status changed. Please go to {}\n".format(
+        config.DOMAIN_ADDR)
+    dispatcher.notify(digest.title(), body_html, body_plain)
+
+
+class LiveSource(object):
+    """ Where the agent gets the miners and their status from: the DB and
+    the miners themselves. simulation.py replaces it with a timeline.
+    """
+
+    def miners(self):
+        # The sweep only reads the miner columns and the model catalog. The
+        # miners are detached so the commits of the events don't expire them
+        # and reload each one from the DB.
+        miners = Miner.query.all()
+        db.session.expunge_all()
+        return miners
+
+    def http_failures(self, miners, stop_event):
+        return try_http_connect(miners=miners, stop_event=stop_event)
+
+    def miner_status(self, miner, archive):
+        return get_miner_status(miner, archive)
+
+
+class Agent(object):
+    """ The monitoring loop: polls the miners, logs events, publishes the
+    snapshot and sends the alert digests.
+
+    It runs either in a thread of the web app (AGENT_EMBEDDED) or on its own
+    through antminer_agent.py. Either way its health is written to
+    AGENT_STATUS_FILE on every iteration, which is what /miners_status reads.
+
+    Time comes from clock and the miners from source, so simulation.py can
+    run it on a virtual clock against a timeline.
+    """
+
+    def __init__(self, interval_secs=None, lightweight_interval_secs=5, clock=system_clock, source=None):
+        self.interval_secs = interval_secs or config.AGENT_INTERVAL_SECS
+        self.lightweight_interval_secs = lightweight_interval_secs
+        self.clock = clock
+        self.source = source or LiveSource()
+        self.last_run_time = 0
+        self.lightweight_last_run_time = 0
+        self.last_status_is_ok = True
+        self.alert_engine = AlertEngine(raise_after_secs=config.ALERT_RAISE_AFTER_SECS,
+                                        clear_after_secs=config.ALERT_CLEAR_AFTER_SECS,
+                                        digest_interval_secs=config.ALERT_DIGEST_INTERVAL_SECS)
+        # Every gunicorn worker (and standalone agent) may run the loop, but
+        # only the one holding the lock polls. The others keep trying to take
+        # over.
+        self.leader = LeaderLock(config.AGENT_LOCK_FILE)
+        self.dispatcher = None
+        self.snapshot_writer = SnapshotWriter(config.SNAPSHOT_FILE)
+        self.aggregates = FleetAggregates()
+        # Collector mode: snapshots and events are also pushed to the
+        # central server.
+        self.uplink = create_uplink()
+        self.events = []
+        # Raw cgminer replies, for replay_archive.py
+        self.archive = create_archive()
+        self.anomalies = create_anomaly_detector()
+        self.stop_event = threading.Event()
+
+    def stop(self):
+        """ Asks the loop to exit once the current iteration is over. """
+        self.stop_event.set()
+
+    def run(self):
+        profiler.register_thread()
+        try:
+            while not self.stop_event.is_set():
+                if self.leader.try_acquire():
+                    self.run_once()
+                self.clock.wait(self.stop_event, self.lightweight_interval_secs)
+        finally:
+            self.shutdown()
+
+    def run_once(self):
+        if self.dispatcher is None:
+            self.dispatcher = create_dispatcher()
+            self.dispatcher.start()
+            if self.uplink is not None:
+                self.uplink.start()
+        profiler.iteration_started()
+        try:
+            self.check()
+        except Exception as e:
+            logger.error("Error. Message:{}".format(e.message))
+            self.last_status_is_ok = False
+        self.publish_status('running')
+        profiler.iteration_finished()
+
+    def check(self):
+        has_problems = False
+
+        # Light check (HTTP connect)
+        miners = self.source.miners()
+        if self.last_run_time != 0 and \
+                self.clock.time() - self.lightweight_last_run_time >= self.lightweight_interval_secs:
+            logger.debug("Lightweight HTTP checks in progress...")
+            inactive_miners = self.source.http_failures(miners, self.stop_event)
+            if self.stop_event.is_set():
+                return
+            inactive_miner_ids = set(inactive_miner.id for inactive_miner in inactive_miners)
+            now = self.clock.time()
+            for miner in miners:
+                findings = {}
+                if miner.id in inactive_miner_ids:
+                    msg = "Miner {} not accessible (HTTP Connect)".format(
+                        miner.ip)
+                    findings['http_connect'] = ("error", msg)
+                    self.log_event(miner, "error", msg)
+                    has_problems = True
+                self.alert_engine.observe(miner.ip, 'http', findings, now)
+            self.lightweight_last_run_time = self.clock.time()
+
+        # Expensive check (CGMiner API)
+        if not has_problems and self.clock.time() - self.last_run_time >= self.interval_secs:
+            logger.info("CGMiner API checks in progress...")
+            rule_engine.refresh()
+            snapshot_records = []
+            chain_rows = []
+            for miner in miners:
+                if self.stop_event.is_set():
+                    # Don't publish a partial sweep on shutdown.
+                    return
+                miner_status = self.source.miner_status(miner, self.archive)
+                if not miner_status:
+                    # Log event. Keep the other checks as they were,
+                    # we just don't know about them.
+                    msg = "Miner {} not accessible (CG Miner)".format(miner.ip)
+                    records = [make_down_record(miner, msg)]
+                    self.alert_engine.observe(miner.ip, 'cgminer', {'cgminer_connect': ("error", msg)},
+                                              self.clock.time(), partial=True)
+                    self.log_event(
+                        miner, "error", "Miner not accessible")
+                    has_problems = True
+                else:
+                    # Replies shown while the miner doesn't answer teach the
+                    # baselines nothing.
+                    if self.anomalies is not None and miner_status.stale is None:
+                        for finding in self.anomalies.observe(miner, miner_status):
+                            miner_status.add_finding(finding)
+                    for message in miner_status.errors:
+                        self.log_event(miner, "error", message)
+                        has_problems = True
+                    for message in miner_status.warnings:
+                        self.log_event(miner, "warning", message)
+                        has_problems = True
+                    self.alert_engine.observe(miner.ip, 'cgminer', miner_status.checks, self.clock.time())
+                    records = make_records(miner, miner_status)
+                    chain_rows.extend(chain_history.changes(miner.id, miner_status.chains, self.clock.time()))
+                snapshot_records.extend(records)
+                if records:
+                    self.aggregates.update(miner.id, make_contribution(records, model_catalog.get(miner.model_id).watts,
+                                                                       config.SITE_NAME))
+                else:
+                    self.aggregates.remove(miner.id)
+            if self.archive is not None:
+                self.archive.flush()
+            store_chain_snapshots(chain_rows)
+            self.alert_engine.retain(set(miner.ip for miner in miners))
+            self.aggregates.retain(set(miner.id for miner in miners))
+            latency.retain(set(miner.ip for miner in miners))
+            breaker.retain(set(miner.ip for miner in miners))
+            rpc_gate.retain(set(miner.ip for miner in miners))
+            if self.anomalies is not None:
+                self.anomalies.retain(set(miner.id for miner in miners))
+            self.snapshot_writer.publish(snapshot_records)
+
+            # Update last run time and status.
+            self.last_run_time = self.clock.time()
+            self.last_status_is_ok = not has_problems
+            if self.uplink is not None:
+                self.uplink.push_snapshot(self.last_run_time, self.interval_secs, snapshot_records,
+                                         self.aggregates.to_dict())
+
+        if self.uplink is not None:
+            self.uplink.push_events(self.events)
+            self.events = []
+
+        # Only transitions are emailed, in rate limited digests.
+        digest = self.alert_engine.pop_digest(self.clock.time())
+        if digest is not None:
+            self.send_digest(digest)
+
+    def send_digest(self, digest):
+        send_alert_digest(self.dispatcher, digest)
+
+    def log_event(self, miner, event_type, message):
+        log_miner_event(miner, event_type, message)
+        if self.uplink is not None:
+            self.events.append({"miner_ip": miner.ip, "event_type": event_type, "message": message,
+                                "time": self.clock.time()})
+
+    def publish_status(self, state):
+        try:
+            publish_agent_status(config.AGENT_STATUS_FILE,
+                                 state=state,
+                                 interval_secs=self.interval_secs,
+                                 last_run_time=self.last_run_time,
+                                 last_status_is_ok=self.last_status_is_ok,
+                                 aggregates=self.aggregates.to_dict(),
+                                 latency=latency.to_dict(),
+                                 circuits=breaker.to_dict())
+        except (IOError, OSError) as e:
+            logger.error("Error while publishing agent status. Message:{}".format(e))
+
+    def shutdown(self):
+        if not self.leader.is_leader():
+            return
+        logger.info("Agent shutting down")
+        if self.dispatcher is not None:
+            # Whatever is not delivered in time stays in the spool for the
+            # next start.
+            self.dispatcher.stop(timeout=10)
+        if self.uplink is not None:
+            self.uplink.stop(timeout=10)
+        if self.archive is not None:
+            # Polls of an interrupted sweep
+            self.archive.flush()
+        self.snapshot_writer.close()
+        self.publish_status('stopped')
+        self.leader.release()
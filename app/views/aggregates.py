@@ -0,0 +1,180 @@
+import re
+import threading
+from collections import namedtuple
+
+from app.views.miner_adapter import update_unit_and_value
+from app.views.miners_profit import get_coin_from_model
+from app.views.rules import HASHRATE_UNITS, hashes_per_sec
+from app.views.snapshot import LEVEL_DOWN
+
+DIMENSIONS = ('model', 'coin', 'pool_user', 'tag', 'site')
+DIMENSION_TITLES = {
+    'model': "Model",
+    'coin': "Coin",
+    'pool_user': "Pool user",
+    'tag': "Remarks tag",
+    'site': "Site",
+}
+
+
+class Totals(object):
+    """ Running sums of one group. All fields are integers so removing a
+    miner exactly undoes adding it, however many updates happened.
+    """
+    __slots__ = ('hashes_per_sec', 'watts', 'up', 'down', 'temp_sum', 'temp_count')
+
+    def __init__(self, hashes_per_sec=0, watts=0, up=0, down=0, temp_sum=0, temp_count=0):
+        self.hashes_per_sec = hashes_per_sec
+        self.watts = watts
+        self.up = up
+        self.down = down
+        self.temp_sum = temp_sum
+        self.temp_count = temp_count
+
+    def add(self, other, sign=1):
+        self.hashes_per_sec += sign * other.hashes_per_sec
+        self.watts += sign * other.watts
+        self.up += sign * other.up
+        self.down += sign * other.down
+        self.temp_sum += sign * other.temp_sum
+        self.temp_count += sign * other.temp_count
+
+    def is_empty(self):
+        return self.up == 0 and self.down == 0
+
+    def average_temp(self):
+        if self.temp_count == 0:
+            return None
+        return float(self.temp_sum) / self.temp_count
+
+    def hashrate_pretty(self):
+        value, unit = update_unit_and_value(float(self.hashes_per_sec) / HASHRATE_UNITS['MH/s'], 'MH/s')
+        return "{:3.2f} {}".format(value, unit)
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(**dict((name, values.get(name, 0)) for name in cls.__slots__))
+
+
+class Contribution(namedtuple('Contribution', 'groups totals')):
+    """ What one miner adds to the aggregates: its (dimension, value) groups
+    and its totals.
+    """
+    __slots__ = ()
+
+
+def coin_of(model):
+    try:
+        return get_coin_from_model(model).get_symbol()
+    except AssertionError:
+        return "?"
+
+
+def tags_of(remarks):
+    return set(tag for tag in re.split(r'[\s,;]+', remarks or '') if tag)
+
+
+def make_contribution(records, watts, site):
+    """ Contribution of a miner given its snapshot records (one per instance). """
+    first = records[0]
+    groups = set([('model', first.model), ('coin', coin_of(first.model)), ('site', site)])
+    groups.update(('tag', tag) for tag in tags_of(first.remarks))
+    totals = Totals()
+    if first.level == LEVEL_DOWN:
+        totals.down = 1
+        return Contribution(frozenset(groups), totals)
+    totals.up = 1
+    totals.watts = watts or 0
+    for record in records:
+        if record.worker:
+            # Pool users are usually <account>.<worker>
+            groups.add(('pool_user', record.worker.split('.')[0]))
+        if record.hashrate_unit in HASHRATE_UNITS:
+            totals.hashes_per_sec += int(round(hashes_per_sec(record.hashrate_value, record.hashrate_unit)))
+        temps = [temp for temp in record.temps if temp]
+        totals.temp_sum += sum(temps)
+        totals.temp_count += len(temps)
+    return Contribution(frozenset(groups), totals)
+
+
+class FleetAggregates(object):
+    """ Fleet totals grouped by model, coin, pool user, remarks tag and site.
+
+    update() replaces the previous contribution of a miner by subtracting it
+    and adding the new one, so the cost of a poll result only depends on the
+    number of groups the miner belongs to and reading the totals never walks
+    the miners.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # miner key -> Contribution
+        self.contributions = {}
+        # dimension -> group value -> Totals
+        self.groups = dict((dimension, {}) for dimension in DIMENSIONS)
+        self.fleet = Totals()
+
+    def _apply(self, contribution, sign):
+        self.fleet.add(contribution.totals, sign)
+        for dimension, value in contribution.groups:
+            groups = self.groups[dimension]
+            totals = groups.get(value)
+            if totals is None:
+                totals = groups[value] = Totals()
+            totals.add(contribution.totals, sign)
+            if totals.is_empty():
+                del groups[value]
+
+    def update(self, miner_key, contribution):
+        with self.lock:
+            previous = self.contributions.get(miner_key)
+            if previous is not None:
+                self._apply(previous, -1)
+            self.contributions[miner_key] = contribution
+            self._apply(contribution, 1)
+
+    def remove(self, miner_key):
+        with self.lock:
+            previous = self.contributions.pop(miner_key, None)
+            if previous is not None:
+                self._apply(previous, -1)
+
+    def retain(self, miner_keys):
+        """ Drops the miners that are gone. """
+        for miner_key in [key for key in self.contributions if key not in miner_keys]:
+            self.remove(miner_key)
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "fleet": self.fleet.to_dict(),
+                "groups": dict((dimension, dict((value, totals.to_dict()) for value, totals in groups.items()))
+                               for dimension, groups in self.groups.items()),
+            }
+
+
+class AggregatesView(object):
+    """ Read side of the aggregates, built from what FleetAggregates.to_dict()
+    published. Several of them (one per site) can be merged.
+    """
+
+    def __init__(self):
+        self.fleet = Totals()
+        self.groups = dict((dimension, {}) for dimension in DIMENSIONS)
+
+    def merge(self, published):
+        self.fleet.add(Totals.from_dict(published['fleet']))
+        for dimension, groups in published['groups'].items():
+            for value, totals in groups.items():
+                merged = self.groups[dimension].get(value)
+                if merged is None:
+                    merged = self.groups[dimension][value] = Totals()
+                merged.add(Totals.from_dict(totals))
+        return self
+
+    def total_hash_rate_per_model(self):
+        return dict((model, totals.hashrate_pretty())
+                    for model, totals in self.groups['model'].items() if totals.up)
@@ -0,0 +1,160 @@
+from collections import namedtuple
+
+OK = 0
+WARN = 1
+ERROR = 2
+
+# Debug findings are shown in the UI but never alerted on.
+LEVEL_STATES = {'debug': OK, 'warning': WARN, 'error': ERROR}
+
+
+class Transition(namedtuple('Transition', 'key check old_state new_state message timestamp')):
+    __slots__ = ()
+
+    def category(self):
+        # Category as understood by messages.html
+        if self.new_state == ERROR:
+            return "error"
+        elif self.new_state == WARN:
+            return "warning"
+        return "info"
+
+    def pretty(self):
+        if self.new_state == OK:
+            return "[OK] Check '{}' recovered on miner '{}'.".format(self.check, self.key)
+        # Messages can be plain strings or findings formatted on demand.
+        return "{}".format(self.message)
+
+
+class CheckState(object):
+    __slots__ = ('state', 'message', 'pending_state', 'pending_since')
+
+    def __init__(self):
+        self.state = OK
+        self.message = None
+        self.pending_state = None
+        self.pending_since = None
+
+
+class Digest(object):
+    def __init__(self, transitions, active_count):
+        self.transitions = transitions
+        self.active_count = active_count
+
+    def title(self):
+        states = set(transition.new_state for transition in self.transitions)
+        if ERROR in states:
+            return "Monitoring Error"
+        elif WARN in states:
+            return "Monitoring warning"
+        elif self.active_count == 0:
+            return "Monitor Success"
+        return "Monitoring recovery"
+
+    def messages(self):
+        messages = [(transition.category(), transition.pretty()) for transition in self.transitions]
+        if self.active_count == 0:
+            messages.append(("info", "All miners are working as expected"))
+        else:
+            messages.append(("info", "{} check(s) still failing".format(self.active_count)))
+        return messages
+
+
+class AlertEngine(object):
+    """ Keeps an OK/WARN/ERROR state per miner and per check.
+
+    Only checks that are (or are about to become) non-OK are stored, so a
+    healthy miner costs a dictionary lookup per observation. A check has to
+    stay in its new state for raise_after_secs (getting worse) or
+    clear_after_secs (getting better) before a transition fires, which keeps
+    a flapping miner from generating a transition on every poll. Transitions
+    are buffered and handed out as a digest at most every digest_interval_secs.
+    """
+
+    def __init__(self, raise_after_secs=0, clear_after_secs=0, digest_interval_secs=0):
+        self.raise_after_secs = raise_after_secs
+        self.clear_after_secs = clear_after_secs
+        self.digest_interval_secs = digest_interval_secs
+        # (key, source) -> {check: CheckState}
+        self.states = {}
+        self.transitions = []
+        self.active_count = 0
+        self.last_digest_time = None
+
+    def observe(self, key, source, findings, now, partial=False):
+        """ findings maps check -> (level, message) for the checks reported by
+        the given source. Checks from the same source that are missing from
+        findings are considered OK unless partial is True.
+        """
+        checks = self.states.get((key, source))
+        if checks is None:
+            if not any(LEVEL_STATES[level] != OK for level, _ in findings.values()):
+                return
+            checks = self.states[(key, source)] = {}
+
+        observed = dict((check, (LEVEL_STATES[level], message))
+                        for check, (level, message) in findings.items())
+        if not partial:
+            for check in checks:
+                if check not in observed:
+                    observed[check] = (OK, None)
+
+        for check, (state, message) in observed.items():
+            check_state = checks.get(check)
+            if check_state is None:
+                if state == OK:
+                    continue
+                check_state = checks[check] = CheckState()
+            self._update(key, check, check_state, state, message, now)
+            if check_state.state == OK and check_state.pending_state is None:
+                del checks[check]
+
+        if not checks:
+            del self.states[(key, source)]
+
+    def _update(self, key, check, check_state, state, message, now):
+        if state == check_state.state:
+            check_state.pending_state = None
+            if state != OK:
+                check_state.message = message
+            return
+
+        if check_state.pending_state != state:
+            check_state.pending_state = state
+            check_state.pending_since = now
+
+        hold_secs = self.raise_after_secs if state > check_state.state else self.clear_after_secs
+        if now - check_state.pending_since < hold_secs:
+            return
+
+        self.transitions.append(Transition(key, check, check_state.state, state,
+                                           message or check_state.message, now))
+        if check_state.state == OK:
+            self.active_count += 1
+        elif state == OK:
+            self.active_count -= 1
+        check_state.state = state
+        check_state.message = message
+        check_state.pending_state = None
+
+    def retain(self, keys):
+        """ Drops the states of miners that are not in keys anymore (e.g.
+        deleted miners), so they do not count as failing forever.
+        """
+        for state_key in [state_key for state_key in self.states if state_key[0] not in keys]:
+            for check_state in self.states.pop(state_key).values():
+                if check_state.state != OK:
+                    self.active_count -= 1
+
+    def pop_digest(self, now):
+        """ Returns a Digest if there are transitions and the rate limit allows
+        sending one, None otherwise.
+        """
+        if not self.transitions:
+            return None
+        if self.last_digest_time is not None and now - self.last_digest_time < self.digest_interval_secs:
+            return None
+        digest = Digest(self.transitions, self.active_count)
+        self.transitions = []
+        self.last_digest_time = now
+        return digest
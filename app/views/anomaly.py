@@ -0,0 +1,238 @@
+import math
+import threading
+
+import config
+from app.views.model_catalog import model_catalog
+from app.views.rules import HASHRATE_UNITS, hashes_per_sec, make_finding
+
+
+class Ewma(object):
+    """ Exponentially weighted mean and variance, O(1) per sample. """
+    __slots__ = ('mean', 'var', 'count')
+
+    def __init__(self):
+        self.mean = 0.0
+        self.var = 0.0
+        self.count = 0
+
+    def update(self, value, alpha):
+        if self.count == 0:
+            self.mean = float(value)
+        else:
+            diff = value - self.mean
+            increment = alpha * diff
+            self.mean += increment
+            self.var = (1 - alpha) * (self.var + diff * increment)
+        self.count += 1
+
+
+class Baseline(Ewma):
+    """ Ewma of one metric of one miner instance or hash board, with the
+    CUSUM of its deviations in the direction that matters.
+    """
+    __slots__ = ('cusum', 'peer_key')
+
+    def __init__(self, peer_key):
+        Ewma.__init__(self)
+        self.cusum = 0.0
+        self.peer_key = peer_key
+
+
+class PeerStats(object):
+    """ Running sums of the baseline means of the streams of one model,
+    updated in O(1) when one of them moves, whatever the size of the fleet.
+    """
+    __slots__ = ('count', 'total', 'total_sq')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+
+    def add(self, mean):
+        self.count += 1
+        self.total += mean
+        self.total_sq += mean * mean
+
+    def remove(self, mean):
+        self.count -= 1
+        self.total -= mean
+        self.total_sq -= mean * mean
+
+    def without(self, mean):
+        """ (mean, variance) of the other streams, mean being one of them. """
+        count = self.count - 1
+        others_mean = (self.total - mean) / count
+        # Rounding can make it slightly negative.
+        return others_mean, max(0.0, (self.total_sq - mean * mean) / count - others_mean * others_mean)
+
+
+class Metric(object):
+    """ How a metric is watched. sign is -1 when only drops matter
+    (hashrate), 1 when only rises do (temperature). The standard deviation
+    is floored so a very steady metric doesn't turn noise into anomalies.
+    """
+
+    def __init__(self, name, title, sign, min_rel_std, min_std):
+        self.name = name
+        self.title = title
+        self.sign = sign
+        self.min_rel_std = min_rel_std
+        self.min_std = min_std
+
+    def std(self, mean, var):
+        return max(math.sqrt(var), self.min_std, abs(mean) * self.min_rel_std)
+
+
+HASHRATE = Metric('hashrate', "Hashrate", -1, min_rel_std=0.01, min_std=1.0)
+TEMPERATURE = Metric('temp', "Temperature", 1, min_rel_std=0, min_std=1.0)
+
+
+class HashrateDisplay(object):
+    """ Converts hashes/s to the unit of the model for the messages. """
+
+    def __init__(self, unit):
+        self.unit = unit
+        self.scale = HASHRATE_UNITS[unit]
+
+    def __call__(self, value):
+        return value / self.scale
+
+
+class TemperatureDisplay(object):
+    unit = "C"
+
+    def __call__(self, value):
+        return value
+
+
+display_temp = TemperatureDisplay()
+
+
+class AnomalyDetector(object):
+    """ Flags miners drifting from their own history and from their peers,
+    in O(1) time and memory per sample.
+
+    Each hashrate and temperature stream has an EWMA baseline. There is one
+    stream per miner instance, plus one per hash board when the miner
+    reports chain rates.
+
+    A sample more than z_threshold standard deviations from the baseline,
+    in the bad direction, is a spike. Spikes are kept out of the baseline.
+    A one-sided CUSUM of the deviations catches slow degradation that never
+    looks like a spike.
+
+    The baseline means of the streams of a model (per kind of source) that
+    have min_samples are summed up. A stream whose mean is z_threshold
+    standard deviations away from the mean of the other streams is a peer
+    outlier.
+
+    Samples taken less than warmup_secs after a (re)boot are ignored,
+    because the hashrate of a miner that just started is always low.
+    """
+
+    def __init__(self, alpha=0.02, z_threshold=4.0, cusum_slack=1.0, cusum_limit=10.0, min_samples=20,
+                 min_peers=5, warmup_secs=15 * 60):
+        self.alpha = alpha
+        self.z_threshold = z_threshold
+        self.cusum_slack = cusum_slack
+        self.cusum_limit = cusum_limit
+        self.min_samples = min_samples
+        self.min_peers = min_peers
+        self.warmup_secs = warmup_secs
+        self.lock = threading.Lock()
+        # miner id -> (metric name, source) -> Baseline
+        self.baselines = {}
+        # Miners that rebooted, their CUSUMs start over once they are warm
+        self.warming = set()
+        # (metric name, model name, source kind) -> PeerStats of its streams
+        self.peers = {}
+
+    def _observe(self, findings, metric, miner, model, source, value, display):
+        streams = self.baselines.setdefault(miner.id, {})
+        baseline = streams.get((metric.name, source))
+        if baseline is None:
+            baseline = streams[(metric.name, source)] = Baseline((metric.name, model.model, source[0]))
+        peers = self.peers.get(baseline.peer_key)
+        if peers is None:
+            peers = self.peers[baseline.peer_key] = PeerStats()
+
+        spike = False
+        if baseline.count >= self.min_samples:
+            where = "" if source == ('instance', 0) else " ({} {})".format(*source)
+            check = "{}_{}_{}".format(metric.name, *source)
+            direction = "below" if metric.sign < 0 else "above"
+            detail = dict(metric=metric.title, where=where, direction=direction, unit=display.unit)
+            # Positive when the metric moves the bad way.
+            deviation = metric.sign * (value - baseline.mean) / metric.std(baseline.mean, baseline.var)
+            if deviation >= self.z_threshold:
+                spike = True
+                findings.append(make_finding('anomaly_spike', 'warning', miner.ip, display(value),
+                                             display(baseline.mean), check='anomaly_spike_' + check,
+                                             score=deviation, **detail))
+            # A single spike is reported as such, it must not be enough to
+            # trip the CUSUM too.
+            baseline.cusum = max(0.0, baseline.cusum + min(deviation, self.z_threshold) - self.cusum_slack)
+            if baseline.cusum >= self.cusum_limit:
+                findings.append(make_finding('anomaly_shift', 'warning', miner.ip, display(value),
+                                             display(baseline.mean), check='anomaly_shift_' + check, **detail))
+            # The stream itself is one of the peers summed up.
+            if peers.count - 1 >= self.min_peers:
+                peers_mean, peers_var = peers.without(baseline.mean)
+                peer_deviation = metric.sign * (baseline.mean - peers_mean) / metric.std(peers_mean, peers_var)
+                if peer_deviation >= self.z_threshold:
+                    findings.append(make_finding('anomaly_peer', 'warning', miner.ip, display(baseline.mean),
+                                                 display(peers_mean), check='anomaly_peer_' + check,
+                                                 score=peer_deviation, model=model.model, **detail))
+        if not spike:
+            # Streams join the peers once their baseline is settled.
+            if baseline.count >= self.min_samples:
+                peers.remove(baseline.mean)
+            baseline.update(value, self.alpha)
+            if baseline.count >= self.min_samples:
+                peers.add(baseline.mean)
+
+    def observe(self, miner, miner_status):
+        """ Findings of the latest poll of a miner. """
+        model = model_catalog.get(miner.model_id)
+        findings = []
+        with self.lock:
+            instances = miner_status.miner_instance_list
+            if any(instance.uptime_secs < self.warmup_secs for instance in instances):
+                self.warming.add(miner.id)
+                return findings
+            if miner.id in self.warming:
+                self.warming.discard(miner.id)
+                for baseline in self.baselines.get(miner.id, {}).values():
+                    baseline.cusum = 0.0
+
+            display_hashrate = HashrateDisplay(model.hashrate_unit)
+            for i, instance in enumerate(instances):
+                if instance.hashrate_unit in HASHRATE_UNITS:
+                    self._observe(findings, HASHRATE, miner, model, ('instance', i),
+                                  hashes_per_sec(instance.hashrate_value, instance.hashrate_unit), display_hashrate)
+                temps = [temp for temp in instance.temps if temp]
+                if temps:
+                    self._observe(findings, TEMPERATURE, miner, model, ('instance', i), max(temps), display_temp)
+            for chain, chain_hashes_per_sec in miner_status.chain_hashrates:
+                self._observe(findings, HASHRATE, miner, model, ('board', chain), chain_hashes_per_sec,
+                              display_hashrate)
+        return findings
+
+    def retain(self, miner_ids):
+        """ Drops the streams of the miners that are gone. """
+        with self.lock:
+            for miner_id in [miner_id for miner_id in self.baselines if miner_id not in miner_ids]:
+                for baseline in self.baselines.pop(miner_id).values():
+                    if baseline.count >= self.min_samples:
+                        self.peers[baseline.peer_key].remove(baseline.mean)
+                self.warming.discard(miner_id)
+
+
+def create_anomaly_detector():
+    """ Returns the detector unless ANOMALY_DETECTION is off. """
+    if not config.ANOMALY_DETECTION:
+        return None
+    return AnomalyDetector(alpha=config.ANOMALY_ALPHA,
+                           z_threshold=config.ANOMALY_Z_THRESHOLD,
+                           warmup_secs=config.MINER_WARMUP_SECS)
@@ -3,21 +3,29 @@ import threading
 import time
 from functools import wraps
 
-import jinja2
-import requests
 from flask import (Response, abort, flash, jsonify, redirect, render_template,
                    request, url_for)
 from flask.views import MethodView
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 
 import config
-from app import (AGENT_INTERVAL_SECS, __version__, app, db, last_run_time,
-                 last_status_is_ok, logger)
-from app.models import Miner, MinerModel, MinerEvent
+from app import __version__, app, db, logger, url_for_ex
+from app.models import Miner
 from app.pycgminer.pycgminer import CgminerAPI
+from app.views.agent import Agent
+from app.views.aggregates import (DIMENSION_TITLES, DIMENSIONS, AggregatesView,
+                                  FleetAggregates, make_contribution)
 from app.views.antminer_json import get_pools, get_stats, get_summary
-from mail_sender import send_email
-from miner_adapter import detect_model, get_miner_status, update_unit_and_value
+from app.views.leader import read_agent_status
+from app.views.miner_table import (PER_PAGE, SORT_KEYS, STATUS_UP, MinerTable,
+                                   miner_tables)
+from app.views.model_catalog import model_catalog
+from app.views.perf import perf, wall_clock
+from app.views.snapshot import (LEVEL_NAMES, SnapshotReader, make_down_record,
+                                make_records)
+from app.views.templating import miner_rows
+from miner_adapter import detect_model, get_miner_status
 from miners_profit import get_miners_profit
 
 
@@ -51,16 +59,73 @@ def requires_auth(f):
     return decorated
 
 
+def requires_writable(f):
+    """ Refuses the request when the web app is a read-only frontend. """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        if config.WEB_READ_ONLY:
+            return abort(403)
+        return f(*args, **kwargs)
+    return decorated
+
+
+snapshot_reader = SnapshotReader(config.SNAPSHOT_FILE)
+
+
+def snapshot_is_stale(published):
+    # Add 10s for slack.
+    return time.time() - published >= config.AGENT_INTERVAL_SECS + 10
+
+
+TABLE_ARGS = ('model', 'pool_user', 'status', 'remarks', 'sort', 'order', 'per_page', 'live')
+
+
+def miner_table_args():
+    """ Filters, sort and page of the miner table, from the query string. """
+    args = request.args
+    status = args.get('status')
+    return dict(model=args.get('model') or None,
+                pool_user=args.get('pool_user') or None,
+                # The miners that are down are listed on their own by default.
+                status=status if status in LEVEL_NAMES.values() else STATUS_UP,
+                remarks=args.get('remarks') or None,
+                sort=args.get('sort') if args.get('sort') in SORT_KEYS else 'ip',
+                descending=args.get('order') == 'desc',
+                page=args.get('page', 1, type=int),
+                per_page=args.get('per_page', PER_PAGE, type=int))
+
+
+def miner_table_url(**changes):
+    """ URL of the miner table with some of the current arguments changed,
+    back to the first page unless a page is given.
+    """
+    values = dict((name, request.args.get(name)) for name in TABLE_ARGS)
+    values.update(changes)
+    return url_for_ex('miners', **dict((name, value) for name, value in values.items() if value))
+
+
 @app.route('/')
 @requires_auth
 def miners():
     # Init variables
-    start = time.clock()
-    miners = Miner.query.all()
-    active_miner_instances = []
-    inactive_miners = []
-    # map is lazy initialized
-    total_hash_rate_per_model = {}
+    start = wall_clock()
+    # Serve what the agent published unless a live poll is asked for. A read
+    # only frontend never polls, it shows the snapshot even when stale.
+    if config.WEB_READ_ONLY or not request.args.get('live'):
+        snapshot = snapshot_reader.read()
+        if config.WEB_READ_ONLY:
+            if snapshot is None:
+                flash("[WARNING] The monitoring agent has not published anything yet.", "warning")
+                return miners_from_snapshot(start, time.time(), [])
+            if snapshot_is_stale(snapshot[0]):
+                flash("[WARNING] The monitoring agent is not running, this data is outdated.", "warning")
+            return miners_from_snapshot(start, *snapshot)
+        if snapshot is not None and not snapshot_is_stale(snapshot[0]):
+            return miners_from_snapshot(start, *snapshot)
+
+    miners = Miner.query.options(joinedload(Miner.model)).all()
+    records = []
+    aggregates = FleetAggregates()
     errors = False
 
     for miner in miners:
@@ -69,16 +134,14 @@ def miners():
         # if miner not accessible
         if not miner_status:
             errors = True
-            inactive_miners.append(miner)
+            records.append(make_down_record(miner, None))
+            aggregates.update(miner.id, make_contribution(records[-1:], 0, config.SITE_NAME))
         else:
-            for miner_instance in miner_status.miner_instance_list:
-                if not miner.model.model in total_hash_rate_per_model.keys():
-                    total_hash_rate_per_model[miner.model.model] = {
-                        "value": 0, "unit": "<EMPTY>"}
-
-                total_hash_rate_per_model[miner.model.model]["value"] += miner_instance.hashrate_value
-                total_hash_rate_per_model[miner.model.model]["unit"] = miner_instance.hashrate_unit
-                active_miner_instances.append(miner_instance)
+            miner_records = make_records(miner, miner_status)
+            records.extend(miner_records)
+            if miner_records:
+                aggregates.update(miner.id, make_contribution(miner_records, model_catalog.get(miner.model_id).watts,
+                                                              config.SITE_NAME))
 
             # Log warnings
             for message in miner_status.debugs:
@@ -100,31 +163,68 @@ def miners():
         error_message = "[INFO] All miners are operating normal. No errors found."
         flash(error_message, "info")
 
-    # Convert the total_hash_rate_per_model into a data structure that the template can
-    # consume.
-    total_hash_rate_per_model_temp = {}
-    for key in total_hash_rate_per_model:
-        value, unit = update_unit_and_value(
-            total_hash_rate_per_model[key]["value"], total_hash_rate_per_model[key]["unit"])
-        total_hash_rate_per_model_temp[key] = "{:3.2f} {}".format(value, unit)
-
-    end = time.clock()
-    models = MinerModel.query.all()
-    loading_time = end - start
-    return render_template('myminers.html',
-                           version=__version__,
-                           models=models,
-                           active_miner_instances=active_miner_instances,
-                           inactive_miners=inactive_miners,
-                           total_hash_rate_per_model=total_hash_rate_per_model_temp,
-                           loading_time=loading_time,
-                           generated_time=time.strftime(
-                               "%d/%b %H:%M:%S", time.localtime()),
-                           is_request=True)
+    aggregates = AggregatesView().merge(aggregates.to_dict())
+    table = MinerTable(records)
+    return render_miners(start, time.time(), table, table.query(**miner_table_args()), aggregates)
+
+
+def miners_from_snapshot(start, published, records):
+    # Totals are maintained by the agent as it polls, reading them does not
+    # depend on the number of miners.
+    agent_status = read_agent_status(config.AGENT_STATUS_FILE)
+    aggregates = AggregatesView()
+    if agent_status is not None and agent_status.get('aggregates'):
+        aggregates.merge(agent_status['aggregates'])
+
+    table = miner_tables.get(records)
+    page = table.query(**miner_table_args())
+    # Only the most severe message of each miner is in the snapshot, and
+    # only those of the page shown are flashed.
+    for row in page.rows:
+        if row.level in ('error', 'warning'):
+            flash(row.message, row.level)
+    problems = sum(len(table.postings['status'].get(level, ())) for level in ('error', 'warning'))
+    shown = sum(1 for row in page.rows if row.level in ('error', 'warning'))
+    if problems > shown:
+        flash("[INFO] {} more miner(s) with errors or warnings, filter the table by status to see them.".format(
+            problems - shown), "info")
+
+    if not records:
+        flash("[INFO] No miners added yet. Please add miners using the above form.", "info")
+    elif not problems and not table.postings['status'].get('down'):
+        flash("[INFO] All miners are operating normal. No errors found.", "info")
+    return render_miners(start, published, table, page, aggregates)
+
+
+def render_miners(start, generated, table, page, aggregates):
+    table_args = miner_table_args()
+    page_status = table_args['status']
+    loading_time = wall_clock() - start
+    with perf.timer('render'):
+        return render_template('myminers.html',
+                               version=__version__,
+                               models_by_name=model_catalog.index().by_name,
+                               table=table,
+                               page=page,
+                               table_args=table_args,
+                               table_url=miner_table_url,
+                               sort_keys=sorted(SORT_KEYS),
+                               statuses=[LEVEL_NAMES[level] for level in sorted(LEVEL_NAMES)],
+                               inactive_rows=table.rows_with_status('down') if page_status != 'down' else [],
+                               aggregates=aggregates,
+                               dimensions=DIMENSIONS,
+                               dimension_titles=DIMENSION_TITLES,
+                               total_hash_rate_per_model=aggregates.total_hash_rate_per_model(),
+                               loading_time=loading_time,
+                               generated_time=time.strftime(
+                                   "%d/%b %H:%M:%S", time.localtime(generated)),
+                               miner_rows=miner_rows,
+                               is_request=True)
 
 
 @app.route('/add', methods=['POST'])
 @requires_auth
+@requires_writable
 def add_miner():
     miner_ip = request.form['ip']
 
@@ -151,20 +251,23 @@ def add_miner():
                 "Error while adding miner. Message: {}".format(e.message))
             flash("IP Address {} already added".format(miner_ip), "error")
 
-    return redirect(url_for('miners'))
+    # The snapshot does not know about the change until the next sweep.
+    return redirect(url_for('miners', live=1))
 
 
 @app.route('/delete/<id>')
 @requires_auth
+@requires_writable
 def delete_miner(id):
     miner = Miner.query.filter_by(id=int(id)).first()
     db.session.delete(miner)
     db.session.commit()
-    return redirect(url_for('miners'))
+    return redirect(url_for('miners', live=1))
 
 
 @app.route('/restart/<id>')
 @requires_auth
+@requires_writable
 def restart_miner(id):
     miner = Miner.query.filter_by(id=int(id)).first()
     cgminer = CgminerAPI(host=miner.ip)
@@ -177,6 +280,7 @@ def restart_miner(id):
 
 @app.route('/quit/<id>')
 @requires_auth
+@requires_writable
 def quit_miner(id):
     miner = Miner.query.filter_by(id=int(id)).first()
     cgminer = CgminerAPI(host=miner.ip)
@@ -189,6 +293,7 @@ def quit_miner(id):
 
 @app.route('/<ip>/summary')
 @requires_auth
+@requires_writable
 def summary(ip):
     output = get_summary(ip)
     return jsonify(output)
@@ -196,6 +301,7 @@ def summary(ip):
 
 @app.route('/<ip>/pools')
 @requires_auth
+@requires_writable
 def pools(ip):
     output = get_pools(ip)
     return jsonify(output)
@@ -203,6 +309,7 @@ def pools(ip):
 
 @app.route('/<ip>/stats')
 @requires_auth
+@requires_writable
 def stats(ip):
     output = get_stats(ip)
     return jsonify(output)
@@ -210,174 +317,44 @@ def stats(ip):
 
 @app.route('/profits', methods=['GET', 'POST'])
 @requires_auth
+@requires_writable
 def profits():
     # Init variables
     usd_per_kwh = float(request.form.get('usd_per_kwh', 0.09))
-    start = time.clock()
+    start = wall_clock()
     miners_profit = get_miners_profit(usd_per_kwh)
-    loading_time = time.clock() - start
-    return render_template('myprofits.html',
-                           version=__version__,
-                           data=miners_profit,
-                           loading_time=loading_time,
-                           usd_per_kwh=usd_per_kwh)
+    loading_time = wall_clock() - start
+    with perf.timer('render'):
+        return render_template('myprofits.html',
+                               version=__version__,
+                               data=miners_profit,
+                               loading_time=loading_time,
+                               usd_per_kwh=usd_per_kwh)
 
 
 @app.route('/miners_status', methods=['GET'])
 @requires_auth
 def status():
-    global last_run_time
-    global last_status_is_ok
-    global AGENT_INTERVAL_SECS
-    # Add 10s for slack.
-    if time.time() - last_run_time >= AGENT_INTERVAL_SECS + 10 or not last_status_is_ok:
+    # The agent may run in another worker or process, so read the health
+    # file it publishes.
+    agent_status = read_agent_status(config.AGENT_STATUS_FILE)
+    if agent_status is None or agent_status.get('state') == 'stopped' \
+            or snapshot_is_stale(agent_status['last_run_time']) \
+            or not agent_status['last_status_is_ok']:
         return abort(500)
     else:
-        return jsonify({"last_run_time": last_run_time})
+        return jsonify({"last_run_time": agent_status['last_run_time'],
+                        "heartbeat": agent_status['heartbeat'],
+                        "pid": agent_status['pid']})
 
 
-def render_without_request(template_name, **template_vars):
-    """
-    Usage is the same as flask.render_template:
-
-    render_without_request('my_template.html', var1='foo', var2='bar')
-    """
-    env = jinja2.Environment(
-        loader=jinja2.PackageLoader('app', 'templates')
-    )
-    template = env.get_template(template_name)
-    return template.render(**template_vars)
-
-
-def try_http_connect(miners, timeout):
-    failed_miners = []
-    for miner in miners:
-        # Have a small retry loop.
-        for i in range(0, 10):
-            try:
-                url = "http://{}".format(miner.ip)
-                r = requests.get(url, timeout=timeout)
-                if r.status_code >= 500:
-                    failed_miners.append(miner)
-                break
-            except Exception as e:
-                # If an exception, just really consider it
-                # if its the last one, otherwise lets try
-                # again after sleeping a bit. 
-                if i == 9:
-                    logger.warning("Error while connecting to {}".format(e.message))
-                    failed_miners.append(miner)
-                else:
-                    time.sleep(1)
-
-    return failed_miners
-
-# Some troubleshooting queries:
-# select m.ip, count(*) count from miner_event me inner join miner m on me.miner_id=m.id group by m.ip order by count desc;
-def log_miner_event(miner, event_type, message):
-    try:
-        logger.debug("Miner:{} type:{} message:{}".format(miner.ip, event_type, message))
-        miner_event = MinerEvent(
-            miner_id=miner.id, event_type=event_type, message=message)
-        db.session.add(miner_event)
-        db.session.commit()
-    except Exception as e:
-        # there could be many types of exceptions such as: IntegrityError , database being locket, etc.
-        db.session.rollback()
-        logger.error("Error while logging event. Message:{}".format(e.message))
+agent = Agent()
 
 
 @app.before_first_request
 def activate_job():
-    def run_job():
-        global last_run_time
-        global last_status_is_ok
-        global AGENT_INTERVAL_SECS
-        lightweight_last_run_time = 0
-        lightweight_interval_secs = 5
-        last_body_message = None
-        while True:
-            try:
-                messages = []
-                has_errors = False
-                has_warnings = False
-
-                # Light check (HTTP connect)
-                miners = Miner.query.all()
-                if last_run_time != 0 and time.time() - lightweight_last_run_time >= lightweight_interval_secs:
-                    logger.debug("Lightweight HTTP checks in progress...")
-                    inactive_miners = try_http_connect(
-                        miners=miners, timeout=5)
-                    for inactive_miner in inactive_miners:
-                        msg = "Miner {} not accessible (HTTP Connect)".format(
-                            inactive_miner.ip)
-                        messages.append(("error", msg))
-                        log_miner_event(inactive_miner, "error", msg)
-                        has_errors = True
-                    lightweight_last_run_time = time.time()
-
-                # Expensive check (CGMiner API)
-                active_miner_instances = []
-                cgminer_check = False
-                if len(messages) == 0 and time.time() - last_run_time >= AGENT_INTERVAL_SECS:
-                    logger.info("CGMiner API checks in progress...")
-                    cgminer_check = True
-                    for miner in miners:
-                        miner_status = get_miner_status(miner)
-                        if not miner_status:
-                            # Log event
-                            messages.append(
-                                ("error", "Miner {} not accessible (CG Miner)".format(miner.ip)))
-                            log_miner_event(
-                                miner, "error", "Miner not accessible")
-                            has_errors = True
-                        else:
-                            for miner_instance in miner_status.miner_instance_list:
-                                active_miner_instances.append(miner_instance)
-                            for message in miner_status.errors:
-                                messages.append(("error", message))
-                                log_miner_event(miner, "error", message)
-                                has_errors = True
-                            for message in miner_status.warnings:
-                                messages.append(('warning', message))
-                                log_miner_event(miner, "warning", message)
-                                has_warnings = True
-
-                    # Update last run time.
-                    last_run_time = time.time()
-
-                # Update status
-                if cgminer_check:
-                    last_status_is_ok = len(messages) == 0
-                #assert (has_errors or has_warnings) == len(messages) > 0
-                if len(messages) <> 0:
-                    body_message = render_without_request("messages.html", messages=messages);
-                    body_html = (body_message + render_without_request("active_miners.html", active_miner_instances=active_miner_instances))
-                    body_plain = "Error founds while monitoring. Please go to {}\n".format(
-                        config.DOMAIN_ADDR)
-                    # Just send the error email if it changed
-                    if last_body_message <> body_message:
-                        if has_errors:
-                            email_title = "Monitoring Error"
-                        else:
-                            email_title = "Monitoring warning"
-                        for i in range(0, 10):
-                            if send_email(config.GMAIL_USER, config.GMAIL_PWD, config.EMAIL_TO, email_title, body_html, body_plain):
-                                last_body_message = body_message
-                                break
-                            logger.warn(
-                                "Failure sending email, retrying... #{}".format(i))
-                    else:
-                        logger.debug("Email the same as previous... skipping...")
-                else:
-                    if not last_body_message is None and cgminer_check:
-                        msg = "All miners are working as expected"
-                        send_email(config.GMAIL_USER, config.GMAIL_PWD, config.EMAIL_TO, "Monitor Success", msg, msg);
-                        last_body_message = None
-            except Exception as e:
-                logger.error("Error. Message:{}".format(e.message))
-                last_status_is_ok = False
-            time.sleep(lightweight_interval_secs)
-
-    thread = threading.Thread(target=run_job)
+    if not config.AGENT_EMBEDDED:
+        logger.info("Agent not embedded, run antminer_agent.py to poll the miners")
+        return
+    thread = threading.Thread(target=agent.run)
     thread.start()
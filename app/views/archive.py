@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+import time
+import zlib
+from collections import namedtuple
+
+import config
+from app import logger
+
+SEGMENT_SUFFIX = '.seg'
+INDEX_SUFFIX = '.idx'
+
+# One poll of one miner: what is needed to run the parsers again.
+ArchivedPoll = namedtuple('ArchivedPoll', 'time miner_id ip model remarks count responses')
+
+# One line of a segment index: where a block is and which polls it holds.
+BlockIndex = namedtuple('BlockIndex', 'first_time last_time offset length count')
+
+# Stands in for the Miner row of an archived poll when parsing it again.
+ReplayMiner = namedtuple('ReplayMiner', 'id ip model_id remarks count')
+
+
+class ResponseArchive(object):
+    """ Append-only archive of the raw cgminer replies (stats, pools,
+    summary) of every poll, so a parser can be run again on what a miner
+    really answered.
+
+    Polls are buffered and written by flush() as one zlib compressed block,
+    normally once per sweep: the replies of the miners of a sweep look alike
+    and compress much better together. Blocks are appended to segment files,
+    each with a small text index (time range, offset and length of every
+    block) so reading a time range only decompresses the blocks in it. A new
+    segment is started every segment_secs or segment_max_bytes, segments
+    older than retention_secs are deleted.
+    """
+
+    def __init__(self, directory, segment_secs=3600, segment_max_bytes=64 * 1024 * 1024,
+                 retention_secs=7 * 24 * 3600, compress_level=6):
+        self.directory = directory
+        self.segment_secs = segment_secs
+        self.segment_max_bytes = segment_max_bytes
+        self.retention_secs = retention_secs
+        self.compress_level = compress_level
+        self.lock = threading.Lock()
+        self.pending = []
+        self.segment = None
+        self.segment_started = 0
+        self.segment_size = 0
+
+    def record(self, miner, model_name, responses, now=None):
+        """ Buffers the replies of one poll. responses maps the command
+        (stats, pools, summary) to the decoded reply.
+        """
+        poll = ArchivedPoll(now or time.time(), miner.id, miner.ip, model_name, miner.remarks, miner.count,
+                            responses)
+        with self.lock:
+            self.pending.append(poll)
+
+    def flush(self):
+        """ Writes the buffered polls as one block. """
+        with self.lock:
+            polls, self.pending = self.pending, []
+        if not polls:
+            return
+        # Failed replies carry the exception, stored as text.
+        data = zlib.compress(json.dumps([list(poll) for poll in polls], default=str).encode('utf-8'),
+                             self.compress_level)
+        try:
+            self._append(polls[0].time, polls[-1].time, len(polls), data)
+        except (IOError, OSError) as e:
+            logger.error("Error while archiving responses. Message:{}".format(e))
+
+    def _append(self, first_time, last_time, count, data):
+        now = time.time()
+        if self.segment is None or now - self.segment_started >= self.segment_secs or \
+                self.segment_size >= self.segment_max_bytes:
+            self._rotate(now)
+        with open(self.segment + SEGMENT_SUFFIX, 'ab') as f:
+            f.write(data)
+        # The index line is written last, a block without one (crash in
+        # between) is never read.
+        with open(self.segment + INDEX_SUFFIX, 'a') as f:
+            f.write("{:.3f}\t{:.3f}\t{}\t{}\t{}\n".format(first_time, last_time, self.segment_size, len(data),
+                                                          count))
+        self.segment_size += len(data)
+
+    def _rotate(self, now):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Segments are never appended to after a restart, names sort by time.
+        self.segment = os.path.join(self.directory, "{:013d}".format(int(now * 1000)))
+        self.segment_started = now
+        self.segment_size = 0
+        for name in segment_names(self.directory):
+            if name_time(name) < now - self.retention_secs:
+                for suffix in (SEGMENT_SUFFIX, INDEX_SUFFIX):
+                    try:
+                        os.remove(os.path.join(self.directory, name + suffix))
+                    except OSError:
+                        pass
+
+
+def segment_names(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(name[:-len(SEGMENT_SUFFIX)] for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+
+
+def name_time(name):
+    return int(name) / 1000.0
+
+
+def read_index(path):
+    blocks = []
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) != 5:
+                    # Truncated last line
+                    continue
+                blocks.append(BlockIndex(float(fields[0]), float(fields[1]), int(fields[2]), int(fields[3]),
+                                         int(fields[4])))
+    except (IOError, OSError):
+        pass
+    return blocks
+
+
+def read_polls(directory, since=None, until=None, ips=None):
+    """ Yields the archived polls between since and until (epoch seconds,
+    both optional), oldest first, optionally only for the given IPs.
+    """
+    names = segment_names(directory)
+    for i, name in enumerate(names):
+        # A segment only holds blocks written before the next one started.
+        if since is not None and i + 1 < len(names) and name_time(names[i + 1]) < since:
+            continue
+        path = os.path.join(directory, name)
+        blocks = read_index(path + INDEX_SUFFIX)
+        # Segments are named after their first flush, which comes after the
+        # polls of the block: only the blocks tell when they start.
+        if until is not None and blocks and blocks[0].first_time > until:
+            break
+        with open(path + SEGMENT_SUFFIX, 'rb') as f:
+            for block in blocks:
+                if (since is not None and block.last_time < since) or \
+                        (until is not None and block.first_time > until):
+                    continue
+                f.seek(block.offset)
+                data = f.read(block.length)
+                if len(data) != block.length:
+                    logger.error("Truncated archive block in {} at {}".format(name, block.offset))
+                    continue
+                for fields in json.loads(zlib.decompress(data).decode('utf-8')):
+                    poll = ArchivedPoll(*fields)
+                    if (since is not None and poll.time < since) or (until is not None and poll.time > until):
+                        continue
+                    if ips and poll.ip not in ips:
+                        continue
+                    yield poll
+
+
+def create_archive():
+    """ Returns the archive when RESPONSE_ARCHIVE_DIR is set, None otherwise. """
+    if not config.RESPONSE_ARCHIVE_DIR:
+        return None
+    return ResponseArchive(config.RESPONSE_ARCHIVE_DIR,
+                           segment_secs=config.RESPONSE_ARCHIVE_SEGMENT_SECS,
+                           retention_secs=config.RESPONSE_ARCHIVE_RETENTION_SECS)
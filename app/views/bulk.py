@@ -0,0 +1,365 @@
+import binascii
+import json
+import os
+import re
+import threading
+import time
+
+from flask import abort, flash, jsonify, redirect, render_template, request, url_for
+
+import config
+from app import __version__, app, logger
+from app.models import Miner
+from app.pycgminer import CgminerAPI
+from app.views.aggregates import tags_of
+from app.views.antminer import requires_auth, requires_writable, snapshot_reader
+from app.views.antminer_json import get_summary
+from app.views.circuit_breaker import breaker
+from app.views.model_catalog import model_catalog
+from app.views.snapshot import LEVEL_NAMES
+
+# action -> reply STATUS of cgminer when the command was accepted
+ACTIONS = {
+    'restart': "RESTART",
+    'quit': "BYE",
+}
+OPERATION_ID_RE = re.compile(r'^[0-9a-f-]{1,64}$')
+# Seconds between two probes of a restarting miner
+PROBE_INTERVAL_SECS = 5
+# A miner is back when cgminer answers with an uptime shorter than the time
+# since the restart plus this much (clock skew, slow answer).
+UPTIME_SLACK_SECS = 60
+
+
+class BulkStore(object):
+    """ Progress of the bulk operations, one JSON file each, so any worker
+    can show an operation started by another one. Cancelling is a file
+    next to it, checked by the worker running the operation.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, op_id, suffix='.json'):
+        return os.path.join(self.directory, op_id + suffix)
+
+    def save(self, operation):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(operation['id'])
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'w') as f:
+            json.dump(operation, f)
+        os.rename(tmp_path, path)
+
+    def load(self, op_id):
+        try:
+            with open(self._path(op_id)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def recent(self, count=20):
+        if not os.path.isdir(self.directory):
+            return []
+        op_ids = sorted((name[:-len('.json')] for name in os.listdir(self.directory) if name.endswith('.json')),
+                        reverse=True)[:count]
+        return [operation for operation in (self.load(op_id) for op_id in op_ids) if operation is not None]
+
+    def request_cancel(self, op_id):
+        with open(self._path(op_id, '.cancel'), 'a'):
+            pass
+
+    def cancel_requested(self, op_id):
+        return os.path.exists(self._path(op_id, '.cancel'))
+
+
+bulk_store = BulkStore(config.BULK_DIR)
+
+
+def send_command(ip, action):
+    """ Returns (accepted, reply). """
+    reply = getattr(CgminerAPI(host=ip), action)()
+    status = reply.get('STATUS')
+    return status == ACTIONS[action], json.dumps(reply, default=str)
+
+
+def probe_uptime(ip):
+    """ Uptime in seconds reported by cgminer, None when it doesn't answer. """
+    summary = get_summary(ip)
+    try:
+        if summary['STATUS'][0]['STATUS'] == 'error' or 'STALE' in summary:
+            return None
+        return int(summary['SUMMARY'][0]['Elapsed'])
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+
+class BulkOperation(object):
+    """ Sends a command to many miners, wave_size miners at a time.
+
+    The miners of a wave are handled concurrently. For a restart, each one
+    must come back (cgminer answering with a fresh uptime) within
+    verify_timeout_secs. The next wave starts wave_delay_secs after the
+    previous one is done, which spreads the power inrush of the restarts.
+    The operation halts once max_failures miners failed. Progress is saved
+    to the store after every change, and at least every BULK_HEARTBEAT_SECS
+    with a fresh heartbeat so the pages can tell it is still running.
+    """
+
+    def __init__(self, op_id, action, targets, wave_size, wave_delay_secs, verify_timeout_secs, max_failures,
+                 store, selection=None):
+        self.lock = threading.Lock()
+        self.store = store
+        self.wave_size = max(1, wave_size)
+        self.wave_delay_secs = wave_delay_secs
+        self.verify_timeout_secs = verify_timeout_secs
+        self.max_failures = max(1, max_failures)
+        self.stop_event = threading.Event()
+        self.done_event = threading.Event()
+        created = time.time()
+        self.state = {
+            "id": op_id,
+            "action": action,
+            "selection": selection or {},
+            "state": "pending",
+            "created": created,
+            "heartbeat": created,
+            "finished": None,
+            "wave_size": self.wave_size,
+            "wave_delay_secs": wave_delay_secs,
+            "wave": 0,
+            "waves": (len(targets) + self.wave_size - 1) // self.wave_size,
+            "miners": [{"id": miner_id, "ip": ip, "state": "pending", "message": ""} for miner_id, ip in targets],
+        }
+
+    def _update(self, miner=None, **changes):
+        with self.lock:
+            (miner if miner is not None else self.state).update(changes)
+            self.state['heartbeat'] = time.time()
+            self.store.save(self.state)
+
+    def _beat(self):
+        while not self.done_event.wait(config.BULK_HEARTBEAT_SECS):
+            self._update()
+
+    def _stopping(self):
+        if not self.stop_event.is_set() and self.store.cancel_requested(self.state['id']):
+            self.stop_event.set()
+        return self.stop_event.is_set()
+
+    def _wait(self, secs):
+        """ Sleeps, returns True if the operation was cancelled meanwhile. """
+        deadline = time.time() + secs
+        while not self._stopping():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self.stop_event.wait(min(remaining, 1))
+        return True
+
+    def _handle(self, miner):
+        action = self.state['action']
+        try:
+            sent = time.time()
+            accepted, reply = send_command(miner['ip'], action)
+        except Exception as e:
+            self._update(miner, state="failed", message="Error: {}".format(e))
+            return
+        if not accepted:
+            self._update(miner, state="failed", message=reply)
+            return
+        if action != 'restart':
+            self._update(miner, state="ok", message="Command accepted")
+            return
+
+        self._update(miner, state="verifying", message="Waiting for cgminer to come back")
+        deadline = sent + self.verify_timeout_secs
+        while time.time() < deadline:
+            if self._wait(PROBE_INTERVAL_SECS):
+                self._update(miner, state="failed", message="Cancelled before the miner came back")
+                return
+            # The probes fail while cgminer restarts, they must not open the
+            # circuit of the miner and be refused once it is back.
+            breaker.reset(miner['ip'])
+            uptime = probe_uptime(miner['ip'])
+            if uptime is not None and uptime <= time.time() - sent + UPTIME_SLACK_SECS:
+                self._update(miner, state="ok", message="Back after {:.0f}s".format(time.time() - sent))
+                return
+        self._update(miner, state="failed", message="Not back after {}s".format(self.verify_timeout_secs))
+
+    def run(self):
+        miners = self.state['miners']
+        self._update(state="running")
+        heartbeat = threading.Thread(target=self._beat, name="bulk-{}-heartbeat".format(self.state['id']))
+        heartbeat.daemon = True
+        heartbeat.start()
+        try:
+            outcome = self._run_waves(miners)
+        finally:
+            self.done_event.set()
+        for miner in miners:
+            if miner['state'] == "pending":
+                self._update(miner, state="skipped")
+        self._update(state=outcome, finished=time.time())
+        logger.info("Bulk {} {} {}".format(self.state['action'], self.state['id'], outcome))
+
+    def _run_waves(self, miners):
+        """ Returns the outcome of the operation. """
+        outcome = "done"
+        for start in range(0, len(miners), self.wave_size):
+            if start and self._wait(self.wave_delay_secs):
+                outcome = "cancelled"
+                break
+            if self._stopping():
+                outcome = "cancelled"
+                break
+            self._update(wave=start // self.wave_size + 1)
+            threads = [threading.Thread(target=self._handle, args=(miner,))
+                       for miner in miners[start:start + self.wave_size]]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if self._stopping():
+                outcome = "cancelled"
+                break
+            if sum(1 for miner in miners if miner['state'] == "failed") >= self.max_failures:
+                outcome = "halted"
+                break
+        return outcome
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="bulk-{}".format(self.state['id']))
+        thread.daemon = True
+        thread.start()
+
+
+def miner_levels():
+    """ miner id -> level name of its worst instance in the last snapshot. """
+    snapshot = snapshot_reader.read()
+    if snapshot is None:
+        return None
+    levels = {}
+    for record in snapshot[1]:
+        levels[record.miner_id] = max(levels.get(record.miner_id, record.level), record.level)
+    return dict((miner_id, LEVEL_NAMES[level]) for miner_id, level in levels.items())
+
+
+def select_miners(model=None, tag=None, level=None):
+    """ Miners matching all the given criteria, None if a level was asked
+    for but no snapshot was published yet.
+    """
+    miners = Miner.query.all()
+    if model:
+        miners = [miner for miner in miners if model_catalog.get(miner.model_id).model == model]
+    if tag:
+        miners = [miner for miner in miners if tag in tags_of(miner.remarks)]
+    if level:
+        levels = miner_levels()
+        if levels is None:
+            return None
+        miners = [miner for miner in miners if levels.get(miner.id) == level]
+    return sorted(miners, key=lambda miner: miner.ip)
+
+
+@app.route('/bulk')
+@requires_auth
+def bulk():
+    tags = set()
+    for miner in Miner.query.all():
+        tags.update(tags_of(miner.remarks))
+    return render_template('bulk.html',
+                           version=__version__,
+                           actions=sorted(ACTIONS),
+                           models=model_catalog.all(),
+                           tags=sorted(tags),
+                           levels=[LEVEL_NAMES[level] for level in sorted(LEVEL_NAMES)],
+                           wave_size=config.BULK_WAVE_SIZE,
+                           wave_delay_secs=config.BULK_WAVE_DELAY_SECS,
+                           verify_timeout_secs=config.BULK_VERIFY_TIMEOUT_SECS,
+                           operations=[check_abandoned(operation) for operation in bulk_store.recent()])
+
+
+@app.route('/bulk', methods=['POST'])
+@requires_auth
+@requires_writable
+def start_bulk():
+    action = request.form.get('action')
+    if action not in ACTIONS:
+        flash("[ERROR] Unknown action '{}'".format(action), "error")
+        return redirect(url_for('bulk'))
+    try:
+        wave_size = int(request.form.get('wave_size', config.BULK_WAVE_SIZE))
+        wave_delay_secs = float(request.form.get('wave_delay_secs', config.BULK_WAVE_DELAY_SECS))
+        verify_timeout_secs = float(request.form.get('verify_timeout_secs', config.BULK_VERIFY_TIMEOUT_SECS))
+        max_failures = int(request.form.get('max_failures', 1))
+    except ValueError:
+        flash("[ERROR] Wave size, delays and failures must be numbers", "error")
+        return redirect(url_for('bulk'))
+
+    selection = dict((key, request.form.get(key) or None) for key in ('model', 'tag', 'level'))
+    miners = select_miners(**selection)
+    if miners is None:
+        flash("[ERROR] The miner status is not known yet, can't select by status", "error")
+        return redirect(url_for('bulk'))
+    if not miners:
+        flash("[ERROR] No miner matches the selection", "error")
+        return redirect(url_for('bulk'))
+
+    op_id = "{}-{}".format(time.strftime('%Y%m%d-%H%M%S'), binascii.hexlify(os.urandom(3)).decode('ascii'))
+    operation = BulkOperation(op_id, action, [(miner.id, miner.ip) for miner in miners], wave_size,
+                              wave_delay_secs, verify_timeout_secs, max_failures, bulk_store, selection)
+    bulk_store.save(operation.state)
+    operation.start()
+    logger.info("Bulk {} {} started on {} miner(s)".format(action, op_id, len(miners)))
+    return redirect(url_for('bulk_operation', op_id=op_id))
+
+
+def check_abandoned(operation, now=None):
+    """ Marks as abandoned an unfinished operation whose worker stopped
+    saving it, the thread running it died with the worker.
+    """
+    now = time.time() if now is None else now
+    heartbeat = operation.get('heartbeat', operation['created'])
+    if operation['state'] in ("pending", "running") and now - heartbeat > config.BULK_ABANDONED_SECS:
+        operation['state'] = "abandoned"
+    return operation
+
+
+def load_operation_or_404(op_id):
+    operation = bulk_store.load(op_id) if OPERATION_ID_RE.match(op_id) else None
+    if operation is None:
+        abort(404)
+    return check_abandoned(operation)
+
+
+@app.route('/bulk/<op_id>')
+@requires_auth
+def bulk_operation(op_id):
+    operation = load_operation_or_404(op_id)
+    counts = {}
+    for miner in operation['miners']:
+        counts[miner['state']] = counts.get(miner['state'], 0) + 1
+    return render_template('bulk_operation.html',
+                           version=__version__,
+                           now=time.time(),
+                           operation=operation,
+                           counts=counts,
+                           running=operation['state'] in ("pending", "running"))
+
+
+@app.route('/api/bulk/<op_id>')
+@requires_auth
+def api_bulk_operation(op_id):
+    return jsonify(load_operation_or_404(op_id))
+
+
+@app.route('/bulk/<op_id>/cancel', methods=['POST'])
+@requires_auth
+@requires_writable
+def cancel_bulk_operation(op_id):
+    load_operation_or_404(op_id)
+    bulk_store.request_cancel(op_id)
+    flash("[INFO] Cancelling, the miners in progress are finished first", "info")
+    return redirect(url_for('bulk_operation', op_id=op_id))
@@ -0,0 +1,213 @@
+import threading
+from collections import namedtuple
+
+from sqlalchemy import func
+
+from app.models import ChainSnapshot, Miner
+from app.views.rules import hashes_per_sec
+
+CHAIN_PREFIX = 'chain_acs'
+CHAIN_RATE_PREFIX = 'chain_rate'
+
+
+def popcount(bits):
+    return bin(bits).count('1')
+
+
+def positions(bits):
+    """ Chip numbers of the bits set. """
+    chips = []
+    i = 0
+    while bits:
+        if bits & 1:
+            chips.append(i)
+        bits >>= 1
+        i += 1
+    return chips
+
+
+def to_hex(bits):
+    return format(bits, 'x')
+
+
+def from_hex(value):
+    return int(value, 16)
+
+
+class ChainBitmap(namedtuple('ChainBitmap', 'chain size ok bad inactive')):
+    """ Chips of one ASIC chain, as bitmaps (bit i is chip i) of the 'o',
+    'x' and '-' of its chain_acs string.
+    """
+    __slots__ = ()
+
+    @property
+    def ok_count(self):
+        return popcount(self.ok)
+
+    @property
+    def bad_count(self):
+        return popcount(self.bad)
+
+    @property
+    def inactive_count(self):
+        return popcount(self.inactive)
+
+
+def decode_chain(chain, acs):
+    """ e.g. decode_chain(6, ' ooxo oo-o') => ChainBitmap(6, 8, 0b10111011, 0b100, 0b1000000) """
+    ok = bad = inactive = 0
+    size = 0
+    for char in str(acs):
+        if char == 'o':
+            ok |= 1 << size
+        elif char == 'x':
+            bad |= 1 << size
+        elif char == '-':
+            inactive |= 1 << size
+        elif char.isspace():
+            continue
+        size += 1
+    return ChainBitmap(chain, size, ok, bad, inactive)
+
+
+def decode_chains(stats):
+    """ Bitmaps of all the chain_acs<N> entries of a Bitmain stats reply, by chain number. """
+    chains = []
+    for key, acs in stats.items():
+        if key.startswith(CHAIN_PREFIX):
+            try:
+                chain = int(key[len(CHAIN_PREFIX):])
+            except ValueError:
+                continue
+            chains.append(decode_chain(chain, acs))
+    return tuple(sorted(chains))
+
+
+def decode_chain_hashrates(stats, unit):
+    """ (chain, hashes/s) of the chain_rate<N> entries of a Bitmain stats
+    reply, given in the unit the API uses for the model.
+    """
+    rates = []
+    for key, rate in stats.items():
+        if key.startswith(CHAIN_RATE_PREFIX):
+            try:
+                rates.append((int(key[len(CHAIN_RATE_PREFIX):]), hashes_per_sec(float(rate), unit)))
+            except ValueError:
+                # Empty on the boards that are not plugged in
+                continue
+    return tuple(sorted(rates))
+
+
+class ChainHistory(object):
+    """ Keeps the last stored bitmaps of every (miner, chain) so a poll only
+    writes a ChainSnapshot for the chains that changed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (miner id, chain) -> (chip_count, bad, inactive)
+        self.latest = None
+
+    def invalidate(self):
+        with self.lock:
+            self.latest = None
+
+    def _load(self):
+        last = ChainSnapshot.query.with_entities(func.max(ChainSnapshot.id)) \
+            .group_by(ChainSnapshot.miner_id, ChainSnapshot.chain).subquery()
+        self.latest = dict(((row.miner_id, row.chain), (row.chip_count, from_hex(row.bad_bits),
+                                                        from_hex(row.inactive_bits)))
+                           for row in ChainSnapshot.query.filter(ChainSnapshot.id.in_(last)))
+
+    def changes(self, miner_id, chains, now):
+        """ ChainSnapshot rows to add for the chains that differ from what
+        is stored.
+        """
+        rows = []
+        with self.lock:
+            if self.latest is None:
+                self._load()
+            for chain in chains:
+                state = (chain.size, chain.bad, chain.inactive)
+                if self.latest.get((miner_id, chain.chain)) == state:
+                    continue
+                self.latest[(miner_id, chain.chain)] = state
+                rows.append(ChainSnapshot(miner_id=miner_id, chain=chain.chain, time=now, chip_count=chain.size,
+                                          bad_bits=to_hex(chain.bad), inactive_bits=to_hex(chain.inactive)))
+        return rows
+
+
+chain_history = ChainHistory()
+
+
+class ChainTrend(object):
+    """ What happened to one chain since a point in time. """
+
+    def __init__(self, miner_id, chain, chip_count, baseline_bad, bad, inactive):
+        self.miner_id = miner_id
+        self.chain = chain
+        self.chip_count = chip_count
+        self.baseline_bad = baseline_bad
+        self.bad = bad
+        self.inactive = inactive
+        # Snapshots that added bad or inactive chips
+        self.degradations = 0
+
+    @property
+    def new_bad(self):
+        return self.bad & ~self.baseline_bad
+
+    @property
+    def recovered(self):
+        return self.baseline_bad & ~self.bad
+
+    def to_dict(self, ip=None):
+        return {
+            "miner_id": self.miner_id,
+            "ip": ip,
+            "chain": self.chain,
+            "chip_count": self.chip_count,
+            "bad_chips": positions(self.bad),
+            "inactive_chips": positions(self.inactive),
+            "new_bad_chips": positions(self.new_bad),
+            "recovered_chips": positions(self.recovered),
+            "degradations": self.degradations,
+        }
+
+
+def chain_trends(since):
+    """ ChainTrend of every chain that changed after since (epoch seconds),
+    the chains trending toward failure first.
+
+    The baseline of a chain is its last snapshot before since, or its first
+    one after it for chains seen for the first time.
+    """
+    last_before = ChainSnapshot.query.with_entities(func.max(ChainSnapshot.id)) \
+        .filter(ChainSnapshot.time <= since) \
+        .group_by(ChainSnapshot.miner_id, ChainSnapshot.chain).subquery()
+    trends = {}
+    for row in ChainSnapshot.query.filter(ChainSnapshot.id.in_(last_before)):
+        bad, inactive = from_hex(row.bad_bits), from_hex(row.inactive_bits)
+        trends[(row.miner_id, row.chain)] = ChainTrend(row.miner_id, row.chain, row.chip_count, bad, bad, inactive)
+
+    changed = set()
+    for row in ChainSnapshot.query.filter(ChainSnapshot.time > since).order_by(ChainSnapshot.time):
+        key = (row.miner_id, row.chain)
+        bad, inactive = from_hex(row.bad_bits), from_hex(row.inactive_bits)
+        trend = trends.get(key)
+        if trend is None:
+            trends[key] = ChainTrend(row.miner_id, row.chain, row.chip_count, bad, bad, inactive)
+            continue
+        if (bad | inactive) & ~(trend.bad | trend.inactive):
+            trend.degradations += 1
+        trend.chip_count, trend.bad, trend.inactive = row.chip_count, bad, inactive
+        changed.add(key)
+
+    return sorted((trends[key] for key in changed),
+                  key=lambda trend: (-trend.degradations, -popcount(trend.new_bad), trend.miner_id, trend.chain))
+
+
+def chain_trends_as_dicts(since):
+    trends = chain_trends(since)
+    ips = dict(Miner.query.with_entities(Miner.id, Miner.ip).all())
+    return [trend.to_dict(ips.get(trend.miner_id)) for trend in trends]
@@ -0,0 +1,131 @@
+import threading
+import time
+
+import config
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    """ The host is not called, the message says why. """
+
+
+class Circuit(object):
+    """ What the breaker knows about one host. """
+    __slots__ = ('state', 'failures', 'trips', 'retry_at', 'last_success', 'last_error')
+
+    def __init__(self):
+        self.state = CLOSED
+        # Failures in a row
+        self.failures = 0
+        # Times it opened since the host last answered
+        self.trips = 0
+        # When the next call may go through (open), or when the probe is
+        # presumed lost (half open)
+        self.retry_at = 0
+        self.last_success = None
+        self.last_error = None
+
+
+class CircuitBreaker(object):
+    """ Per-host circuit breaker in front of the cgminer API.
+
+    After failure_threshold failures in a row the circuit of a host opens:
+    calls fail at once instead of waiting for the connect timeout. Once
+    open_secs have passed, a single call goes through as a probe (half
+    open) while the others keep failing fast. A probe that succeeds closes
+    the circuit, one that fails opens it again for twice as long, up to
+    max_open_secs. A probe that didn't report back within probe_secs is
+    presumed lost, the next call probes instead.
+    """
+
+    def __init__(self, failure_threshold=3, open_secs=10, max_open_secs=5 * 60, probe_secs=60):
+        self.failure_threshold = max(1, failure_threshold)
+        self.open_secs = open_secs
+        self.max_open_secs = max_open_secs
+        self.probe_secs = probe_secs
+        self.lock = threading.Lock()
+        # host -> Circuit
+        self.circuits = {}
+
+    def refusal(self, host, now=None):
+        """ None when a call to host may go through, otherwise why not. """
+        now = time.time() if now is None else now
+        with self.lock:
+            circuit = self.circuits.get(host)
+            if circuit is None or circuit.state == CLOSED:
+                return None
+            if now >= circuit.retry_at:
+                # This call is the probe, or replaces one that was lost.
+                circuit.state = HALF_OPEN
+                circuit.retry_at = now + self.probe_secs
+                return None
+            if circuit.state == HALF_OPEN:
+                return "Unreachable ({} failures in a row: {}), probing it".format(circuit.failures, circuit.last_error)
+            if circuit.last_success is None:
+                last_seen = "never answered"
+            else:
+                last_seen = "last answered {:.0f}s ago".format(now - circuit.last_success)
+            return "Unreachable ({} failures in a row, {}: {}), next try in {:.0f}s".format(
+                circuit.failures, last_seen, circuit.last_error, max(0, circuit.retry_at - now))
+
+    def success(self, host, now=None):
+        with self.lock:
+            circuit = self.circuits.get(host)
+            if circuit is None:
+                circuit = self.circuits[host] = Circuit()
+            circuit.state = CLOSED
+            circuit.failures = 0
+            circuit.trips = 0
+            circuit.last_success = time.time() if now is None else now
+
+    def failure(self, host, error, now=None):
+        now = time.time() if now is None else now
+        with self.lock:
+            circuit = self.circuits.get(host)
+            if circuit is None:
+                circuit = self.circuits[host] = Circuit()
+            circuit.failures += 1
+            circuit.last_error = error
+            if circuit.state == OPEN:
+                # A call that started before it opened
+                return
+            if circuit.state == HALF_OPEN or circuit.failures >= self.failure_threshold:
+                circuit.state = OPEN
+                circuit.trips += 1
+                circuit.retry_at = now + min(self.open_secs * 2 ** (circuit.trips - 1), self.max_open_secs)
+
+    def reset(self, host):
+        """ Closes the circuit of host: the next calls go through whatever
+        failed before, e.g. to wait for a miner that was just restarted.
+        """
+        with self.lock:
+            circuit = self.circuits.get(host)
+            if circuit is not None:
+                circuit.state = CLOSED
+                circuit.failures = 0
+                circuit.trips = 0
+
+    def retain(self, hosts):
+        """ Drops the hosts that are not monitored anymore. """
+        with self.lock:
+            for host in [host for host in self.circuits if host not in hosts]:
+                del self.circuits[host]
+
+    def to_dict(self):
+        """ host -> state of the circuits that are not closed. """
+        with self.lock:
+            return dict((host, {"state": circuit.state,
+                                "failures": circuit.failures,
+                                "retry_at": circuit.retry_at,
+                                "last_success": circuit.last_success,
+                                "last_error": circuit.last_error})
+                        for host, circuit in self.circuits.items() if circuit.state != CLOSED)
+
+
+breaker = CircuitBreaker(failure_threshold=config.CIRCUIT_FAILURE_THRESHOLD,
+                         open_secs=config.CIRCUIT_OPEN_SECS,
+                         max_open_secs=config.CIRCUIT_MAX_OPEN_SECS,
+                         probe_secs=config.CIRCUIT_PROBE_SECS)
@@ -0,0 +1,37 @@
+import time
+
+
+class SystemClock(object):
+    """ Real time, what the agent runs on. """
+
+    def time(self):
+        return time.time()
+
+    def wait(self, event, secs):
+        """ Waits secs or until event is set, returns whether it is set. """
+        event.wait(secs)
+        return event.is_set()
+
+
+class VirtualClock(object):
+    """ Simulated time: waiting returns at once and moves the clock forward,
+    so a loop written against a clock runs as fast as the CPU allows. Once
+    the clock reaches until, waiting sets the event, which stops the loop.
+    """
+
+    def __init__(self, start, until=None):
+        self.now = start
+        self.until = until
+
+    def time(self):
+        return self.now
+
+    def wait(self, event, secs):
+        if not event.is_set():
+            self.now += secs
+            if self.until is not None and self.now >= self.until:
+                event.set()
+        return event.is_set()
+
+
+system_clock = SystemClock()
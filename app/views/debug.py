@@ -0,0 +1,62 @@
+import time
+
+from flask import (abort, flash, jsonify, redirect, render_template, request,
+                   send_from_directory, url_for)
+
+from app import __version__, app
+from app.views.antminer import requires_auth
+from app.views.perf import BUCKETS_MS, PHASES, perf
+from app.views.profiler import ProfilerError, profiler
+
+
+@app.route('/debug/perf', methods=['GET', 'POST'])
+@requires_auth
+def debug_perf():
+    if request.method == 'POST':
+        perf.reset()
+        return redirect(url_for('debug_perf'))
+
+    snapshot = perf.snapshot()
+    if request.args.get('format') == 'json':
+        return jsonify(snapshot)
+    return render_template('perf.html',
+                           version=__version__,
+                           phases=PHASES,
+                           buckets_ms=BUCKETS_MS,
+                           snapshot=snapshot,
+                           since=time.strftime(
+                               "%d/%b %H:%M:%S", time.localtime(snapshot["since"])))
+
+
+@app.route('/debug/profile', methods=['GET', 'POST'])
+@requires_auth
+def debug_profile():
+    if request.method == 'POST':
+        if request.form.get('action') == 'stop':
+            profiler.stop()
+        else:
+            try:
+                amount = int(request.form['amount'])
+                if request.form.get('unit') == 'iterations':
+                    profiler.start(iterations=amount)
+                else:
+                    profiler.start(seconds=amount)
+                flash("[INFO] Profiler started", "info")
+            except (ProfilerError, KeyError, ValueError) as e:
+                flash("[ERROR] Could not start the profiler: {}".format(e), "error")
+        return redirect(url_for('debug_profile'))
+
+    if request.args.get('format') == 'json':
+        return jsonify({"running": profiler.is_running(), "last_result": profiler.last_result})
+    return render_template('profile.html',
+                           version=__version__,
+                           running=profiler.is_running(),
+                           result=profiler.last_result)
+
+
+@app.route('/debug/profile/<file_name>')
+@requires_auth
+def debug_profile_file(file_name):
+    if not (file_name.startswith('profile-') and file_name.endswith('.folded')):
+        return abort(404)
+    return send_from_directory(profiler.output_dir, file_name, as_attachment=True)
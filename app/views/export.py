@@ -0,0 +1,216 @@
+import csv
+import io
+import json
+import time
+import zlib
+from datetime import datetime
+
+from flask import Response, abort, request, stream_with_context
+
+import config
+from app import app, db
+from app.models import ChainSnapshot, Miner, MinerEvent
+from app.views.antminer import requires_auth
+from app.views.archive import ReplayMiner, read_polls
+from app.views.miner_adapter import parse_miner_status
+from app.views.model_catalog import model_catalog
+from app.views.rules import HASHRATE_UNITS, hashes_per_sec
+
+FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+json_encoder = json.JSONEncoder(sort_keys=True)
+
+EVENT_COLUMNS = ('time', 'ip', 'event_type', 'message')
+CHAIN_COLUMNS = ('time', 'ip', 'chain', 'chip_count', 'bad_bits', 'inactive_bits')
+HASHRATE_COLUMNS = ('time', 'ip', 'model', 'worker', 'hashrate_hs', 'max_temp', 'hw_error_rate_pct', 'uptime_secs')
+
+
+def parse_time(value):
+    """ Epoch seconds or 'YYYY-MM-DD[ HH:MM[:SS]]' (local time), None stays
+    None. Raises ValueError.
+    """
+    if value is None or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in (TIME_FORMAT, '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            pass
+    raise ValueError("invalid time: {}".format(value))
+
+
+def format_time(epoch):
+    return datetime.fromtimestamp(epoch).strftime(TIME_FORMAT)
+
+
+def _stream(query, batch_size):
+    """ Yields the rows of a Core query batch by batch, through a server-side
+    cursor where the driver has one (sqlite3 steps through the result as it
+    is fetched anyway), so only one batch is in memory at a time.
+    """
+    result = db.session.execute(query.execution_options(stream_results=True))
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        result.close()
+
+
+def event_batches(since=None, until=None, ips=None, batch_size=1000):
+    """ miner_event rows between since and until (epoch seconds), in the
+    order they were written. Rows of the id order are returned as they are
+    read: sorting months of events by time would need them all first.
+    """
+    query = db.select([MinerEvent.timestamp, Miner.ip, MinerEvent.event_type, MinerEvent.message]) \
+        .select_from(MinerEvent.__table__.join(Miner.__table__, MinerEvent.miner_id == Miner.id)) \
+        .order_by(MinerEvent.id)
+    if since is not None:
+        query = query.where(MinerEvent.timestamp >= datetime.fromtimestamp(since))
+    if until is not None:
+        query = query.where(MinerEvent.timestamp <= datetime.fromtimestamp(until))
+    if ips:
+        query = query.where(Miner.ip.in_(sorted(ips)))
+    for rows in _stream(query, batch_size):
+        yield [(timestamp.strftime(TIME_FORMAT), ip, event_type, message)
+               for timestamp, ip, event_type, message in rows]
+
+
+def chain_batches(since=None, until=None, ips=None, batch_size=1000):
+    """ chain_snapshot rows (chip bitmaps of every hash board when they
+    changed) between since and until, oldest first.
+    """
+    query = db.select([ChainSnapshot.time, Miner.ip, ChainSnapshot.chain, ChainSnapshot.chip_count,
+                       ChainSnapshot.bad_bits, ChainSnapshot.inactive_bits]) \
+        .select_from(ChainSnapshot.__table__.join(Miner.__table__, ChainSnapshot.miner_id == Miner.id)) \
+        .order_by(ChainSnapshot.time, ChainSnapshot.id)
+    if since is not None:
+        query = query.where(ChainSnapshot.time >= since)
+    if until is not None:
+        query = query.where(ChainSnapshot.time <= until)
+    if ips:
+        query = query.where(Miner.ip.in_(sorted(ips)))
+    for rows in _stream(query, batch_size):
+        yield [(format_time(row[0]),) + tuple(row[1:]) for row in rows]
+
+
+def hashrate_batches(since=None, until=None, ips=None, batch_size=1000):
+    """ Hashrate, temperature and errors of every miner instance at every
+    poll, parsed again from the response archive: the database only keeps
+    the current status. Nothing when RESPONSE_ARCHIVE_DIR is not set.
+    """
+    if not config.RESPONSE_ARCHIVE_DIR:
+        return
+    batch = []
+    for poll in read_polls(config.RESPONSE_ARCHIVE_DIR, since, until, ips):
+        model = model_catalog.find(poll.model)
+        if model is None:
+            continue
+        miner = ReplayMiner(poll.miner_id, poll.ip, model.id, poll.remarks, poll.count)
+        status = parse_miner_status(miner, model, poll.responses)
+        if status is None:
+            continue
+        for instance in status.miner_instance_list:
+            if instance.hashrate_unit in HASHRATE_UNITS:
+                hashrate = hashes_per_sec(instance.hashrate_value, instance.hashrate_unit)
+            else:
+                hashrate = None
+            batch.append((format_time(poll.time), instance.ip, instance.model, instance.worker, hashrate,
+                          max(instance.temps) if instance.temps else None, instance.hw_error_rate_pct,
+                          instance.uptime_secs))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# name -> (columns, batches)
+DATASETS = {
+    'events': (EVENT_COLUMNS, event_batches),
+    'chains': (CHAIN_COLUMNS, chain_batches),
+    'hashrate': (HASHRATE_COLUMNS, hashrate_batches),
+}
+
+
+def _csv_cell(value):
+    # The csv module of Python 2 writes bytes.
+    if str is bytes and isinstance(value, type(u'')):
+        return value.encode('utf-8')
+    return value
+
+
+def encode_csv(columns, batches):
+    yield ','.join(columns) + '\r\n'
+    for batch in batches:
+        buf = io.BytesIO() if str is bytes else io.StringIO()
+        writer = csv.writer(buf)
+        for row in batch:
+            writer.writerow([_csv_cell(value) for value in row])
+        yield buf.getvalue()
+
+
+def encode_jsonl(columns, batches):
+    for batch in batches:
+        yield ''.join(json_encoder.encode(dict(zip(columns, row))) + '\n' for row in batch)
+
+
+ENCODERS = {'csv': encode_csv, 'jsonl': encode_jsonl}
+
+
+def _bytes(chunk):
+    return chunk if isinstance(chunk, bytes) else chunk.encode('utf-8')
+
+
+def gzip_chunks(chunks, level=6):
+    """ Compresses a stream of chunks into one gzip member as it goes. """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(_bytes(chunk))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(dataset, fmt='csv', gzip=False, since=None, until=None, ips=None,
+                  batch_size=config.EXPORT_BATCH_SIZE):
+    """ Yields the dataset encoded as fmt, as bytes. Raises KeyError for an
+    unknown dataset or format.
+    """
+    columns, batches = DATASETS[dataset]
+    chunks = ENCODERS[fmt](columns, batches(since, until, ips, batch_size))
+    if gzip:
+        return gzip_chunks(chunks)
+    return (_bytes(chunk) for chunk in chunks)
+
+
+@app.route('/export/<dataset>')
+@requires_auth
+def export(dataset):
+    """ Streams a dataset (events, chains or hashrate) as CSV or JSON Lines.
+
+    Query arguments: format (csv or jsonl), gzip=1, since and until (epoch
+    seconds or 'YYYY-MM-DD[ HH:MM[:SS]]'), ip (repeatable).
+    """
+    fmt = request.args.get('format', 'csv')
+    if dataset not in DATASETS or fmt not in FORMATS:
+        abort(404)
+    try:
+        since = parse_time(request.args.get('since'))
+        until = parse_time(request.args.get('until'))
+    except ValueError:
+        abort(400)
+    gzip = request.args.get('gzip') == '1'
+    filename = '{}-{}.{}'.format(dataset, datetime.now().strftime('%Y%m%d-%H%M%S'), fmt)
+    if gzip:
+        filename += '.gz'
+    chunks = export_chunks(dataset, fmt, gzip, since, until, set(request.args.getlist('ip')))
+    return Response(stream_with_context(chunks),
+                    mimetype='application/gzip' if gzip else FORMATS[fmt],
+                    headers={'Content-Disposition': 'attachment; filename="{}"'.format(filename)})
@@ -0,0 +1,167 @@
+import time
+
+from flask import Response, abort, jsonify, render_template, request
+
+import config
+from app import __version__, app
+from app.models import Miner
+from app.views.antminer import requires_auth, snapshot_reader
+from app.views.chains import chain_trends_as_dicts
+from app.views.latency import HTTP, KINDS, RPC
+from app.views.leader import read_agent_status
+from app.views.model_catalog import model_catalog
+from app.views.rules import HASHRATE_UNITS, hashes_per_sec
+from app.views.snapshot import LEVEL_DOWN, LEVEL_NAMES
+
+
+def read_snapshot_or_503():
+    snapshot = snapshot_reader.read()
+    if snapshot is None:
+        # Nothing published yet, the agent did not complete a sweep.
+        abort(503)
+    return snapshot
+
+
+@app.route('/api')
+@requires_auth
+def api():
+    published, records = read_snapshot_or_503()
+    miners = []
+    for record in records:
+        miner = record._asdict()
+        miner['level'] = LEVEL_NAMES[record.level]
+        miners.append(miner)
+    return jsonify({"published": published, "miners": miners})
+
+
+@app.route('/api/aggregates')
+@requires_auth
+def api_aggregates():
+    """ Fleet totals by model, coin, pool user, remarks tag and site. """
+    agent_status = read_agent_status(config.AGENT_STATUS_FILE)
+    if agent_status is None or not agent_status.get('aggregates'):
+        abort(503)
+    return jsonify(agent_status['aggregates'])
+
+
+@app.route('/api/chains')
+@requires_auth
+def api_chains():
+    """ ASIC chains whose chips changed in the last ?hours= (default a week),
+    the ones trending toward failure first.
+    """
+    hours = request.args.get('hours', 7 * 24, type=float)
+    return jsonify({"chains": chain_trends_as_dicts(time.time() - hours * 3600)})
+
+
+METRICS = (
+    ('antminer_up', "Whether the miner answered the last poll.",
+     lambda record: 0 if record.level == LEVEL_DOWN else 1),
+    ('antminer_hashrate_hashes_per_second', "Hashrate (5s).",
+     lambda record: hashes_per_sec(record.hashrate_value, record.hashrate_unit)
+     if record.hashrate_unit in HASHRATE_UNITS else None),
+    ('antminer_temperature_max_celsius', "Highest chip temperature.",
+     lambda record: max(record.temps) if record.temps else None),
+    ('antminer_fan_percent', "Fan speed in percent.",
+     lambda record: record.fan_pct),
+    ('antminer_chips_working', "Working ('o') chips.",
+     lambda record: record.working_chip_count),
+    ('antminer_chips_defective', "Defective ('x') chips.",
+     lambda record: record.defective_chip_count),
+    ('antminer_chips_inactive', "Inactive ('-') chips.",
+     lambda record: record.inactive_chip_count),
+    ('antminer_chips_expected', "Chips according to the model.",
+     lambda record: record.expected_chip_count),
+    ('antminer_hw_error_rate_percent', "Hardware error rate.",
+     lambda record: record.hw_error_rate_pct),
+    ('antminer_uptime_seconds', "Time since cgminer started.",
+     lambda record: record.uptime_secs),
+    ('antminer_status_level', "0 ok, 1 warning, 2 error, 3 down.",
+     lambda record: record.level),
+)
+
+
+def _escape(value):
+    return (value or u"").replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+@app.route('/metrics')
+@requires_auth
+def metrics():
+    """ Prometheus text exposition of the latest snapshot. """
+    published, records = read_snapshot_or_503()
+    labels = [u'ip="{}",instance_index="{}",model="{}",worker="{}"'.format(
+        _escape(record.ip), record.instance, _escape(record.model), _escape(record.worker))
+        for record in records]
+    lines = [
+        "# HELP antminer_snapshot_age_seconds Time since the agent published the snapshot.",
+        "# TYPE antminer_snapshot_age_seconds gauge",
+        "antminer_snapshot_age_seconds {}".format(time.time() - published),
+    ]
+    for name, description, value_of in METRICS:
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} gauge".format(name))
+        for record, record_labels in zip(records, labels):
+            value = value_of(record)
+            if value is not None:
+                lines.append(u"{}{{{}}} {}".format(name, record_labels, float(value)))
+
+    latency = read_latency()
+    for name, description, key in LATENCY_METRICS:
+        lines.append("# HELP {} {}".format(name, description))
+        lines.append("# TYPE {} gauge".format(name))
+        for ip in sorted(latency):
+            for kind, stats in sorted(latency[ip].items()):
+                if key in stats:
+                    lines.append(u'{}{{ip="{}",kind="{}"}} {}'.format(name, _escape(ip), kind, stats[key] / 1000.0))
+    return Response(u"\n".join(lines) + u"\n", mimetype='text/plain; version=0.0.4')
+
+
+LATENCY_METRICS = (
+    ('antminer_round_trip_p99_seconds', "99th percentile of the last round trips to the miner.", 'p99_ms'),
+    ('antminer_timeout_seconds', "Current timeout of the requests to the miner.", 'timeout_ms'),
+)
+
+
+def read_latency():
+    """ ip -> kind -> round-trip stats, as published by the agent. """
+    agent_status = read_agent_status(config.AGENT_STATUS_FILE)
+    return (agent_status or {}).get('latency') or {}
+
+
+@app.route('/api/latency')
+@requires_auth
+def api_latency():
+    return jsonify(read_latency())
+
+
+@app.route('/network')
+@requires_auth
+def network():
+    """ Round trips and timeouts of every miner, the slowest first. A miner
+    whose round trips come close to the largest timeout is shown before it
+    starts dropping out, one the agent stopped calling (open circuit) as an
+    error.
+    """
+    latency = read_latency()
+    agent_status = read_agent_status(config.AGENT_STATUS_FILE) or {}
+    circuits = agent_status.get('circuits') or {}
+    ceilings = {RPC: config.RPC_TIMEOUT_MAX_SECS * 1000, HTTP: config.HTTP_TIMEOUT_MAX_SECS * 1000}
+    rows = []
+    for miner in Miner.query.all():
+        stats = latency.get(miner.ip, {})
+        circuit = circuits.get(miner.ip)
+        level = 'ok' if circuit is None else 'error'
+        for kind, kind_stats in stats.items():
+            if kind_stats['timeouts_in_a_row']:
+                level = 'error'
+            elif level == 'ok' and kind_stats.get('p99_ms', 0) * config.TIMEOUT_FACTOR >= ceilings[kind]:
+                level = 'warning'
+        rows.append(dict(ip=miner.ip, model=model_catalog.get(miner.model_id).model, stats=stats, circuit=circuit,
+                         level=level))
+    rows.sort(key=lambda row: (row['circuit'] is None, -row['stats'].get(RPC, {}).get('p99_ms', 0)))
+    return render_template('network.html',
+                           version=__version__,
+                           now=time.time(),
+                           kinds=KINDS,
+                           rows=rows)
@@ -0,0 +1,188 @@
+import hmac
+import json
+import os
+import re
+import threading
+import time
+import zlib
+
+from flask import abort, jsonify, render_template, request
+
+import config
+from app import __version__, app, logger
+from app.views.antminer import requires_auth
+from app.views.aggregates import DIMENSION_TITLES, DIMENSIONS, AggregatesView
+
+SITE_NAME_RE = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+# Decompressed size of one batch, so a bad collector can't exhaust memory.
+MAX_BATCH_BYTES = 64 * 1024 * 1024
+MAX_EVENTS_PER_SITE = 500
+# Fields an item of each type must have, items of other types are skipped.
+ITEM_FIELDS = {
+    'snapshot': ('published', 'interval_secs', 'records'),
+    'events': ('events',),
+}
+
+
+class SiteStore(object):
+    """ Latest snapshot and recent events of every collector site, one JSON
+    file per site.
+
+    Each ingested item carries an increasing id, items at or below the last
+    one stored are skipped so a batch retried by the collector is not
+    applied twice.
+    """
+
+    def __init__(self, directory, max_events=MAX_EVENTS_PER_SITE):
+        self.directory = directory
+        self.max_events = max_events
+        self.lock = threading.Lock()
+
+    def _path(self, site):
+        return os.path.join(self.directory, site + '.json')
+
+    def load(self, site):
+        try:
+            with open(self._path(site)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save(self, state):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self._path(state['site'])
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp_path, path)
+
+    def ingest(self, site, items, now):
+        """ Applies a batch, returns the number of items that were new. """
+        with self.lock:
+            state = self.load(site) or {
+                "site": site,
+                "last_item_id": "",
+                "published": None,
+                "interval_secs": None,
+                "records": [],
+                "events": [],
+            }
+            accepted = 0
+            for item in sorted(items, key=lambda item: item['id']):
+                if item['id'] <= state['last_item_id']:
+                    continue
+                if item.get('type') == 'snapshot':
+                    state['published'] = item['published']
+                    state['interval_secs'] = item['interval_secs']
+                    state['records'] = item['records']
+                    state['aggregates'] = item.get('aggregates')
+                elif item.get('type') == 'events':
+                    state['events'] = (state['events'] + item['events'])[-self.max_events:]
+                state['last_item_id'] = item['id']
+                accepted += 1
+            state['received'] = now
+            self._save(state)
+            return accepted
+
+    def sites(self):
+        if not os.path.isdir(self.directory):
+            return []
+        names = sorted(name[:-len('.json')] for name in os.listdir(self.directory) if name.endswith('.json'))
+        return [state for state in (self.load(name) for name in names) if state is not None]
+
+
+site_store = SiteStore(config.SITES_DIR)
+
+
+def valid_item(item):
+    if not isinstance(item, dict) or not isinstance(item.get('id'), type(u'')):
+        return False
+    return all(field in item for field in ITEM_FIELDS.get(item.get('type'), ()))
+
+
+def read_batch():
+    """ The batch of the request. Aborts with 413 when it is larger than
+    MAX_BATCH_BYTES (compressed or not), 400 when it is not a valid batch.
+    """
+    if request.content_length is not None and request.content_length > MAX_BATCH_BYTES:
+        abort(413)
+    # A body without a length is bounded too.
+    data = request.stream.read(MAX_BATCH_BYTES + 1)
+    if len(data) > MAX_BATCH_BYTES:
+        abort(413)
+    if request.headers.get('Content-Encoding') == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            data = decompressor.decompress(data, MAX_BATCH_BYTES)
+        except zlib.error:
+            abort(400)
+        if decompressor.unconsumed_tail:
+            abort(413)
+    try:
+        batch = json.loads(data.decode('utf-8'))
+    except ValueError:
+        abort(400)
+    if not isinstance(batch, dict) or not isinstance(batch.get('site'), type(u'')) or \
+            not SITE_NAME_RE.match(batch['site']) or not isinstance(batch.get('items'), list) or \
+            not all(valid_item(item) for item in batch['items']):
+        abort(400)
+    return batch
+
+
+@app.route('/ingest', methods=['POST'])
+def ingest():
+    """ Receives the batches pushed by the collectors (COLLECTOR_UPLINK_URL). """
+    # Disabled unless a token is configured.
+    if not config.INGEST_TOKEN:
+        abort(404)
+    authorization = request.headers.get('Authorization') or ''
+    if not hmac.compare_digest(authorization.encode('utf-8'),
+                               "Bearer {}".format(config.INGEST_TOKEN).encode('utf-8')):
+        abort(403)
+    batch = read_batch()
+    accepted = site_store.ingest(batch['site'], batch['items'], time.time())
+    logger.debug("Ingested {}/{} item(s) from site {}".format(accepted, len(batch['items']), batch['site']))
+    return jsonify({"accepted": accepted})
+
+
+@app.route('/fleet')
+@requires_auth
+def fleet():
+    """ All the collector sites in one view. """
+    now = time.time()
+    sites = []
+    records = []
+    events = []
+    aggregates = AggregatesView()
+    for state in site_store.sites():
+        counts = {"ok": 0, "warning": 0, "error": 0, "down": 0}
+        for record in state['records']:
+            record['site'] = state['site']
+            counts[record['level']] += 1
+            records.append(record)
+        if state.get('aggregates'):
+            aggregates.merge(state['aggregates'])
+        for event in state['events']:
+            event['site'] = state['site']
+            events.append(event)
+        # A site is stale when it missed two sweeps.
+        interval_secs = state['interval_secs'] or config.AGENT_INTERVAL_SECS
+        sites.append({
+            "name": state['site'],
+            "published": state['published'],
+            "received": state['received'],
+            "stale": state['published'] is None or now - state['published'] >= 2 * interval_secs + 10,
+            "counts": counts,
+        })
+
+    return render_template('fleet.html',
+                           version=__version__,
+                           now=now,
+                           sites=sites,
+                           records=records,
+                           events=sorted(events, key=lambda event: event['time'], reverse=True)[:100],
+                           aggregates=aggregates,
+                           dimensions=DIMENSIONS,
+                           dimension_titles=DIMENSION_TITLES,
+                           total_hash_rate_per_model=aggregates.total_hash_rate_per_model())
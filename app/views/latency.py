@@ -0,0 +1,136 @@
+import threading
+from collections import deque
+
+import config
+
+RPC = 'rpc'
+HTTP = 'http'
+KINDS = (RPC, HTTP)
+# A reply timeout grows this many times at most after timeouts in a row.
+MAX_BACKOFF = 4
+
+
+class TimeoutBounds(object):
+    """ Timeout of a kind of request: the fixed one used until a miner has
+    enough round trips, and the range the adaptive one stays in.
+    """
+
+    def __init__(self, default_secs, min_secs, max_secs):
+        self.default_secs = default_secs
+        self.min_secs = min_secs
+        self.max_secs = max_secs
+
+
+class HostLatency(object):
+    """ The last round trips to one host for one kind of request. """
+    __slots__ = ('samples', 'timeouts_in_a_row', 'timeouts')
+
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.timeouts_in_a_row = 0
+        self.timeouts = 0
+
+    def percentile(self, pct):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+class LatencyTracker(object):
+    """ Round-trip times of the miners, and the timeouts derived from them.
+
+    The timeout of a host is factor times the percentile of its last window
+    round trips, within the bounds of the kind. Until it has min_samples of
+    them, it can only grow above the default. The timeout of the reply
+    doubles for every reply that timed out in a row, up to MAX_BACKOFF
+    times: a miner that slowed down gets more time on the next try. The
+    connect timeout never grows, so a dead miner keeps failing after the
+    learned timeout.
+    """
+
+    def __init__(self, bounds, percentile=99, factor=3.0, window=100, min_samples=10):
+        self.bounds = bounds
+        self.pct = percentile
+        self.factor = factor
+        self.window = window
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        # (host, kind) -> HostLatency
+        self.hosts = {}
+
+    def _get(self, host, kind):
+        latency = self.hosts.get((host, kind))
+        if latency is None:
+            latency = self.hosts[(host, kind)] = HostLatency(self.window)
+        return latency
+
+    def _timeout(self, latency, kind, backoff=True):
+        bounds = self.bounds[kind]
+        if latency is None or not latency.samples:
+            timeout = bounds.default_secs
+        elif len(latency.samples) < self.min_samples:
+            # Too few round trips to go below the default, enough to know
+            # that a slow miner needs more.
+            timeout = max(bounds.default_secs, max(latency.samples) * self.factor)
+        else:
+            timeout = max(bounds.min_secs, latency.percentile(self.pct) * self.factor)
+        if latency is not None and backoff:
+            timeout *= min(2 ** latency.timeouts_in_a_row, MAX_BACKOFF)
+        return min(timeout, max(bounds.max_secs, bounds.default_secs))
+
+    def timeout(self, host, kind, connect=False):
+        """ Seconds to wait for host before giving up, to connect or to
+        reply.
+        """
+        with self.lock:
+            return self._timeout(self.hosts.get((host, kind)), kind, backoff=not connect)
+
+    def record(self, host, kind, seconds):
+        with self.lock:
+            latency = self._get(host, kind)
+            latency.samples.append(seconds)
+            latency.timeouts_in_a_row = 0
+
+    def record_timeout(self, host, kind, connect=False):
+        """ A request that timed out. Only slow replies make the next try
+        wait longer, a host that doesn't accept the connection is down.
+        """
+        with self.lock:
+            latency = self._get(host, kind)
+            if not connect:
+                latency.timeouts_in_a_row += 1
+            latency.timeouts += 1
+
+    def retain(self, hosts):
+        """ Drops the hosts that are not monitored anymore. """
+        with self.lock:
+            for key in [key for key in self.hosts if key[0] not in hosts]:
+                del self.hosts[key]
+
+    def to_dict(self):
+        """ host -> kind -> stats, in milliseconds. """
+        stats = {}
+        with self.lock:
+            for (host, kind), latency in self.hosts.items():
+                entry = {
+                    "samples": len(latency.samples),
+                    "timeout_ms": round(self._timeout(latency, kind) * 1000, 1),
+                    "timeouts": latency.timeouts,
+                    "timeouts_in_a_row": latency.timeouts_in_a_row,
+                }
+                if latency.samples:
+                    entry.update(p50_ms=round(latency.percentile(50) * 1000, 1),
+                                 p99_ms=round(latency.percentile(99) * 1000, 1),
+                                 max_ms=round(max(latency.samples) * 1000, 1))
+                stats.setdefault(host, {})[kind] = entry
+        return stats
+
+
+latency = LatencyTracker(
+    {
+        RPC: TimeoutBounds(config.RPC_TIMEOUT_SECS, config.RPC_TIMEOUT_MIN_SECS, config.RPC_TIMEOUT_MAX_SECS),
+        HTTP: TimeoutBounds(config.HTTP_TIMEOUT_SECS, config.HTTP_TIMEOUT_MIN_SECS, config.HTTP_TIMEOUT_MAX_SECS),
+    },
+    percentile=config.TIMEOUT_PERCENTILE,
+    factor=config.TIMEOUT_FACTOR,
+    window=config.LATENCY_WINDOW,
+    min_samples=config.LATENCY_MIN_SAMPLES)
@@ -0,0 +1,71 @@
+import json
+import os
+import time
+
+from app import logger
+
+try:
+    import fcntl
+except ImportError:
+    # Windows. The development server is a single process anyway.
+    fcntl = None
+
+
+class LeaderLock(object):
+    """ Elects the one process that runs the agent, using an exclusive lock on
+    a file.
+
+    The kernel drops the lock as soon as its owner dies, so a follower calling
+    try_acquire() once per agent iteration takes over within one interval.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_file = None
+
+    def is_leader(self):
+        return self.lock_file is not None
+
+    def try_acquire(self):
+        if self.lock_file is not None:
+            return True
+        if fcntl is None:
+            self.lock_file = True
+            return True
+        lock_file = open(self.path, 'a+')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(str(os.getpid()))
+        lock_file.flush()
+        self.lock_file = lock_file
+        logger.info("Process {} is now running the agent".format(os.getpid()))
+        return True
+
+    def release(self):
+        if self.lock_file not in (None, True):
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+            self.lock_file.close()
+        self.lock_file = None
+
+
+def publish_agent_status(path, **status):
+    """ Atomically replaces the status file read by the other workers. """
+    status['pid'] = os.getpid()
+    status['heartbeat'] = time.time()
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f)
+    os.rename(tmp_path, path)
+
+
+def read_agent_status(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
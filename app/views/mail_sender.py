@@ -5,27 +5,86 @@ from app import logger
 import config
 
 
-def send_email(gmail_user, gmail_pwd, to_email, subject, body_html, body_plain):
-    from_email = gmail_user
-    subject = subject
+def build_message(from_email, to_email, subject, body_html, body_plain):
     msg = MIMEMultipart('alternative')
     msg['Subject'] = subject
     msg['From'] = from_email
     msg['To'] = to_email
     msg.attach(MIMEText(body_plain, 'plain'))
     msg.attach(MIMEText(body_html, 'html'))
+    return msg
+
+
+class SmtpSink(object):
+    """ Notification sink that keeps one authenticated SMTP session open and
+    reuses it for every message, reconnecting only when the server dropped it.
+    """
+    name = 'smtp'
+
+    def __init__(self, host, port, user, password, to_email, starttls=True, timeout=30):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.to_email = to_email
+        self.starttls = starttls
+        self.timeout = timeout
+        self.server = None
+
+    def _connect(self):
+        logger.debug("Opening SMTP session to {}:{}".format(self.host, self.port))
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        server.ehlo()
+        if self.starttls:
+            server.starttls()
+            server.ehlo()
+        if self.user:
+            server.login(self.user, self.password)
+        self.server = server
 
+    def _is_connected(self):
+        if self.server is None:
+            return False
+        try:
+            return self.server.noop()[0] == 250
+        except smtplib.SMTPException:
+            return False
+        except IOError:
+            return False
+
+    def send(self, subject, body_html, body_plain):
+        if not self._is_connected():
+            self.close()
+            self._connect()
+        from_email = self.user or "antminer-monitor@localhost"
+        msg = build_message(from_email, self.to_email, subject, body_html, body_plain)
+        try:
+            self.server.sendmail(from_email, self.to_email, msg.as_string())
+        except Exception:
+            # Start from a fresh session on the next attempt.
+            self.close()
+            raise
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+
+def send_email(gmail_user, gmail_pwd, to_email, subject, body_html, body_plain):
     # Send actual message
+    sink = SmtpSink(config.SMTP_HOST, config.SMTP_PORT, gmail_user, gmail_pwd, to_email,
+                    starttls=config.SMTP_STARTTLS)
     try:
         logger.debug("Sending email...")
-        server = smtplib.SMTP("smtp.gmail.com", 587)
-        server.ehlo()
-        server.starttls()
-        server.login(gmail_user, gmail_pwd)
-        server.sendmail(from_email, to_email, msg.as_string())
-        server.close()
+        sink.send(subject, body_html, body_plain)
         logger.debug ("Successfully sent the mail")
         return True
     except Exception as e:
         logger.error ("Failed to send mail " + str(e))
         return False
+    finally:
+        sink.close()
@@ -1,19 +1,61 @@
 import re
+from collections import namedtuple
 from datetime import timedelta
 from enum import Enum
 from urlparse import urlparse
 
+import config
 from app import logger
-from app.models import MinerModel
 from app.pycgminer.pycgminer import CgminerAPI
 from app.views.antminer_json import get_pools, get_stats, get_summary
+from app.views.chains import decode_chain_hashrates, decode_chains
+from app.views.model_catalog import model_catalog
+from app.views.perf import perf
+from app.views.rules import make_finding, rule_engine
+
+LEVEL_SEVERITY = {'debug': 0, 'warning': 1, 'error': 2}
 
 class MinersStatus(object):
     def __init__(self):
         self.miner_instance_list = []
-        self.debugs = set()
-        self.warnings = set()
-        self.errors = set()
+        self.findings = []
+        # ChainBitmap of every ASIC chain, for the models that report them
+        self.chains = ()
+        # (chain, hashes/s) of every hash board, for the models that report them
+        self.chain_hashrates = ()
+        # Why the miner wasn't called, when the status is parsed from its
+        # last replies
+        self.stale = None
+
+    def add_finding(self, finding):
+        self.findings.append(finding)
+
+    def _messages(self, level):
+        # Findings are only turned into text when somebody looks at them.
+        return set(finding.message() for finding in self.findings if finding.level == level)
+
+    @property
+    def debugs(self):
+        return self._messages('debug')
+
+    @property
+    def warnings(self):
+        return self._messages('warning')
+
+    @property
+    def errors(self):
+        return self._messages('error')
+
+    @property
+    def checks(self):
+        """ check -> (level, finding), keeping the most severe finding when
+        several instances (e.g. Avalon modules) fail the same check.
+        """
+        checks = {}
+        for finding in self.findings:
+            if finding.check not in checks or LEVEL_SEVERITY[finding.level] > LEVEL_SEVERITY[checks[finding.check][0]]:
+                checks[finding.check] = (finding.level, finding)
+        return checks
 
     def add_miner_instance(self,
                            worker,
@@ -30,53 +72,32 @@ class MinersStatus(object):
                            uptime_secs,
                            miner):
 
-        # Some error checking that applies to all miner types.
-        if defective_chip_count > 0:
-            self.errors.add("[WARNING] '{}' chips are defective on miner '{}'.".format(
-                defective_chip_count, miner.ip))
-        if temps and max(temps) >= miner.model.high_temp:
-            error_message = "[WARNING] High temperatures on miner '{}'.".format(
-                miner.ip)
-            self.warnings.add(error_message)
-
-        # Target hashrate will be 80% of the model advertised hashrate. Most of the times
-        # the hashrate will be higher, so 80% should just be hit if the device
-        # is either starting or malfunctioning.
-        # TODO: This potentially have a bug because I am not converting the hash units.
-        target_hashrate = int(miner.model.hashrate_value * 0.8)
-        low_hashrate = hashrate_value < target_hashrate
-        if low_hashrate:
-            self.errors.add("[ERROR] Hashrate {:3.2f}{} is much smaller than the target {:3.2f}{} on {}".format(hashrate_value, hashrate_unit, target_hashrate, miner.model.hashrate_unit, miner.ip))
-        # Give some slack. As long as the hashrate is fine don't worry
-        if working_chip_count + defective_chip_count < expected_chip_count:
-            if low_hashrate:
-                error_message = "[ERROR] ASIC chips are missing from miner '{}'. Your Antminer '{}' has '{}/{} chips'." \
-                    .format(miner.ip,
-                            miner.model.model,
-                            working_chip_count + defective_chip_count,
-                            expected_chip_count)
-                self.errors.add(error_message)
-            else:
-                error_message = "[WARNING] ASIC chips are missing from miner '{}'. Your Antminer '{}' has '{}/{} chips'." \
-                    .format(miner.ip,
-                            miner.model.model,
-                            working_chip_count + defective_chip_count,
-                            expected_chip_count)
-                self.debugs.add(error_message)
-
-        self.miner_instance_list.append(miner_instance(worker,
-                           working_chip_count,
-                           defective_chip_count,
-                           inactive_chip_count,
-                           expected_chip_count,
-                           hashrate_value,
-                           hashrate_unit,
-                           temps,
-                           fan_speeds,
-                           fan_pct,
-                           hw_error_rate_pct,
-                           uptime_secs,
-                           miner))
+        # Health rules that apply to all miner types. The engine only
+        # re-evaluates them when the inputs changed since the last poll.
+        inputs = (working_chip_count, defective_chip_count, expected_chip_count,
+                  hashrate_value, hashrate_unit, max(temps) if temps else None,
+                  uptime_secs < config.MINER_WARMUP_SECS)
+        self.findings.extend(rule_engine.evaluate(miner, len(self.miner_instance_list), inputs))
+
+        model = model_catalog.get(miner.model_id)
+        if fan_pct is None:
+            fan_pct = fan_pct_from_speeds(fan_speeds, model.max_fan_rpm)
+        self.miner_instance_list.append(MinerInstance(miner.id,
+                                                      miner.ip,
+                                                      model.model,
+                                                      miner.remarks,
+                                                      worker,
+                                                      working_chip_count,
+                                                      defective_chip_count,
+                                                      inactive_chip_count,
+                                                      expected_chip_count,
+                                                      hashrate_value,
+                                                      hashrate_unit,
+                                                      tuple(temps),
+                                                      tuple(fan_speeds),
+                                                      fan_pct,
+                                                      hw_error_rate_pct,
+                                                      uptime_secs))
 
 class ModelType(Enum):
     Avalon741 = "AV741"
@@ -114,7 +135,7 @@ def detect_model(ip):
             model_name = ModelType.AntRouterR1LTC.value
 
     if not model_name is None:
-        model = MinerModel.query.filter_by(model=model_name).first()
+        model = model_catalog.find(model_name)
         if not model is None:
             return model
     else:
@@ -123,61 +144,96 @@ def detect_model(ip):
     raise Exception("[ERROR] Miner type '{}' at ip address '{}' is not supported.".format(
         model_name, ip))
 
-def get_miner_status(miner):
-    # if miner not accessible
-    miner_stats = get_stats(miner.ip)
+def fetch_miner_responses(miner, model):
+    """ Sends the cgminer commands the parser of the model needs. Returns
+    command -> reply, only stats when the miner can't be reached.
+    """
+    responses = {'stats': get_stats(miner.ip)}
+    if responses['stats']['STATUS'][0]['STATUS'] == 'error':
+        return responses
+    responses['pools'] = get_pools(miner.ip)
+    if model.model == ModelType.GekkoScience.value or model.model == ModelType.AntRouterR1LTC.value:
+        responses['summary'] = get_summary(miner.ip)
+    if 'STALE' in responses['stats']:
+        # The last stats can't be parsed without the other last replies.
+        for reply in responses.values():
+            if reply['STATUS'][0]['STATUS'] == 'error':
+                return {'stats': reply}
+    return responses
+
+
+def parse_miner_status(miner, model, responses):
+    """ Runs the parser of the model over the replies of fetch_miner_responses.
+    Returns None when the miner wasn't reachable.
+    """
+    miner_stats = responses['stats']
     if miner_stats['STATUS'][0]['STATUS'] == 'error':
         return None
 
     status = MinersStatus()
+    with perf.timer('parse', miner.ip):
+        if model.model == ModelType.Avalon741.value or model.model == ModelType.Avalon821.value:
+            make_miner_instance_avalon7or8(status, miner, miner_stats, responses['pools'])
+        elif model.model == ModelType.GekkoScience.value:
+            make_miner_instance_gekkoscience(status, miner, miner_stats, responses['pools'], responses['summary'])
+        elif model.model == ModelType.AntRouterR1LTC.value:
+            make_miner_instance_r1_ltc(status, miner, miner_stats, responses['pools'], responses['summary'])
+        else:
+            make_miner_instance_bitmain(status, miner, miner_stats, responses['pools'])
 
-    if miner.model.model == ModelType.Avalon741.value or miner.model.model == ModelType.Avalon821.value:
-        make_miner_instance_avalon7or8(status, miner, miner_stats, get_pools(miner.ip))
-    elif miner.model.model == ModelType.GekkoScience.value:
-        make_miner_instance_gekkoscience(status, miner, miner_stats, get_pools(miner.ip), get_summary(miner.ip))
-    elif miner.model.model == ModelType.AntRouterR1LTC.value:
-        make_miner_instance_r1_ltc(status, miner, miner_stats, get_pools(miner.ip), get_summary(miner.ip))
-    else:
-        make_miner_instance_bitmain(status, miner, miner_stats, get_pools(miner.ip))
+    if 'STALE' in miner_stats:
+        # Its last replies, the miner itself didn't answer.
+        status.stale = miner_stats['STALE']
+        status.add_finding(make_finding('stale', 'error', miner.ip, check='cgminer_connect',
+                                        reason=status.stale))
 
     # Check if the count.
     if status.miner_instance_list and miner.count > len(status.miner_instance_list):
-         status.errors.add("Expected {} miners in ip {}. Found {}".format(miner.count, miner.ip, len(status.miner_instance_list)))
+         status.add_finding(make_finding('miner_count', 'error', miner.ip,
+                                         len(status.miner_instance_list), miner.count))
     return status
 
 
-class miner_instance(object):
-    def __init__(self, worker, working_chip_count, defective_chip_count, inactive_chip_count, expected_chip_count, hashrate_value, hashrate_unit, temps, fan_speeds, fan_pct, hw_error_rate_pct, uptime_secs, miner):
-        self.worker = worker
-        self.working_chip_count = working_chip_count
-        self.defective_chip_count = defective_chip_count
-        self.inactive_chip_count = inactive_chip_count
-        self.expected_chip_count = expected_chip_count
-        self.hashrate_value = hashrate_value
-        self.hashrate_unit = hashrate_unit
-        self.temps = temps
-        self.fan_speeds = fan_speeds
-        self.fan_pct = fan_pct
-        self.hw_error_rate_pct = hw_error_rate_pct
-        self.uptime = timedelta(seconds=uptime_secs)
-        self.miner = miner
+def get_miner_status(miner, archive=None):
+    """ Polls the miner. The replies are added to archive (a
+    ResponseArchive) when given.
+    """
+    model = model_catalog.get(miner.model_id)
+    # Everything is fetched first so that the parse timer only covers parsing.
+    responses = fetch_miner_responses(miner, model)
+    if archive is not None:
+        archive.record(miner, model.model, responses)
+    return parse_miner_status(miner, model, responses)
 
-    def fan_speed_pretty(self):
-        fan_pct = self.fan_pct
-        if fan_pct is None:
-            if self.fan_speeds:
-                fan_pct = (100.0 * max(self.fan_speeds)) / \
-                    self.miner.model.max_fan_rpm
-            else:
-                fan_pct = 0
 
-        return "{0} / {1:.0f}%".format(str(self.fan_speeds), fan_pct)
+class MinerInstance(namedtuple('MinerInstance', [
+        'miner_id', 'ip', 'model', 'remarks', 'worker',
+        'working_chip_count', 'defective_chip_count', 'inactive_chip_count', 'expected_chip_count',
+        'hashrate_value', 'hashrate_unit', 'temps', 'fan_speeds', 'fan_pct', 'hw_error_rate_pct',
+        'uptime_secs'])):
+    """ Status of one miner instance (a whole Antminer or one Avalon module).
+
+    Only plain values, nothing refers back to the DB session, so instances
+    can be shared between the agent and request threads, kept around and
+    serialized as they are. model is the model name (MinerModel.model).
+    """
+    __slots__ = ()
+
+    @property
+    def uptime(self):
+        return timedelta(seconds=self.uptime_secs)
+
+    def fan_speed_pretty(self):
+        return "{0} / {1:.0f}%".format(str(list(self.fan_speeds)), self.fan_pct)
 
     def hashrate_pretty(self):
         return "{:3.2f} {}".format(self.hashrate_value, self.hashrate_unit)
 
-    def __str__(self):
-        return "worker:{} working_chip_count:{} defective_chip_count:{} inactive_chip_count:{} expected_chip_count:{} hashrate_value:{} hashrate_unit:{} temps:{} fan_speeds:{} fan_pct:{} hw_error_rate_pct:{} uptime:{} debugs:{}, warnings:{} errors:{}".format(self.worker, self.working_chip_count, self.inactive_chip_count, self.defective_chip_count, self.expected_chip_count, self.hashrate_value, self.hashrate_unit, self.temps, self.fan_speeds, self.fan_pct, self.hw_error_rate_pct, self.uptime, self.debugs, self.warnings, self.errors)
+
+def fan_pct_from_speeds(fan_speeds, max_fan_rpm):
+    if fan_speeds and max_fan_rpm:
+        return (100.0 * max(fan_speeds)) / max_fan_rpm
+    return 0
 
 # Update from one unit to the next if the value is greater than 1024.
 # e.g. update_unit_and_value(1024, "GH/s") => (1, "TH/s")
@@ -197,36 +253,32 @@ def update_unit_and_value(value, unit):
     return (value, unit)
 
 def make_miner_instance_bitmain(status, miner, miner_stats, miner_pools):
+    model = model_catalog.get(miner.model_id)
     # Get worker name
     worker = miner_pools['POOLS'][0]['User']
-    # Get miner's ASIC chips
-    asic_chains = [miner_stats['STATS'][1][chain] for chain in miner_stats['STATS'][1].keys() if
-                   "chain_acs" in chain]
+    # Get miner's ASIC chips, one bitmap per chain
+    status.chains = decode_chains(miner_stats['STATS'][1])
+    status.chain_hashrates = decode_chain_hashrates(miner_stats['STATS'][1], model.hashrate_unit_in_api)
     # count number of working chips
-    O = [str(o).count('o') for o in asic_chains]
-    Os = sum(O)
+    Os = sum(chain.ok_count for chain in status.chains)
     # count number of defective chips
-    X = [str(x).count('x') for x in asic_chains]
-    Xs = sum(X)
+    Xs = sum(chain.bad_count for chain in status.chains)
     # get number of in-active chips
-    _dash_chips = [str(x).count('-') for x in asic_chains]
-    _dash_chips = sum(_dash_chips)
+    _dash_chips = sum(chain.inactive_count for chain in status.chains)
     # Get total number of chips according to miner's model
-    # convert miner.model.chips to int list and sum
-    chips_list = [int(y) for y in str(miner.model.chips).split(',')]
-    total_chips = sum(chips_list)
+    total_chips = model.expected_chip_count
 
     # Get the temperatures of the miner according to miner's model
     temps = [int(miner_stats['STATS'][1][temp]) for temp in
              sorted(miner_stats['STATS'][1].keys(), key=lambda x: str(x)) if
-             re.search(miner.model.temp_keys + '[0-9]', temp) if miner_stats['STATS'][1][temp] != 0]
+             model.temp_re.search(temp) if miner_stats['STATS'][1][temp] != 0]
     # Get fan speeds
     fan_speeds = [miner_stats['STATS'][1][fan] for fan in
                   sorted(miner_stats['STATS'][1].keys(), key=lambda x: str(x)) if
                   re.search("fan" + '[0-9]', fan) if miner_stats['STATS'][1][fan] != 0]
     # Get GH/S 5s
     hashrate_value = float(str(miner_stats['STATS'][1]['GHS 5s']))
-    hashrate_unit = miner.model.hashrate_unit_in_api
+    hashrate_unit = model.hashrate_unit_in_api
     hashrate_value, hashrate_unit = update_unit_and_value(
         hashrate_value, hashrate_unit)
 
@@ -251,10 +303,11 @@ def make_miner_instance_bitmain(status, miner, miner_stats, miner_pools):
 
 
 def make_miner_instance_avalon7or8(status, miner, miner_stats, miner_pools):
+    model = model_catalog.get(miner.model_id)
     # Get worker name
     worker = miner_pools['POOLS'][0]['User']
 
-    expected_asic = int(miner.model.chips)
+    expected_asic = model.expected_chip_count
 
     r = re.compile("MM ID(\d*)")
     for i in miner_stats["STATS"]:
@@ -294,7 +347,7 @@ def make_miner_instance_avalon7or8(status, miner, miner_stats, miner_pools):
                     # was deprecated. So lets not look at it a all.
 
                 hashrate_value, hashrate_unit = update_unit_and_value(
-                    hashrate_value, miner.model.hashrate_unit_in_api)
+                    hashrate_value, model.hashrate_unit_in_api)
 
                 # Read asic info. The following two fields will contain
                 # information about how the board is operating and the
@@ -402,7 +455,7 @@ class AvalonErrorCode(Enum):
 # 784 0 0 0
 def decode_echu(status, miner, current_hashrate, identifier, input):
     if type(current_hashrate) is not float:
-        status.errors.add("INTERNAL ERROR")
+        status.add_finding(make_finding('internal', 'error', miner.ip))
         return
 
     actual_codes = input.split(" ")
@@ -414,13 +467,14 @@ def decode_echu(status, miner, current_hashrate, identifier, input):
             if (code.value & actual_code) <> 0:
                 # Acording to doc there are some erros that are ignorable.
                 if code.get_error_type() == AvalonErrorType.IGNORABLE:
-                    status.debugs.add(code.get_error_message(
-                        miner.ip, identifier))
+                    level = 'debug'
                 elif code.get_error_type() == AvalonErrorType.WARNING:
-                    status.warnings.add(
-                        code.get_error_message(miner.ip, identifier))
+                    level = 'warning'
                 else:
-                    status.errors.add(code.get_error_message(miner.ip, identifier))
+                    level = 'error'
+                status.add_finding(make_finding('echu', level, miner.ip, code,
+                                                check="echu_{}_{}".format(identifier, code.name),
+                                                identifier=identifier))
     return
 
 # MW will be something like:
@@ -431,12 +485,13 @@ def decode_mw(input):
     return len(nums)
 
 def make_miner_instance_gekkoscience(status, miner, miner_stats, miner_pools, miner_summary):
+    model = model_catalog.get(miner.model_id)
     # Get worker name
     worker = miner_pools['POOLS'][0]['User']
 
     # Get GH/S 5s
     hashrate_value = float(str(miner_summary['SUMMARY'][0]['MHS 5s']))
-    hashrate_unit = miner.model.hashrate_unit
+    hashrate_unit = model.hashrate_unit
     hashrate_value, hashrate_unit = update_unit_and_value(
         hashrate_value, hashrate_unit)
 
@@ -446,10 +501,10 @@ def make_miner_instance_gekkoscience(status, miner, miner_stats, miner_pools, mi
     uptime = miner_summary['SUMMARY'][0]['Elapsed']
 
     status.add_miner_instance(worker=worker,
-                           working_chip_count=int(miner.model.chips),
+                           working_chip_count=model.expected_chip_count,
                            defective_chip_count=0,
                            inactive_chip_count=0,
-                           expected_chip_count=int(miner.model.chips),
+                           expected_chip_count=model.expected_chip_count,
                            hashrate_value=hashrate_value,
                            hashrate_unit=hashrate_unit,
                            temps=[],
@@ -461,12 +516,13 @@ def make_miner_instance_gekkoscience(status, miner, miner_stats, miner_pools, mi
 
 
 def make_miner_instance_r1_ltc(status, miner, miner_stats, miner_pools, miner_summary):
+    model = model_catalog.get(miner.model_id)
     # Get worker name
     worker = miner_pools['POOLS'][0]['User']
 
     # Get GH/S 5s
     hashrate_value = float(str(miner_summary['SUMMARY'][0]['GHS 5s']))
-    hashrate_unit = miner.model.hashrate_unit
+    hashrate_unit = model.hashrate_unit
     hashrate_value, hashrate_unit = update_unit_and_value(
         hashrate_value, hashrate_unit)
 
@@ -476,10 +532,10 @@ def make_miner_instance_r1_ltc(status, miner, miner_stats, miner_pools, miner_su
     uptime = miner_summary['SUMMARY'][0]['Elapsed']
 
     status.add_miner_instance(worker=worker,
-                           working_chip_count=int(miner.model.chips),
+                           working_chip_count=model.expected_chip_count,
                            defective_chip_count=0,
                            inactive_chip_count=0,
-                           expected_chip_count=int(miner.model.chips),
+                           expected_chip_count=model.expected_chip_count,
                            hashrate_value=hashrate_value,
                            hashrate_unit=hashrate_unit,
                            temps=[],
@@ -0,0 +1,166 @@
+import socket
+import struct
+import threading
+from collections import namedtuple
+
+from app.views.rules import HASHRATE_UNITS, hashes_per_sec
+from app.views.snapshot import LEVEL_DOWN, LEVEL_NAMES, instance_from_record
+
+PER_PAGE = 100
+MAX_PER_PAGE = 500
+# Pseudo status matching every miner that answered
+STATUS_UP = 'up'
+FILTERS = ('model', 'pool_user', 'status')
+
+
+def ip_key(ip):
+    """ Sorts IPv4 addresses numerically, anything else after them. """
+    try:
+        return (0, struct.unpack('!I', socket.inet_aton(ip))[0], ip)
+    except (socket.error, TypeError, ValueError):
+        return (1, 0, ip)
+
+
+def record_hashrate(record):
+    if record.hashrate_unit in HASHRATE_UNITS:
+        return hashes_per_sec(record.hashrate_value, record.hashrate_unit)
+    return 0
+
+
+# sort parameter -> key of a record. Ties are broken by IP.
+SORT_KEYS = {
+    'ip': lambda record: 0,
+    'hashrate': record_hashrate,
+    'temp': lambda record: max(record.temps) if record.temps else 0,
+    'hw': lambda record: record.hw_error_rate_pct,
+    'uptime': lambda record: record.uptime_secs,
+}
+
+
+def pool_user_of(record):
+    return record.worker.split('.')[0] if record.worker else ''
+
+
+class MinerRow(namedtuple('MinerRow', 'instance level message pool_user key')):
+    """ key identifies the rendered row: (miner id, instance, version of its
+    record), None when the row is not to be cached.
+    """
+    __slots__ = ()
+
+
+class MinerPage(namedtuple('MinerPage', 'rows total page pages per_page')):
+    __slots__ = ()
+
+
+class MinerTable(object):
+    """ The records of one snapshot with the indexes the miner table is
+    queried through: one precomputed order per sort key and the record
+    positions of every model, pool user and status. A page costs at most
+    one pass over an order, without sorting or decoding anything.
+    """
+
+    def __init__(self, records, versions=None):
+        self.records = records
+        self.rows = [MinerRow(instance_from_record(record), LEVEL_NAMES[record.level], record.message,
+                              pool_user_of(record),
+                              (record.miner_id, record.instance, versions[i]) if versions is not None else None)
+                     for i, record in enumerate(records)]
+        ip_order = sorted(range(len(records)), key=lambda i: (ip_key(records[i].ip), records[i].instance))
+        ip_rank = [0] * len(records)
+        for rank, i in enumerate(ip_order):
+            ip_rank[i] = rank
+        self.orders = dict((name, sorted(ip_order, key=lambda i: (key(records[i]), ip_rank[i])))
+                           for name, key in SORT_KEYS.items())
+        self.postings = dict((name, {}) for name in FILTERS)
+        for i, (record, row) in enumerate(zip(records, self.rows)):
+            self.postings['model'].setdefault(record.model, set()).add(i)
+            self.postings['pool_user'].setdefault(row.pool_user, set()).add(i)
+            self.postings['status'].setdefault(row.level, set()).add(i)
+            if record.level != LEVEL_DOWN:
+                self.postings['status'].setdefault(STATUS_UP, set()).add(i)
+        self.remarks = [(record.remarks or '').lower() for record in records]
+
+    def values(self, name):
+        """ Values to offer for a filter. """
+        return sorted(value for value in self.postings[name] if value)
+
+    def rows_with_status(self, status):
+        return [self.rows[i] for i in self.orders['ip'] if i in self.postings['status'].get(status, ())]
+
+    def query(self, model=None, pool_user=None, status=STATUS_UP, remarks=None, sort='ip', descending=False,
+              page=1, per_page=PER_PAGE):
+        per_page = max(1, min(per_page, MAX_PER_PAGE))
+        candidates = None
+        for name, value in (('model', model), ('pool_user', pool_user), ('status', status)):
+            if value is None:
+                continue
+            positions = self.postings[name].get(value, set())
+            candidates = positions if candidates is None else candidates & positions
+        remarks = remarks.lower() if remarks else None
+
+        order = self.orders.get(sort, self.orders['ip'])
+        if descending:
+            order = reversed(order)
+        first = (max(1, page) - 1) * per_page
+        rows = []
+        total = 0
+        for i in order:
+            if candidates is not None and i not in candidates:
+                continue
+            if remarks is not None and remarks not in self.remarks[i]:
+                continue
+            if first <= total < first + per_page:
+                rows.append(self.rows[i])
+            total += 1
+            if remarks is None and total >= first + per_page:
+                # The count is known without going further.
+                total = len(candidates) if candidates is not None else len(self.records)
+                break
+        pages = max(1, (total + per_page - 1) // per_page)
+        if page > pages:
+            return self.query(model, pool_user, status, remarks, sort, descending, pages, per_page)
+        return MinerPage(rows, total, max(1, page), pages, per_page)
+
+
+class MinerTableCache(object):
+    """ Keeps the table of the last snapshot, rebuilt once per published
+    snapshot instead of once per request.
+
+    Every record gets a version, which only changes when the record differs
+    from the one of the same miner instance in the previous snapshot, so
+    the rows rendered for unchanged miners can be reused.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = None
+        self.table = None
+        # (miner id, instance) -> (record, version)
+        self.versions = {}
+        self.last_version = 0
+
+    def _versions(self, records):
+        versions = []
+        current = {}
+        for record in records:
+            key = (record.miner_id, record.instance)
+            previous = self.versions.get(key)
+            if previous is not None and previous[0] == record:
+                version = previous[1]
+            else:
+                self.last_version += 1
+                version = self.last_version
+            current[key] = (record, version)
+            versions.append(version)
+        self.versions = current
+        return versions
+
+    def get(self, records):
+        with self.lock:
+            if records is not self.records:
+                self.table = MinerTable(records, self._versions(records))
+                self.records = records
+            return self.table
+
+
+miner_tables = MinerTableCache()
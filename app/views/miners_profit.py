@@ -3,7 +3,9 @@ import json
 import re
 from enum import Enum
 from miner_adapter import get_miner_status, update_unit_and_value, ModelType
-from app.models import Miner, MinerModel
+from sqlalchemy.orm import joinedload
+
+from app.models import Miner
 from cached_http_request import CachedHttpRequest
 
 cached_http_request = CachedHttpRequest(entry_expiration_secs=60)
@@ -109,8 +111,9 @@ class MiningInfo(object):
 
 
 class MinerProfit(object):
-    def __init__(self, miner_instance, data):
+    def __init__(self, miner_instance, model, data):
         self.miner_instance = miner_instance
+        self.model = model
         self.data = data
 
     def number_of_devices(self):
@@ -134,7 +137,7 @@ def get_coin_from_model(model_str):
 
 
 def get_miners_profit(usd_per_kwh):
-    miners = Miner.query.all()
+    miners = Miner.query.options(joinedload(Miner.model)).all()
     result = []
     total_revenue = 0
     total_cost = 0
@@ -145,12 +148,12 @@ def get_miners_profit(usd_per_kwh):
     for miner in miners:
         miner_status = get_miner_status(miner)
         for miner_instance in miner_status.miner_instance_list:
-            coin = get_coin_from_model(miner_instance.miner.model.model)
-            mi = MiningInfo(coin, miner_instance.miner.model.hashrate_value,
-                            miner_instance.miner.model.hashrate_unit, miner_instance.miner.model.watts, usd_per_kwh, cached_http_request)
+            coin = get_coin_from_model(miner.model.model)
+            mi = MiningInfo(coin, miner.model.hashrate_value,
+                            miner.model.hashrate_unit, miner.model.watts, usd_per_kwh, cached_http_request)
             data = mi.fetch()
             if not data is None:
-                mp = MinerProfit(miner_instance=miner_instance, data=data)
+                mp = MinerProfit(miner_instance=miner_instance, model=miner.model, data=data)
                 total_revenue += data['revenue_per_day']
                 total_cost += data['cost_per_day']
 
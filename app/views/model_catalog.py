@@ -0,0 +1,98 @@
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import event
+
+import config
+from app.models import MinerModel
+
+
+class ModelSpec(namedtuple('ModelSpec', [
+        'id', 'model', 'chips', 'chips_per_board', 'expected_chip_count', 'temp_keys', 'temp_re',
+        'description', 'hashrate_value', 'hashrate_unit', 'hashrate_unit_in_api', 'high_temp',
+        'max_fan_rpm', 'watts'])):
+    """ Immutable copy of a MinerModel row, with the fields the parsers need
+    already parsed: chips_per_board and expected_chip_count from chips, and
+    temp_re matching the stats keys of the chip temperatures.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_row(cls, row):
+        chips_per_board = tuple(int(chips) for chips in str(row.chips).split(','))
+        return cls(row.id, row.model, row.chips, chips_per_board, sum(chips_per_board), row.temp_keys,
+                   re.compile(re.escape(row.temp_keys) + '[0-9]'), row.description, row.hashrate_value,
+                   row.hashrate_unit, row.hashrate_unit_in_api, row.high_temp, row.max_fan_rpm, row.watts)
+
+
+CatalogIndex = namedtuple('CatalogIndex', 'by_id by_name specs')
+
+
+class ModelCatalog(object):
+    """ All the miner models, loaded from the DB once and served from memory.
+
+    Writes to MinerModel in this process drop the index right away. Writes
+    from another process (create_db.py, update_db.py, another worker) are
+    noticed through stamp_path, checked at most every check_interval_secs.
+    """
+
+    def __init__(self, stamp_path, check_interval_secs=1):
+        self.lock = threading.Lock()
+        self.stamp_path = stamp_path
+        self.check_interval_secs = check_interval_secs
+        self.stamp = None
+        self.checked = 0
+        self.current = None
+
+    def _read_stamp(self):
+        try:
+            return os.stat(self.stamp_path).st_mtime
+        except OSError:
+            return None
+
+    def invalidate(self):
+        with self.lock:
+            self.current = None
+
+    def index(self):
+        with self.lock:
+            now = time.time()
+            if now - self.checked >= self.check_interval_secs:
+                self.checked = now
+                stamp = self._read_stamp()
+                if stamp != self.stamp:
+                    self.stamp = stamp
+                    self.current = None
+            if self.current is None:
+                specs = tuple(sorted((ModelSpec.from_row(row) for row in MinerModel.query.all()),
+                                     key=lambda spec: spec.model))
+                self.current = CatalogIndex(dict((spec.id, spec) for spec in specs),
+                                            dict((spec.model, spec) for spec in specs),
+                                            specs)
+            return self.current
+
+    def get(self, model_id):
+        return self.index().by_id[model_id]
+
+    def find(self, model_name):
+        """ Returns the spec of the model with that name, or None. """
+        return self.index().by_name.get(model_name)
+
+    def all(self):
+        return self.index().specs
+
+
+# Any write that changes models, thresholds or miners touches this stamp (see
+# rules.py), so it is shared with the rule engine.
+model_catalog = ModelCatalog(config.RULES_STAMP_FILE)
+
+
+def _invalidate_catalog(mapper, connection, target):
+    model_catalog.invalidate()
+
+
+for _event in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(MinerModel, _event, _invalidate_catalog)
@@ -0,0 +1,147 @@
+import threading
+import time
+
+import requests
+
+import config
+from app import logger
+from app.views.mail_sender import SmtpSink
+from app.views.spool import Spool
+
+
+class WebhookSink(object):
+    """ POSTs every notification as JSON to a URL (chat bots, PagerDuty, ...). """
+    name = 'webhook'
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, subject, body_html, body_plain):
+        r = requests.post(self.url, timeout=self.timeout, json={
+            "subject": subject,
+            "body_html": body_html,
+            "body_plain": body_plain,
+        })
+        if r.status_code >= 300:
+            raise IOError("Webhook returned status code {}".format(r.status_code))
+
+    def close(self):
+        pass
+
+
+class NotificationDispatcher(object):
+    """ Delivers notifications from a background thread.
+
+    notify() only writes one spool entry per sink and returns, so a slow or
+    broken mail server never holds up the monitoring loop. Failed deliveries
+    are retried with exponential backoff and, because the spool lives on disk,
+    undelivered notifications are picked up again after a restart.
+    """
+
+    def __init__(self, sinks, spool, initial_backoff_secs=5, max_backoff_secs=3600):
+        self.sinks = dict((sink.name, sink) for sink in sinks)
+        self.spool = spool
+        self.initial_backoff_secs = initial_backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        self.condition = threading.Condition()
+        # spool entry name -> entry, for entries not delivered yet
+        self.pending = {}
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        with self.condition:
+            for name, entry in self.spool.items():
+                if entry['sink'] in self.sinks:
+                    self.pending[name] = entry
+                else:
+                    logger.warning("Dropping notification for unconfigured sink '{}'".format(entry['sink']))
+                    self.spool.remove(name)
+        if self.pending:
+            logger.info("Resuming delivery of {} notification(s)".format(len(self.pending)))
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def notify(self, subject, body_html, body_plain):
+        now = time.time()
+        with self.condition:
+            for sink_name in self.sinks:
+                entry = {
+                    "sink": sink_name,
+                    "subject": subject,
+                    "body_html": body_html,
+                    "body_plain": body_plain,
+                    "created": now,
+                    "attempts": 0,
+                    "next_attempt": now,
+                }
+                self.pending[self.spool.put(entry)] = entry
+            self.condition.notify()
+
+    def _next_due(self):
+        # Returns (name, entry) of the oldest due entry, or (None, seconds to
+        # wait) when nothing is due yet.
+        now = time.time()
+        wait_secs = None
+        for name in sorted(self.pending):
+            entry = self.pending[name]
+            if entry['next_attempt'] <= now:
+                return name, entry
+            if wait_secs is None or entry['next_attempt'] - now < wait_secs:
+                wait_secs = entry['next_attempt'] - now
+        return None, wait_secs
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    name, entry = self._next_due()
+                    if name is not None:
+                        break
+                    # Close idle sessions while there is nothing to send.
+                    if not self.pending:
+                        for sink in self.sinks.values():
+                            sink.close()
+                    self.condition.wait(entry)
+                if self.stopped:
+                    break
+            self._deliver(name, entry)
+        for sink in self.sinks.values():
+            sink.close()
+
+    def _deliver(self, name, entry):
+        sink = self.sinks[entry['sink']]
+        try:
+            sink.send(entry['subject'], entry['body_html'], entry['body_plain'])
+        except Exception as e:
+            entry['attempts'] += 1
+            backoff_secs = min(self.initial_backoff_secs * 2 ** (entry['attempts'] - 1),
+                               self.max_backoff_secs)
+            entry['next_attempt'] = time.time() + backoff_secs
+            logger.warning("Failure sending '{}' through {} (attempt #{}), retrying in {}s. Message:{}".format(
+                entry['subject'], sink.name, entry['attempts'], backoff_secs, e))
+            self.spool.put(entry, name=name)
+            return
+        logger.debug("Successfully sent '{}' through {}".format(entry['subject'], sink.name))
+        with self.condition:
+            self.pending.pop(name, None)
+        self.spool.remove(name)
+
+
+def create_dispatcher():
+    sinks = []
+    if config.EMAIL_TO:
+        sinks.append(SmtpSink(config.SMTP_HOST, config.SMTP_PORT, config.GMAIL_USER, config.GMAIL_PWD,
+                              config.EMAIL_TO, starttls=config.SMTP_STARTTLS))
+    if config.WEBHOOK_URL:
+        sinks.append(WebhookSink(config.WEBHOOK_URL))
+    return NotificationDispatcher(sinks, Spool(config.NOTIFICATION_SPOOL_DIR))
@@ -0,0 +1,153 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# time.clock() measures CPU time on Linux (and is gone in python 3.8), so use
+# a real wall clock. perf_counter only exists in python 3.
+try:
+    wall_clock = time.perf_counter
+except AttributeError:
+    wall_clock = time.time
+
+# Upper bound (in milliseconds) of each histogram bucket. Anything slower than
+# the last bound goes into an extra overflow bucket.
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Phases in the order they are displayed in /debug/perf.
+PHASES = ('connect', 'send', 'receive', 'json_decode', 'parse', 'db', 'render')
+
+
+class Histogram(object):
+    """ Fixed bucket latency histogram. Adding a sample is O(log buckets). """
+    __slots__ = ('counts', 'count', 'total_ms', 'max_ms')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def mean(self):
+        if self.count == 0:
+            return 0.0
+        return self.total_ms / self.count
+
+    def percentile(self, pct):
+        # Returns the upper bound of the bucket holding the given percentile,
+        # or the max seen if it falls into the overflow bucket.
+        if self.count == 0:
+            return 0.0
+        rank = self.count * pct / 100.0
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                if i < len(BUCKETS_MS):
+                    return min(float(BUCKETS_MS[i]), self.max_ms)
+                break
+        return self.max_ms
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.mean(), 3),
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "max_ms": round(self.max_ms, 3),
+            "buckets": self.counts[:],
+        }
+
+
+class PerfRegistry(object):
+    """ Aggregates phase timings into global and per-miner histograms.
+
+    Recording is a lock plus a bisect, so the timers are meant to stay on in
+    production.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = True
+        self.started = time.time()
+        self.global_histograms = {}
+        self.miner_histograms = {}
+
+    def record(self, phase, seconds, miner=None):
+        if not self.enabled:
+            return
+        ms = seconds * 1000.0
+        with self.lock:
+            histogram = self.global_histograms.get(phase)
+            if histogram is None:
+                histogram = self.global_histograms[phase] = Histogram()
+            histogram.add(ms)
+            if miner is not None:
+                per_miner = self.miner_histograms.get(miner)
+                if per_miner is None:
+                    per_miner = self.miner_histograms[miner] = {}
+                histogram = per_miner.get(phase)
+                if histogram is None:
+                    histogram = per_miner[phase] = Histogram()
+                histogram.add(ms)
+
+    @contextmanager
+    def timer(self, phase, miner=None):
+        start = wall_clock()
+        try:
+            yield
+        finally:
+            self.record(phase, wall_clock() - start, miner)
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.global_histograms = {}
+            self.miner_histograms = {}
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "since": self.started,
+                "buckets_ms": list(BUCKETS_MS),
+                "global": dict((phase, histogram.to_dict())
+                               for phase, histogram in self.global_histograms.items()),
+                "miners": dict((miner, dict((phase, histogram.to_dict())
+                                            for phase, histogram in phases.items()))
+                               for miner, phases in self.miner_histograms.items()),
+            }
+
+
+perf = PerfRegistry()
+
+
+# Time every SQL statement, whoever issues it.
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('perf_query_start', []).append(wall_clock())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    starts = conn.info.get('perf_query_start')
+    if starts:
+        perf.record('db', wall_clock() - starts.pop())
+
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute.
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('perf_query_start'):
+        conn.info['perf_query_start'].pop()
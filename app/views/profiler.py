@@ -0,0 +1,155 @@
+import os
+import sys
+import threading
+import time
+
+from app import basedir, logger
+
+PROFILE_DIR = os.path.join(basedir, 'logs')
+# 200 samples per second is enough to see where a sweep spends its time while
+# keeping the sampler thread well under 1% of a core.
+SAMPLE_INTERVAL_SECS = 0.005
+TOP_FUNCTIONS = 25
+
+
+class ProfilerError(Exception):
+    pass
+
+
+class ProfileSession(object):
+    def __init__(self, seconds=None, iterations=None):
+        self.started = time.time()
+        self.deadline = None if seconds is None else self.started + seconds
+        self.remaining_iterations = iterations
+        self.stack_counts = {}
+        self.sample_count = 0
+        self.done = threading.Event()
+
+
+class SamplingProfiler(object):
+    """ Statistical profiler for the agent thread.
+
+    A daemon thread periodically grabs the agent thread's frame through
+    sys._current_frames() and counts the stacks it sees. Nothing is hooked
+    into the interpreter (unlike cProfile), so the agent runs at full speed and
+    the Flask request threads are never sampled.
+
+    The session either runs for a number of seconds, or for the next N agent
+    iterations, in which case only the time between iteration_started() and
+    iteration_finished() is sampled so the sleeps between sweeps do not show up.
+    """
+
+    def __init__(self, output_dir=PROFILE_DIR, interval_secs=SAMPLE_INTERVAL_SECS):
+        self.output_dir = output_dir
+        self.interval_secs = interval_secs
+        self.lock = threading.Lock()
+        self.target_thread_id = None
+        self.session = None
+        self.sampling = False
+        self.last_result = None
+
+    def register_thread(self):
+        """ Must be called from the thread to be profiled. """
+        self.target_thread_id = threading.current_thread().ident
+
+    def start(self, seconds=None, iterations=None):
+        if (seconds is None) == (iterations is None):
+            raise ProfilerError("Either seconds or iterations must be given")
+        if self.target_thread_id is None:
+            raise ProfilerError("The monitoring agent is not running")
+        with self.lock:
+            if self.session is not None:
+                raise ProfilerError("A profiling session is already running")
+            self.session = ProfileSession(seconds=seconds, iterations=iterations)
+            # Time based sessions sample right away, iteration based ones wait
+            # for the next iteration to start.
+            self.sampling = seconds is not None
+            session = self.session
+        thread = threading.Thread(target=self._sample, args=(session,))
+        thread.daemon = True
+        thread.start()
+        logger.info("Profiler started. seconds:{} iterations:{}".format(seconds, iterations))
+
+    def stop(self):
+        with self.lock:
+            session = self.session
+        if session is not None:
+            session.done.set()
+
+    def is_running(self):
+        return self.session is not None
+
+    def iteration_started(self):
+        with self.lock:
+            if self.session is not None and self.session.remaining_iterations is not None:
+                self.sampling = True
+
+    def iteration_finished(self):
+        with self.lock:
+            session = self.session
+            if session is None or session.remaining_iterations is None:
+                return
+            self.sampling = False
+            session.remaining_iterations -= 1
+            if session.remaining_iterations <= 0:
+                session.done.set()
+
+    def _sample(self, session):
+        try:
+            while not session.done.is_set():
+                if session.deadline is not None and time.time() >= session.deadline:
+                    break
+                if self.sampling:
+                    frame = sys._current_frames().get(self.target_thread_id)
+                    if frame is not None:
+                        stack = []
+                        while frame is not None:
+                            code = frame.f_code
+                            stack.append("{} ({}:{})".format(
+                                code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                            frame = frame.f_back
+                        # Root first, as expected by flamegraph tools.
+                        stack = tuple(reversed(stack))
+                        session.stack_counts[stack] = session.stack_counts.get(stack, 0) + 1
+                        session.sample_count += 1
+                session.done.wait(self.interval_secs)
+            self.last_result = self._write_result(session)
+        except Exception as e:
+            logger.error("Error while profiling. Message:{}".format(e))
+        finally:
+            with self.lock:
+                self.session = None
+                self.sampling = False
+
+    def _write_result(self, session):
+        file_name = "profile-{}.folded".format(
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(session.started)))
+        with open(os.path.join(self.output_dir, file_name), 'w') as f:
+            for stack, count in sorted(session.stack_counts.items(), key=lambda x: -x[1]):
+                f.write("{} {}\n".format(";".join(stack), count))
+
+        # Self time is counted on the leaf, total time once per stack the
+        # function appears in (recursion is not double counted).
+        self_counts = {}
+        total_counts = {}
+        for stack, count in session.stack_counts.items():
+            self_counts[stack[-1]] = self_counts.get(stack[-1], 0) + count
+            for function in set(stack):
+                total_counts[function] = total_counts.get(function, 0) + count
+        top = sorted(total_counts.items(), key=lambda x: (-self_counts.get(x[0], 0), -x[1]))
+        result = {
+            "file_name": file_name,
+            "started": session.started,
+            "duration_secs": time.time() - session.started,
+            "sample_count": session.sample_count,
+            "top_functions": [{"function": function,
+                               "self": self_counts.get(function, 0),
+                               "total": total}
+                              for function, total in top[:TOP_FUNCTIONS]],
+        }
+        logger.info("Profiler finished. {} samples written to {}".format(
+            session.sample_count, file_name))
+        return result
+
+
+profiler = SamplingProfiler()
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import config
+
+# Commands that only read. Their replies are shared and cached, any other
+# command (restart, quit...) runs on its own and drops the cache of the host.
+READ_COMMANDS = frozenset(['summary', 'stats', 'pools', 'devs', 'version', 'config', 'coin', 'estats', 'devdetails'])
+
+
+class Call(object):
+    """ A read in progress that identical requests wait for. """
+    __slots__ = ('done', 'reply', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.reply = None
+        self.error = None
+
+
+class RpcGate(object):
+    """ Bounds the load the cgminer API of each miner sees, whatever the
+    number of viewers: one command at a time per host, identical concurrent
+    reads share one call, and read replies are reused for ttl_secs.
+
+    The raw replies are shared, every caller decodes its own copy. The last
+    reply of every read is kept as well, to be shown while the miner doesn't
+    answer.
+    """
+
+    def __init__(self, ttl_secs=2.0):
+        self.ttl_secs = ttl_secs
+        self.lock = threading.Lock()
+        # host -> Lock held while a command runs
+        self.host_locks = {}
+        # (host, command, arg) -> Call
+        self.in_flight = {}
+        # (host, command, arg) -> (expiry time, raw reply)
+        self.cache = {}
+        # (host, command, arg) -> last raw reply
+        self.last_replies = {}
+        self.next_purge = 0
+
+    def _purge(self, now):
+        if now < self.next_purge:
+            return
+        self.next_purge = now + max(self.ttl_secs, 1) * 10
+        for key in [key for key, (expiry, _) in self.cache.items() if expiry <= now]:
+            del self.cache[key]
+
+    def call(self, host, command, arg, send):
+        """ Returns the raw reply of send() or of an identical call, raises
+        what it raised.
+        """
+        key = (host, command, arg)
+        read = command in READ_COMMANDS
+        with self.lock:
+            host_lock = self.host_locks.get(host)
+            if host_lock is None:
+                host_lock = self.host_locks[host] = threading.Lock()
+            if read:
+                cached = self.cache.get(key)
+                if cached is not None and cached[0] > time.time():
+                    return cached[1]
+                call = self.in_flight.get(key)
+                if call is not None:
+                    shared = True
+                else:
+                    shared = False
+                    call = self.in_flight[key] = Call()
+            else:
+                for cached_key in [cached_key for cached_key in self.cache if cached_key[0] == host]:
+                    del self.cache[cached_key]
+
+        if not read:
+            with host_lock:
+                return send()
+
+        if shared:
+            call.done.wait()
+        else:
+            try:
+                with host_lock:
+                    call.reply = send()
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.in_flight[key]
+                    if call.error is None:
+                        self.last_replies[key] = call.reply
+                        if self.ttl_secs > 0:
+                            now = time.time()
+                            self.cache[key] = (now + self.ttl_secs, call.reply)
+                            self._purge(now)
+                call.done.set()
+        if call.error is not None:
+            raise call.error
+        return call.reply
+
+    def last_reply(self, host, command, arg):
+        """ The last raw reply of a read, None when there was none. """
+        with self.lock:
+            return self.last_replies.get((host, command, arg))
+
+    def retain(self, hosts):
+        """ Drops the replies of the hosts that are not monitored anymore. """
+        with self.lock:
+            for key in [key for key in self.last_replies if key[0] not in hosts]:
+                del self.last_replies[key]
+
+
+rpc_gate = RpcGate(ttl_secs=config.RPC_CACHE_TTL_SECS)
@@ -0,0 +1,209 @@
+import os
+import threading
+from collections import namedtuple
+
+from sqlalchemy import event
+
+import config
+from app.models import Miner, MinerModel, MinerThreshold
+from app.views.model_catalog import model_catalog
+
+HASHRATE_UNITS = {
+    'MH/s': 1e6,
+    'GH/s': 1e9,
+    'TH/s': 1e12,
+    'PH/s': 1e15,
+    'EH/s': 1e18,
+}
+
+
+def hashes_per_sec(value, unit):
+    return value * HASHRATE_UNITS[unit]
+
+
+# Thresholds used when no override is stored in the DB, given the model.
+DEFAULT_THRESHOLDS = {
+    'max_defective_chips': lambda model: 0,
+    'max_missing_chips': lambda model: 0,
+    'max_temp': lambda model: model.high_temp,
+    # Most of the times the hashrate will be higher than advertised, so 80%
+    # should just be hit if the device is either starting or malfunctioning.
+    'min_hashrate_pct': lambda model: 80,
+}
+
+RULE_DESCRIPTIONS = {
+    'max_defective_chips': "Defective ('x') chips tolerated before raising an error",
+    'max_missing_chips': "Missing chips tolerated before raising an error",
+    'max_temp': "Chip temperature (C) at which a warning is raised",
+    'min_hashrate_pct': "Percent of the advertised model hashrate below which an error is raised",
+}
+
+
+def _echu_message(finding):
+    return finding.value.get_error_message(finding.miner_ip, finding.detail['identifier'])
+
+
+# How each rule turns its finding into text. Only called when the finding is
+# displayed, logged or emailed.
+MESSAGES = {
+    'defective_chips': "[WARNING] '{value}' chips are defective on miner '{miner_ip}'.",
+    'high_temp': "[WARNING] High temperatures on miner '{miner_ip}'.",
+    'low_hashrate': "[ERROR] Hashrate {value:3.2f}{unit} is much smaller than the target {threshold:3.2f}{threshold_unit} on {miner_ip}",
+    'missing_chips': "[{level_tag}] ASIC chips are missing from miner '{miner_ip}'. Your Antminer '{model}' has '{value}/{threshold} chips'.",
+    'miner_count': "Expected {threshold} miners in ip {miner_ip}. Found {value}",
+    'stale': "[ERROR] Miner {miner_ip} not accessible (CG Miner), showing its last replies. {reason}",
+    'echu': _echu_message,
+    # Raised by the anomaly detector (anomaly.py)
+    'anomaly_spike': "[WARNING] {metric} of {miner_ip}{where} is {value:.2f}{unit}, {score:.1f} sigma {direction} its usual {threshold:.2f}{unit}",
+    'anomaly_shift': "[WARNING] {metric} of {miner_ip}{where} keeps drifting {direction} its usual {threshold:.2f}{unit}, now {value:.2f}{unit}",
+    'anomaly_peer': "[WARNING] {metric} of {miner_ip}{where} is {score:.1f} sigma {direction} the other {model} ({value:.2f}{unit} vs {threshold:.2f}{unit})",
+    'internal': "INTERNAL ERROR",
+}
+
+
+class Finding(namedtuple('Finding', 'rule check level miner_ip value threshold detail')):
+    """ Result of a failed health rule. check identifies the finding for the
+    alert engine, rule selects how it is formatted.
+    """
+    __slots__ = ()
+
+    def message(self):
+        template = MESSAGES[self.rule]
+        if callable(template):
+            return template(self)
+        return template.format(miner_ip=self.miner_ip, value=self.value, threshold=self.threshold,
+                               level_tag="ERROR" if self.level == 'error' else "WARNING",
+                               **(self.detail or {}))
+
+    def __str__(self):
+        return self.message()
+
+
+def make_finding(rule, level, miner_ip, value=None, threshold=None, check=None, **detail):
+    return Finding(rule, check or rule, level, miner_ip, value, threshold, detail)
+
+
+class CompiledRules(object):
+    """ Thresholds of one miner, resolved once. evaluate() is plain arithmetic. """
+    __slots__ = ('model_name', 'max_defective_chips', 'max_missing_chips', 'max_temp',
+                 'min_hashrate', 'min_hashrate_unit', 'min_hashrate_hs')
+
+    def __init__(self, model, thresholds):
+        self.model_name = model.model
+        self.max_defective_chips = thresholds['max_defective_chips']
+        self.max_missing_chips = thresholds['max_missing_chips']
+        self.max_temp = thresholds['max_temp']
+        self.min_hashrate = model.hashrate_value * thresholds['min_hashrate_pct'] / 100.0
+        self.min_hashrate_unit = model.hashrate_unit
+        self.min_hashrate_hs = hashes_per_sec(self.min_hashrate, model.hashrate_unit)
+
+    def evaluate(self, miner_ip, inputs):
+        (working_chip_count, defective_chip_count, expected_chip_count, hashrate_value, hashrate_unit, max_temp,
+         warming_up) = inputs
+        findings = []
+        if defective_chip_count > self.max_defective_chips:
+            findings.append(make_finding('defective_chips', 'error', miner_ip,
+                                         defective_chip_count, self.max_defective_chips))
+        if max_temp is not None and max_temp >= self.max_temp:
+            findings.append(make_finding('high_temp', 'warning', miner_ip, max_temp, self.max_temp))
+        low_hashrate = hashes_per_sec(hashrate_value, hashrate_unit) < self.min_hashrate_hs
+        if low_hashrate:
+            # Expected while the miner is warming up after a (re)boot.
+            findings.append(make_finding('low_hashrate', 'debug' if warming_up else 'error', miner_ip,
+                                         hashrate_value, self.min_hashrate,
+                                         unit=hashrate_unit, threshold_unit=self.min_hashrate_unit))
+            low_hashrate = not warming_up
+        # Give some slack. As long as the hashrate is fine don't worry
+        found_chip_count = working_chip_count + defective_chip_count
+        if expected_chip_count - found_chip_count > self.max_missing_chips:
+            findings.append(make_finding('missing_chips', 'error' if low_hashrate else 'debug', miner_ip,
+                                         found_chip_count, expected_chip_count, model=self.model_name))
+        return tuple(findings)
+
+
+class RuleEngine(object):
+    """ Compiles the rules of each miner once and only re-evaluates a miner
+    instance when its inputs changed. Any write to the thresholds or models
+    invalidates everything. Writes made by another process (the web app
+    when the agent runs standalone) are noticed through stamp_path.
+    """
+
+    def __init__(self, stamp_path):
+        self.lock = threading.Lock()
+        self.stamp_path = stamp_path
+        self.stamp = self._read_stamp()
+        # (rule, model_id, miner_id) -> value, loaded on first use
+        self.overrides = None
+        # miner id -> CompiledRules
+        self.compiled = {}
+        # (miner id, miner ip, instance key) -> (inputs, findings)
+        self.results = {}
+
+    def invalidate(self):
+        with self.lock:
+            self.overrides = None
+            self.compiled = {}
+            self.results = {}
+
+    def _read_stamp(self):
+        try:
+            return os.stat(self.stamp_path).st_mtime
+        except OSError:
+            return None
+
+    def touch(self):
+        """ Tells the other processes that the rules changed. """
+        try:
+            with open(self.stamp_path, 'a'):
+                os.utime(self.stamp_path, None)
+        except (IOError, OSError):
+            pass
+        self.invalidate()
+        self.stamp = self._read_stamp()
+
+    def refresh(self):
+        """ Drops everything if the rules changed in another process. """
+        stamp = self._read_stamp()
+        if stamp != self.stamp:
+            self.invalidate()
+            self.stamp = stamp
+
+    def thresholds_for(self, miner):
+        if self.overrides is None:
+            self.overrides = dict(((threshold.rule, threshold.model_id, threshold.miner_id), threshold.value)
+                                  for threshold in MinerThreshold.query.all())
+        thresholds = {}
+        for rule, default in DEFAULT_THRESHOLDS.items():
+            value = self.overrides.get((rule, None, miner.id))
+            if value is None:
+                value = self.overrides.get((rule, miner.model_id, None))
+            if value is None:
+                value = default(model_catalog.get(miner.model_id))
+            thresholds[rule] = value
+        return thresholds
+
+    def evaluate(self, miner, instance_key, inputs):
+        key = (miner.id, miner.ip, instance_key)
+        with self.lock:
+            cached = self.results.get(key)
+            if cached is not None and cached[0] == inputs:
+                return cached[1]
+            compiled = self.compiled.get(miner.id)
+            if compiled is None:
+                compiled = self.compiled[miner.id] = CompiledRules(model_catalog.get(miner.model_id),
+                                                                         self.thresholds_for(miner))
+            findings = compiled.evaluate(miner.ip, inputs)
+            self.results[key] = (inputs, findings)
+            return findings
+
+
+rule_engine = RuleEngine(config.RULES_STAMP_FILE)
+
+
+def _invalidate_rules(mapper, connection, target):
+    rule_engine.touch()
+
+
+for _model in (MinerThreshold, MinerModel, Miner):
+    for _event in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event, _invalidate_rules)
@@ -0,0 +1,295 @@
+import json
+import random
+import re
+from collections import namedtuple
+
+from app import db
+from app.models import Miner
+from app.views.agent import Agent
+from app.views.alerts import OK
+from app.views.archive import read_polls
+from app.views.miner_adapter import MinersStatus, parse_miner_status
+from app.views.model_catalog import model_catalog
+
+# States of a miner in a timeline
+UP = 'up'
+# Neither the web interface nor the cgminer API answer
+DOWN = 'down'
+# The web interface answers, the cgminer API doesn't
+UNREACHABLE = 'unreachable'
+# Answers, chips above the high temperature of the model
+HOT = 'hot'
+# Answers, at half the hashrate of the model
+SLOW = 'slow'
+STATES = (UP, DOWN, UNREACHABLE, HOT, SLOW)
+
+# time is in seconds from the start of the timeline
+TimelineEvent = namedtuple('TimelineEvent', 'time ip state')
+
+WRITE_STATEMENT = re.compile(r'^\s*(INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+"?(\w+)', re.IGNORECASE)
+
+
+def read_timeline(path):
+    """ Reads a timeline from a JSON Lines file of {"time": secs from the
+    start, "ip": ..., "state": ...}. Raises ValueError.
+    """
+    events = []
+    with open(path) as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            fields = json.loads(line)
+            if fields.get('state') not in STATES:
+                raise ValueError("line {}: state must be one of {}".format(number, ", ".join(STATES)))
+            events.append(TimelineEvent(float(fields['time']), fields['ip'], fields['state']))
+    events.sort(key=lambda event: event.time)
+    return events
+
+
+def synthetic_timeline(ips, duration_secs, flaps_per_day=4.0, mean_failure_secs=300.0,
+                       states=(DOWN, UNREACHABLE, HOT, SLOW), seed=None):
+    """ Every miner fails at random (flaps_per_day on average, in one of
+    states) and recovers after mean_failure_secs on average, both
+    exponentially distributed.
+    """
+    rng = random.Random(seed)
+    events = []
+    for ip in ips:
+        t = rng.expovariate(flaps_per_day / 86400.0)
+        while t < duration_secs:
+            events.append(TimelineEvent(t, ip, rng.choice(states)))
+            t += rng.expovariate(1.0 / mean_failure_secs)
+            events.append(TimelineEvent(t, ip, UP))
+            t += rng.expovariate(flaps_per_day / 86400.0)
+    events.sort(key=lambda event: event.time)
+    return events
+
+
+class Incident(object):
+    __slots__ = ('ip', 'start', 'end', 'alerted_at')
+
+    def __init__(self, ip, start):
+        self.ip = ip
+        self.start = start
+        self.end = None
+        self.alerted_at = None
+
+
+class IncidentLog(object):
+    """ When each miner started and stopped failing, and when the agent
+    first emailed about it.
+    """
+
+    def __init__(self):
+        self.incidents = []
+        # ip -> last Incident of the miner
+        self.last = {}
+
+    def change(self, ip, failing, now):
+        incident = self.last.get(ip)
+        is_open = incident is not None and incident.end is None
+        if failing and not is_open:
+            incident = self.last[ip] = Incident(ip, now)
+            self.incidents.append(incident)
+        elif not failing and is_open:
+            incident.end = now
+
+    def alerted(self, ip, transition_time, now):
+        incident = self.last.get(ip)
+        if incident is not None and incident.start <= transition_time and incident.alerted_at is None:
+            incident.alerted_at = now
+
+
+class ReplaySource(object):
+    """ What the sources of a simulation share: the miners, and what
+    happened to them.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.incidents = IncidentLog()
+        self.http_checks = 0
+        self.polls = 0
+        self.fleet = None
+
+    def miners(self):
+        # The fleet doesn't change during a simulation, it is only read once.
+        if self.fleet is None:
+            self.fleet = Miner.query.all()
+            db.session.expunge_all()
+        return self.fleet
+
+
+class TimelineSource(ReplaySource):
+    """ Miner status played from a timeline on the clock of the agent. A
+    miner that answers gets one instance with the chips and hashrate of its
+    model, so the health rules run on it as on a real one.
+    """
+
+    def __init__(self, clock, start, events):
+        super(TimelineSource, self).__init__(clock)
+        self.start = start
+        self.events = events
+        self.next_event = 0
+        # ip -> state, UP when absent
+        self.states = {}
+
+    def advance(self):
+        elapsed = self.clock.time() - self.start
+        while self.next_event < len(self.events) and self.events[self.next_event].time <= elapsed:
+            event = self.events[self.next_event]
+            self.next_event += 1
+            if event.state == self.states.get(event.ip, UP):
+                continue
+            self.states[event.ip] = event.state
+            self.incidents.change(event.ip, event.state != UP, self.start + event.time)
+
+    def http_failures(self, miners, stop_event):
+        self.advance()
+        self.http_checks += 1
+        return [miner for miner in miners if self.states.get(miner.ip) == DOWN]
+
+    def miner_status(self, miner, archive):
+        self.advance()
+        self.polls += 1
+        state = self.states.get(miner.ip, UP)
+        if state in (DOWN, UNREACHABLE):
+            return None
+        model = model_catalog.get(miner.model_id)
+        chips = sum(int(count) for count in model.chips.split(','))
+        status = MinersStatus()
+        status.add_miner_instance(
+            worker='sim', working_chip_count=chips, defective_chip_count=0, inactive_chip_count=0,
+            expected_chip_count=chips,
+            hashrate_value=model.hashrate_value / 2 if state == SLOW else model.hashrate_value,
+            hashrate_unit=model.hashrate_unit,
+            temps=[model.high_temp + 5 if state == HOT else model.high_temp - 20],
+            fan_speeds=[], fan_pct=None, hw_error_rate_pct=0.0,
+            uptime_secs=24 * 3600, miner=miner)
+        return status
+
+
+class ArchiveSource(ReplaySource):
+    """ Miner status played from the response archive on the clock of the
+    agent: every poll returns the last archived replies of the miner. A
+    miner whose last replies are an error fails the HTTP check as well.
+    """
+
+    def __init__(self, clock, directory, since=None, until=None):
+        super(ArchiveSource, self).__init__(clock)
+        self.polls_iter = read_polls(directory, since, until)
+        self.pending = next(self.polls_iter, None)
+        # ip -> last ArchivedPoll
+        self.last = {}
+
+    def advance(self):
+        now = self.clock.time()
+        while self.pending is not None and self.pending.time <= now:
+            poll = self.pending
+            self.pending = next(self.polls_iter, None)
+            was_failing = self.failing(poll.ip)
+            self.last[poll.ip] = poll
+            if self.failing(poll.ip) != was_failing:
+                self.incidents.change(poll.ip, not was_failing, poll.time)
+
+    def failing(self, ip):
+        poll = self.last.get(ip)
+        return poll is not None and poll.responses['stats']['STATUS'][0]['STATUS'] == 'error'
+
+    def http_failures(self, miners, stop_event):
+        self.advance()
+        self.http_checks += 1
+        return [miner for miner in miners if self.failing(miner.ip)]
+
+    def miner_status(self, miner, archive):
+        self.advance()
+        self.polls += 1
+        poll = self.last.get(miner.ip)
+        if poll is None:
+            return None
+        return parse_miner_status(miner, model_catalog.get(miner.model_id), poll.responses)
+
+
+class RecordingDispatcher(object):
+    """ Stands in for the notification dispatcher: counts the emails. """
+
+    def __init__(self, clock):
+        self.clock = clock
+        # (time, subject)
+        self.sent = []
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=None):
+        pass
+
+    def notify(self, subject, body_html, body_plain):
+        self.sent.append((self.clock.time(), subject))
+
+
+class SimulatedAgent(Agent):
+    """ The agent with a recording dispatcher, which matches every digest
+    with the incidents it reports.
+    """
+
+    def __init__(self, clock, source, **kwargs):
+        super(SimulatedAgent, self).__init__(clock=clock, source=source, **kwargs)
+        self.dispatcher = RecordingDispatcher(clock)
+        self.transitions = 0
+
+    def publish_status(self, state):
+        # Only read by the other workers, there are none.
+        pass
+
+    def send_digest(self, digest):
+        super(SimulatedAgent, self).send_digest(digest)
+        self.transitions += len(digest.transitions)
+        for transition in digest.transitions:
+            if transition.new_state != OK:
+                self.source.incidents.alerted(transition.key, transition.timestamp, self.clock.time())
+
+
+class WriteCounter(object):
+    """ Counts the statements that write, by table, through a
+    before_cursor_execute listener.
+    """
+
+    def __init__(self):
+        # (verb, table) -> count
+        self.counts = {}
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        match = WRITE_STATEMENT.match(statement)
+        if match:
+            key = (match.group(1).split()[0].upper(), match.group(2))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def total(self):
+        return sum(self.counts.values())
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def report(agent, source, writes, duration_secs, wall_secs):
+    """ Lines describing what the agent did over the simulated time. """
+    incidents = source.incidents.incidents
+    alerted = [incident for incident in incidents if incident.alerted_at is not None]
+    lines = [
+        "Simulated {:.0f}s ({:.1f} day(s)) in {:.1f}s of wall time, {:.0f}x real time".format(
+            duration_secs, duration_secs / 86400.0, wall_secs, duration_secs / wall_secs if wall_secs else 0),
+        "HTTP check sweeps: {}, cgminer polls: {}".format(source.http_checks, source.polls),
+        "Incidents: {}, alerted: {}, never alerted: {}".format(
+            len(incidents), len(alerted), len(incidents) - len(alerted)),
+    ]
+    if alerted:
+        latencies = [incident.alerted_at - incident.start for incident in alerted]
+        lines.append("Alert latency: p50 {:.0f}s, p95 {:.0f}s, max {:.0f}s".format(
+            percentile(latencies, 50), percentile(latencies, 95), max(latencies)))
+    lines.append("Emails: {} ({} transition(s))".format(len(agent.dispatcher.sent), agent.transitions))
+    lines.append("DB writes: {}{}".format(writes.total(), "".join(
+        "\n    {} {}: {}".format(verb, table, count) for (verb, table), count in sorted(writes.counts.items()))))
+    return lines
@@ -0,0 +1,220 @@
+import math
+import mmap
+import os
+import struct
+import time
+from collections import namedtuple
+
+from app import logger
+from app.views.miner_adapter import MinerInstance
+from app.views.model_catalog import model_catalog
+
+MAGIC = b'AMSNAP01'
+# magic, sequence, record count, record capacity, published time
+HEADER = struct.Struct('<8sQIId')
+HEADER_SIZE = 64
+SEQ_OFFSET = 8
+MAX_TEMPS = 4
+MAX_FANS = 4
+# Everything is fixed size so that a record can be located and decoded in
+# place: miner id, instance index, ip, model, remarks, worker, level, chips
+# (working, defective, inactive, expected), hashrate value and unit, temps,
+# fan speeds, fan percent, HW error rate, uptime and the most severe message.
+RECORD = struct.Struct('<IB16s16s64s64sB4Hd8s{}h{}Hffi128s'.format(MAX_TEMPS, MAX_FANS))
+
+LEVEL_OK = 0
+LEVEL_WARNING = 1
+LEVEL_ERROR = 2
+LEVEL_DOWN = 3
+LEVEL_CODES = {'debug': LEVEL_OK, 'warning': LEVEL_WARNING, 'error': LEVEL_ERROR}
+LEVEL_NAMES = {LEVEL_OK: "ok", LEVEL_WARNING: "warning", LEVEL_ERROR: "error", LEVEL_DOWN: "down"}
+
+SnapshotRecord = namedtuple('SnapshotRecord', [
+    'miner_id', 'instance', 'ip', 'model', 'remarks', 'worker', 'level',
+    'working_chip_count', 'defective_chip_count', 'inactive_chip_count', 'expected_chip_count',
+    'hashrate_value', 'hashrate_unit', 'temps', 'fan_speeds', 'fan_pct', 'hw_error_rate_pct',
+    'uptime_secs', 'message'])
+
+
+def _encode(text, size):
+    if text is None:
+        return b''
+    if not isinstance(text, bytes):
+        text = text.encode('utf-8')
+    return text[:size]
+
+
+def _decode(raw):
+    return raw.rstrip(b'\0').decode('utf-8', 'replace')
+
+
+def _clamp(value, high, low=0):
+    return max(low, min(int(value), high))
+
+
+def _padded(values, size, high, low=0):
+    values = [_clamp(value, high, low) for value in values][:size]
+    return values + [0] * (size - len(values))
+
+
+def pack_record(buf, offset, record):
+    RECORD.pack_into(buf, offset,
+                     record.miner_id, record.instance,
+                     _encode(record.ip, 16), _encode(record.model, 16),
+                     _encode(record.remarks, 64), _encode(record.worker, 64),
+                     record.level,
+                     _clamp(record.working_chip_count, 0xffff), _clamp(record.defective_chip_count, 0xffff),
+                     _clamp(record.inactive_chip_count, 0xffff), _clamp(record.expected_chip_count, 0xffff),
+                     float(record.hashrate_value), _encode(record.hashrate_unit, 8),
+                     *(_padded(record.temps, MAX_TEMPS, 0x7fff, -0x8000) + _padded(record.fan_speeds, MAX_FANS, 0xffff) + [
+                         float('nan') if record.fan_pct is None else float(record.fan_pct),
+                         float(record.hw_error_rate_pct),
+                         int(record.uptime_secs),
+                         _encode(record.message, 128)]))
+
+
+def unpack_record(buf, offset):
+    values = RECORD.unpack_from(buf, offset)
+    temps_end = 13 + MAX_TEMPS
+    fans_end = temps_end + MAX_FANS
+    fan_pct = values[fans_end]
+    return SnapshotRecord(
+        values[0], values[1], _decode(values[2]), _decode(values[3]), _decode(values[4]), _decode(values[5]),
+        values[6], values[7], values[8], values[9], values[10], values[11], _decode(values[12]),
+        [temp for temp in values[13:temps_end] if temp != 0],
+        [fan for fan in values[temps_end:fans_end] if fan != 0],
+        None if math.isnan(fan_pct) else fan_pct,
+        values[fans_end + 1], values[fans_end + 2], _decode(values[fans_end + 3]))
+
+
+class SnapshotWriter(object):
+    """ Publishes the latest fleet status into a memory mapped file.
+
+    The header carries a sequence number used as a seqlock: it is odd while a
+    publish is in progress, so readers in other processes retry instead of
+    seeing a half written snapshot. There must be a single writer, the agent
+    leader.
+    """
+
+    def __init__(self, path, capacity=1024):
+        self.path = path
+        self.capacity = capacity
+        self.file = None
+        self.map = None
+        self.seq = 0
+
+    def _open(self, capacity):
+        self.close()
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(b'\0' * (HEADER_SIZE + capacity * RECORD.size))
+        os.rename(tmp_path, self.path)
+        self.file = open(self.path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.capacity = capacity
+        self.seq = 0
+
+    def publish(self, records):
+        if self.map is None or len(records) > self.capacity:
+            # A new file is renamed over the old one. Readers notice the inode
+            # change and map the new file.
+            capacity = self.capacity
+            while capacity < len(records):
+                capacity *= 2
+            self._open(capacity)
+
+        self.seq += 1
+        struct.pack_into('<Q', self.map, SEQ_OFFSET, self.seq)
+        for i, record in enumerate(records):
+            pack_record(self.map, HEADER_SIZE + i * RECORD.size, record)
+        HEADER.pack_into(self.map, 0, MAGIC, self.seq, len(records), self.capacity, time.time())
+        self.seq += 1
+        struct.pack_into('<Q', self.map, SEQ_OFFSET, self.seq)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+        self.map = None
+        self.file = None
+
+
+class SnapshotReader(object):
+    """ Reads the snapshot published by the agent, possibly in another process.
+
+    Records are decoded straight from the shared mapping, nothing goes
+    through the DB or a socket. They are decoded once per published
+    snapshot: until the next one, every read returns the same tuple.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.map = None
+        self.inode = None
+        # ((inode, sequence), (published time, records)) of the last read
+        self.last = (None, None)
+
+    def _mapping(self):
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            return None
+        if inode != self.inode:
+            # The previous mapping is not closed, request threads may still be
+            # reading it. It goes away with its last reference.
+            with open(self.path, 'rb') as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.inode = inode
+        return self.map
+
+    def read(self, retries=100):
+        """ Returns (published time, records) or None if nothing was published. """
+        buf = self._mapping()
+        if buf is None or len(buf) < HEADER_SIZE:
+            return None
+        for _ in range(retries):
+            magic, seq, count, capacity, published = HEADER.unpack_from(buf, 0)
+            if magic != MAGIC:
+                return None
+            if seq % 2 == 1:
+                time.sleep(0.001)
+                continue
+            key = (self.inode, seq)
+            last_key, last_snapshot = self.last
+            if key == last_key:
+                return last_snapshot
+            records = [unpack_record(buf, HEADER_SIZE + i * RECORD.size) for i in range(count)]
+            if struct.unpack_from('<Q', buf, SEQ_OFFSET)[0] == seq:
+                self.last = (key, (published, records))
+                return published, records
+        logger.warning("Could not get a consistent fleet snapshot")
+        return None
+
+
+def make_records(miner, miner_status):
+    """ One record per miner instance, tagged with the most severe finding. """
+    level, message = LEVEL_OK, None
+    for finding_level, finding in miner_status.checks.values():
+        if LEVEL_CODES[finding_level] > level:
+            level, message = LEVEL_CODES[finding_level], finding.message()
+    return [SnapshotRecord(instance.miner_id, i, instance.ip, instance.model, instance.remarks, instance.worker, level,
+                           instance.working_chip_count, instance.defective_chip_count,
+                           instance.inactive_chip_count, instance.expected_chip_count,
+                           instance.hashrate_value, instance.hashrate_unit,
+                           instance.temps, instance.fan_speeds, instance.fan_pct,
+                           instance.hw_error_rate_pct, instance.uptime_secs, message)
+            for i, instance in enumerate(miner_status.miner_instance_list)]
+
+
+def instance_from_record(record):
+    return MinerInstance(record.miner_id, record.ip, record.model, record.remarks, record.worker,
+                         record.working_chip_count, record.defective_chip_count,
+                         record.inactive_chip_count, record.expected_chip_count,
+                         record.hashrate_value, record.hashrate_unit,
+                         tuple(record.temps), tuple(record.fan_speeds), record.fan_pct or 0,
+                         record.hw_error_rate_pct, record.uptime_secs)
+
+
+def make_down_record(miner, message):
+    return SnapshotRecord(miner.id, 0, miner.ip, model_catalog.get(miner.model_id).model, miner.remarks, None, LEVEL_DOWN,
+                          0, 0, 0, 0, 0.0, None, [], [], None, 0.0, 0, message)
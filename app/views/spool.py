@@ -0,0 +1,63 @@
+import json
+import os
+import threading
+import time
+
+from app import logger
+
+
+class Spool(object):
+    """ Persistent FIFO of JSON documents, one file per entry.
+
+    Entries survive a restart until they are removed. Files are written to a
+    temporary name and renamed so a crash never leaves a half written entry.
+    """
+
+    def __init__(self, directory, suffix='.json'):
+        self.directory = directory
+        self.suffix = suffix
+        self.lock = threading.Lock()
+        self.counter = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _new_name(self):
+        with self.lock:
+            self.counter += 1
+            counter = self.counter
+        # Names sort in insertion order.
+        return "{:017.6f}-{}-{:06d}{}".format(time.time(), os.getpid(), counter, self.suffix)
+
+    def put(self, document, name=None):
+        if name is None:
+            name = self._new_name()
+        path = os.path.join(self.directory, name)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(document, f)
+        os.rename(tmp_path, path)
+        return name
+
+    def names(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(self.suffix))
+
+    def get(self, name):
+        try:
+            with open(os.path.join(self.directory, name)) as f:
+                return json.load(f)
+        except ValueError:
+            logger.error("Dropping corrupted spool entry {}".format(name))
+            self.remove(name)
+            return None
+
+    def items(self):
+        for name in self.names():
+            document = self.get(name)
+            if document is not None:
+                yield name, document
+
+    def remove(self, name):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
@@ -0,0 +1,90 @@
+import errno
+import os
+import threading
+from collections import OrderedDict
+
+import jinja2
+from flask import Markup
+
+import config
+
+
+class AtomicBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """ Writes every compiled template to a temporary file first, so that
+    processes or threads compiling the same template at once never load half
+    a file nor rename each other's.
+    """
+
+    def dump_bytecode(self, bucket):
+        path = self._get_cache_filename(bucket)
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.current_thread().ident)
+        with open(tmp_path, 'wb') as f:
+            bucket.write_bytecode(f)
+        os.rename(tmp_path, path)
+
+
+def create_bytecode_cache():
+    """ Compiled templates kept in TEMPLATE_CACHE_DIR, so that a new process
+    (gunicorn worker, agent) doesn't compile them again. None when it is
+    empty.
+    """
+    if not config.TEMPLATE_CACHE_DIR:
+        return None
+    try:
+        os.makedirs(config.TEMPLATE_CACHE_DIR)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return AtomicBytecodeCache(config.TEMPLATE_CACHE_DIR)
+
+
+bytecode_cache = create_bytecode_cache()
+
+# Renders the templates used outside of a request (alert emails). Templates
+# are compiled once per process and then looked up in memory.
+template_env = jinja2.Environment(loader=jinja2.PackageLoader('app', 'templates'), bytecode_cache=bytecode_cache)
+
+
+class FragmentCache(object):
+    """ Least recently used cache of rendered fragments: the rows of the
+    miner table, keyed by miner instance and version of its record
+    (MinerRow.key). A page then only renders the rows of the miners that
+    changed since they were last shown.
+
+    The rows also depend on the model descriptions, the cache is emptied
+    when they change.
+    """
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        # key -> Markup
+        self.fragments = OrderedDict()
+        self.models_by_name = None
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, macro, row, models_by_name, is_request):
+        if row.key is None or not self.max_entries:
+            return macro(row, models_by_name, is_request)
+        key = (row.key, is_request)
+        with self.lock:
+            if models_by_name is not self.models_by_name:
+                self.fragments.clear()
+                self.models_by_name = models_by_name
+            html = self.fragments.pop(key, None)
+            if html is not None:
+                # Most recently used last
+                self.fragments[key] = html
+                self.hits += 1
+                return html
+            self.misses += 1
+        html = Markup(macro(row, models_by_name, is_request))
+        with self.lock:
+            self.fragments[key] = html
+            while len(self.fragments) > self.max_entries:
+                self.fragments.popitem(last=False)
+        return html
+
+
+miner_rows = FragmentCache(max_entries=config.ROW_CACHE_SIZE)
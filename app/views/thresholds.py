@@ -0,0 +1,75 @@
+from flask import flash, redirect, render_template, request, url_for
+from sqlalchemy.exc import IntegrityError
+
+from app import __version__, app, db, logger
+from app.models import Miner, MinerModel, MinerThreshold
+from app.views.antminer import requires_auth, requires_writable
+from app.views.rules import DEFAULT_THRESHOLDS, RULE_DESCRIPTIONS
+
+
+@app.route('/thresholds')
+@requires_auth
+def thresholds():
+    models = MinerModel.query.all()
+    defaults = dict((model.model, dict((rule, default(model)) for rule, default in DEFAULT_THRESHOLDS.items()))
+                    for model in models)
+    return render_template('thresholds.html',
+                           version=__version__,
+                           rules=sorted(DEFAULT_THRESHOLDS),
+                           rule_descriptions=RULE_DESCRIPTIONS,
+                           models=models,
+                           defaults=defaults,
+                           thresholds=MinerThreshold.query.all(),
+                           miners=dict((miner.id, miner) for miner in Miner.query.all()))
+
+
+@app.route('/thresholds', methods=['POST'])
+@requires_auth
+@requires_writable
+def set_threshold():
+    rule = request.form['rule']
+    target = request.form['target'].strip()
+    try:
+        value = float(request.form['value'])
+    except ValueError:
+        flash("[ERROR] Threshold value must be a number", "error")
+        return redirect(url_for('thresholds'))
+    if rule not in DEFAULT_THRESHOLDS:
+        flash("[ERROR] Unknown rule '{}'".format(rule), "error")
+        return redirect(url_for('thresholds'))
+
+    # The target is either a model name or a miner IP Address.
+    model = MinerModel.query.filter_by(model=target).first()
+    miner = None if model else Miner.query.filter_by(ip=target).first()
+    if model is None and miner is None:
+        flash("[ERROR] '{}' is neither a model nor a miner IP Address".format(target), "error")
+        return redirect(url_for('thresholds'))
+
+    threshold = MinerThreshold.query.filter_by(rule=rule,
+                                               model_id=model.id if model else None,
+                                               miner_id=miner.id if miner else None).first()
+    if threshold is None:
+        threshold = MinerThreshold(rule=rule,
+                                   model_id=model.id if model else None,
+                                   miner_id=miner.id if miner else None)
+        db.session.add(threshold)
+    threshold.value = value
+    try:
+        db.session.commit()
+        flash("[INFO] Threshold '{}' set to {} for {}".format(rule, value, target), "info")
+    except IntegrityError as e:
+        db.session.rollback()
+        logger.error("Error while setting threshold. Message: {}".format(e))
+        flash("[ERROR] Could not set threshold '{}' for {}".format(rule, target), "error")
+    return redirect(url_for('thresholds'))
+
+
+@app.route('/thresholds/delete/<id>')
+@requires_auth
+@requires_writable
+def delete_threshold(id):
+    threshold = MinerThreshold.query.filter_by(id=int(id)).first()
+    if threshold is not None:
+        db.session.delete(threshold)
+        db.session.commit()
+    return redirect(url_for('thresholds'))
@@ -0,0 +1,156 @@
+import gzip
+import io
+import json
+import threading
+import time
+
+import requests
+
+import config
+from app import logger
+from app.views.snapshot import LEVEL_NAMES
+from app.views.spool import Spool
+
+
+def compress(document):
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(json.dumps(document).encode('utf-8'))
+    return buf.getvalue()
+
+
+def record_to_dict(record):
+    item = record._asdict()
+    item['level'] = LEVEL_NAMES[record.level]
+    return item
+
+
+class UplinkPusher(object):
+    """ Ships the snapshots and events of a collector to the central server.
+
+    Everything goes through an on-disk spool first, so nothing is lost while
+    the uplink is down or across restarts. Pending entries are then sent
+    oldest first in gzipped batches. Only the latest snapshot is worth
+    sending, older pending ones are dropped when a new one is queued.
+    """
+
+    def __init__(self, url, token, site, spool, batch_max=50, initial_backoff_secs=5, max_backoff_secs=600,
+                 timeout=30):
+        self.url = url
+        self.token = token
+        self.site = site
+        self.spool = spool
+        self.batch_max = batch_max
+        self.initial_backoff_secs = initial_backoff_secs
+        self.max_backoff_secs = max_backoff_secs
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.failures = 0
+        self.next_attempt = 0
+        # Spool entry of the pending snapshot, if any
+        self.snapshot_name = None
+        self.thread = None
+        self.stopped = False
+
+    def start(self):
+        with self.condition:
+            for name, item in self.spool.items():
+                if item['type'] == 'snapshot':
+                    self._drop_snapshot()
+                    self.snapshot_name = name
+        pending = len(self.spool.names())
+        if pending:
+            logger.info("Resuming upload of {} uplink item(s)".format(pending))
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def _drop_snapshot(self):
+        if self.snapshot_name is not None:
+            self.spool.remove(self.snapshot_name)
+            self.snapshot_name = None
+
+    def push_snapshot(self, published, interval_secs, records, aggregates):
+        with self.condition:
+            self._drop_snapshot()
+            self.snapshot_name = self.spool.put({
+                "type": "snapshot",
+                "published": published,
+                "interval_secs": interval_secs,
+                "records": [record_to_dict(record) for record in records],
+                "aggregates": aggregates,
+            })
+            self.condition.notify()
+
+    def push_events(self, events):
+        if not events:
+            return
+        with self.condition:
+            self.spool.put({"type": "events", "events": events})
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.stopped:
+                    names = self.spool.names()[:self.batch_max]
+                    wait_secs = self.next_attempt - time.time()
+                    if names and wait_secs <= 0:
+                        break
+                    self.condition.wait(wait_secs if names else None)
+                if self.stopped:
+                    return
+            self._send(names)
+
+    def _send(self, names):
+        items = []
+        with self.condition:
+            # Snapshots may have been superseded since the names were listed.
+            existing = set(self.spool.names())
+            for name in names:
+                if name not in existing:
+                    continue
+                item = self.spool.get(name)
+                if item is not None:
+                    # Spool names sort in insertion order, the server uses them
+                    # to skip items of a batch it already got.
+                    item['id'] = name
+                    items.append(item)
+        try:
+            r = requests.post(self.url, data=compress({"site": self.site, "sent": time.time(), "items": items}),
+                              timeout=self.timeout,
+                              headers={"Content-Type": "application/json",
+                                       "Content-Encoding": "gzip",
+                                       "Authorization": "Bearer {}".format(self.token)})
+            if r.status_code >= 300:
+                raise IOError("Ingest returned status code {}".format(r.status_code))
+        except Exception as e:
+            self.failures += 1
+            backoff_secs = min(self.initial_backoff_secs * 2 ** (self.failures - 1), self.max_backoff_secs)
+            self.next_attempt = time.time() + backoff_secs
+            logger.warning("Failure uploading {} item(s) to {} (attempt #{}), retrying in {}s. Message:{}".format(
+                len(items), self.url, self.failures, backoff_secs, e))
+            return
+        self.failures = 0
+        self.next_attempt = 0
+        with self.condition:
+            for name in names:
+                self.spool.remove(name)
+                if name == self.snapshot_name:
+                    self.snapshot_name = None
+        logger.debug("Uploaded {} item(s) to {}".format(len(items), self.url))
+
+
+def create_uplink():
+    """ Returns the pusher when this instance is a collector, None otherwise. """
+    if not config.COLLECTOR_UPLINK_URL:
+        return None
+    return UplinkPusher(config.COLLECTOR_UPLINK_URL, config.INGEST_TOKEN, config.SITE_NAME,
+                        Spool(config.UPLINK_SPOOL_DIR), batch_max=config.UPLINK_BATCH_MAX)
@@ -0,0 +1,197 @@
+"""
+Concurrency of the SQLite setup under load: one thread writes a sweep of
+events for every miner, one commit per event as the agent does, while
+reader threads load pages and page through the events and scanner threads
+run long scans over them. Reports the "database is locked" errors and the
+latency percentiles of the reads and of the write sweeps.
+
+    $ python benchmarks/db_concurrency.py [--seconds S] [--miners N] [--events N]
+                                          [--readers N] [--scanners N]
+
+Needs the app's dependencies (Flask, Flask-SQLAlchemy). The database and
+the files of the app are throwaway ones in a temporary directory, the
+database is seeded with N miners and events.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+# Pages loaded in turn by every reader
+PAGES = ('/thresholds', '/api/chains', '/bulk')
+# Events read per page when paging through them
+EVENTS_PER_PAGE = 500
+
+
+class Results(object):
+    """ Latencies and errors recorded by the threads. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # kind -> seconds
+        self.latencies = {'write sweep': [], 'page': [], 'event page': [], 'scan': []}
+        # kind -> count
+        self.locked = {}
+        self.other_errors = []
+
+    def timed(self, kind, fn):
+        start = time.time()
+        try:
+            fn()
+        except Exception as e:
+            with self.lock:
+                if 'database is locked' in str(e):
+                    self.locked[kind] = self.locked.get(kind, 0) + 1
+                else:
+                    self.other_errors.append((kind, repr(e)))
+            return False
+        with self.lock:
+            self.latencies[kind].append(time.time() - start)
+        return True
+
+
+def seed(db, miners, events):
+    from app.migrations import SUPPORTED_MODELS, stamp_latest
+    from app.models import Miner, MinerModel
+
+    db.create_all()
+    stamp_latest()
+    db.session.add_all(MinerModel(**fields) for fields in SUPPORTED_MODELS)
+    db.session.commit()
+    model = MinerModel.query.filter_by(model='S9').first()
+    db.session.add_all(Miner(ip='10.0.{}.{}'.format(i // 250, i % 250 + 1), model_id=model.id, remarks='',
+                             count=1) for i in range(miners))
+    db.session.commit()
+    ids = [miner.id for miner in Miner.query.all()]
+    engine = db.get_writer_engine() or db.engine
+    for start in range(0, events, 50000):
+        engine.execute("INSERT INTO miner_event (miner_id, event_type, message, timestamp) "
+                       "VALUES (?, 'error', ?, datetime('now'))",
+                       [(ids[i % len(ids)], 'seed {}'.format(i)) for i in range(start, min(events, start + 50000))])
+
+
+def writer(app, db, results, stop):
+    from app.models import Miner, MinerEvent
+
+    with app.app_context():
+        miners = Miner.query.all()
+        db.session.expunge_all()
+        sweep = [0]
+
+        def write_sweep():
+            try:
+                for miner in miners:
+                    db.session.add(MinerEvent(miner_id=miner.id, event_type='error',
+                                              message='sweep {}'.format(sweep[0])))
+                    db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+        while not stop.is_set():
+            results.timed('write sweep', write_sweep)
+            sweep[0] += 1
+
+
+def reader(app, db, results, stop):
+    from app.models import MinerEvent
+
+    client = app.test_client()
+    last_id = [0]
+
+    def load(path):
+        response = client.get(path)
+        if response.status_code != 200:
+            raise RuntimeError("{} answered {}".format(path, response.status_code))
+
+    def event_page():
+        with app.app_context():
+            rows = MinerEvent.query.filter(MinerEvent.id > last_id[0]).order_by(MinerEvent.id) \
+                .limit(EVENTS_PER_PAGE).all()
+            # Back to the first page at the end
+            last_id[0] = rows[-1].id if rows else 0
+
+    while not stop.is_set():
+        for path in PAGES:
+            results.timed('page', lambda: load(path))
+        results.timed('event page', event_page)
+
+
+def scanner(app, db, results, stop):
+    from app.models import MinerEvent
+
+    def scan():
+        with app.app_context():
+            # Reads every event, in one read transaction
+            MinerEvent.query.filter(MinerEvent.message.like('%9%')).count()
+
+    while not stop.is_set():
+        results.timed('scan', scan)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100.0))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent reads and writes on the SQLite database")
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--miners', type=int, default=50)
+    parser.add_argument('--events', type=int, default=400000, help="events in the database at the start")
+    parser.add_argument('--readers', type=int, default=4, help="threads loading pages")
+    parser.add_argument('--scanners', type=int, default=2, help="threads scanning all the events")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='antminer-bench-')
+    os.environ.update(DATABASE_URI='sqlite:///' + os.path.join(directory, 'app.db'),
+                      SNAPSHOT_FILE=os.path.join(directory, 'fleet.snapshot'),
+                      AGENT_STATUS_FILE=os.path.join(directory, 'agent_status.json'),
+                      RULES_STAMP_FILE=os.path.join(directory, 'rules.stamp'),
+                      TEMPLATE_CACHE_DIR=os.path.join(directory, 'jinja_cache'),
+                      AGENT_EMBEDDED='0')
+    try:
+        from app import app, db
+
+        # Errors reach the threads instead of becoming 500 pages.
+        app.config['PROPAGATE_EXCEPTIONS'] = True
+        with app.app_context():
+            print("Seeding {} miners and {} events...".format(args.miners, args.events))
+            seed(db, args.miners, args.events)
+
+        results = Results()
+        stop = threading.Event()
+        threads = [threading.Thread(target=writer, args=(app, db, results, stop))]
+        threads += [threading.Thread(target=reader, args=(app, db, results, stop)) for _ in range(args.readers)]
+        threads += [threading.Thread(target=scanner, args=(app, db, results, stop)) for _ in range(args.scanners)]
+        print("1 writer, {} reader(s), {} scanner(s) for {:.0f}s".format(args.readers, args.scanners, args.seconds))
+        for thread in threads:
+            thread.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        print("{:<12} {:>8} {:>10} {:>10} {:>10}".format("", "count", "p50 s", "p99 s", "max s"))
+        for kind in ('write sweep', 'page', 'event page', 'scan'):
+            values = results.latencies[kind]
+            if values:
+                print("{:<12} {:>8} {:>10.4f} {:>10.4f} {:>10.4f}".format(
+                    kind, len(values), percentile(values, 50), percentile(values, 99), max(values)))
+        print("'database is locked' errors: {}{}".format(sum(results.locked.values()), "".join(
+            "\n    {}: {}".format(kind, count) for kind, count in sorted(results.locked.items()))))
+        if results.other_errors:
+            print("Other errors: {}{}".format(len(results.other_errors), "".join(
+                "\n    {}: {}".format(kind, error) for kind, error in results.other_errors[:10])))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 1 if results.locked or results.other_errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
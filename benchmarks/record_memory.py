@@ -0,0 +1,136 @@
+"""
+Memory and CPU cost of keeping miner instance statuses around: the slotted
+MinerInstance record against the previous miner_instance object, which had a
+__dict__, a timedelta and a reference to the Miner row.
+
+    $ python benchmarks/record_memory.py [count]
+
+No miner is polled and the database is not queried, but MinerInstance is
+imported from the app: the app's dependencies (Flask, Flask-SQLAlchemy)
+must be installed, and importing it sets up the app as usual (log file
+under app/logs, database engine).
+"""
+import json
+import os
+import sys
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from app.views.miner_adapter import MinerInstance  # noqa: E402
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class LegacyMinerInstance(object):
+    """ miner_adapter.miner_instance as it was before MinerInstance. """
+
+    def __init__(self, worker, working_chip_count, defective_chip_count, inactive_chip_count, expected_chip_count,
+                 hashrate_value, hashrate_unit, temps, fan_speeds, fan_pct, hw_error_rate_pct, uptime_secs, miner):
+        self.worker = worker
+        self.working_chip_count = working_chip_count
+        self.defective_chip_count = defective_chip_count
+        self.inactive_chip_count = inactive_chip_count
+        self.expected_chip_count = expected_chip_count
+        self.hashrate_value = hashrate_value
+        self.hashrate_unit = hashrate_unit
+        self.temps = temps
+        self.fan_speeds = fan_speeds
+        self.fan_pct = fan_pct
+        self.hw_error_rate_pct = hw_error_rate_pct
+        self.uptime = timedelta(seconds=uptime_secs)
+        self.miner = miner
+
+
+class FakeMiner(object):
+    """ Stands in for the Miner row. It is shared, so not counted. """
+    id = 1
+    ip = '10.0.0.1'
+    remarks = 'rack1'
+
+
+def make_legacy(i, miner):
+    return LegacyMinerInstance('account.worker{}'.format(i), 189, 0, 0, 189, 13.5 + i % 10, 'TH/s',
+                               [70 + i % 5, 71, 72], [5000, 5100], None, 0.002, 3600 + i, miner)
+
+
+def make_slotted(i, miner):
+    return MinerInstance(miner.id, miner.ip, 'S9', miner.remarks, 'account.worker{}'.format(i), 189, 0, 0, 189,
+                         13.5 + i % 10, 'TH/s', (70 + i % 5, 71, 72), (5000, 5100), 71.6, 0.002, 3600 + i)
+
+
+def deep_size(obj, shared, seen=None):
+    """ getsizeof of obj and everything it owns, ignoring the shared objects. """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen or id(obj) in shared:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, shared, seen) + deep_size(value, shared, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, shared, seen) for item in obj)
+    elif hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, shared, seen)
+    return size
+
+
+def legacy_as_dict(instance):
+    values = dict(instance.__dict__)
+    values['uptime'] = instance.uptime.total_seconds()
+    values['miner'] = instance.miner.id
+    return values
+
+
+def measure(name, make, as_dict, count):
+    miner = FakeMiner()
+    shared = set([id(miner), id('TH/s'), id('S9'), id(miner.ip), id(miner.remarks)])
+
+    if tracemalloc is not None:
+        tracemalloc.start()
+    start = time.time()
+    records = [make(i, miner) for i in range(count)]
+    create_secs = time.time() - start
+    traced = None
+    if tracemalloc is not None:
+        traced = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+    size = sum(deep_size(record, shared) for record in records[:1000]) * count / min(count, 1000)
+
+    start = time.time()
+    copies = [pickle.loads(pickle.dumps(record, pickle.HIGHEST_PROTOCOL)) for record in records[:10000]]
+    pickle_secs = (time.time() - start) * count / len(copies)
+
+    start = time.time()
+    json.dumps([as_dict(record) for record in records])
+    json_secs = time.time() - start
+
+    print("{:<10} {:>10.0f} {:>12} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+        name, size / count, "-" if traced is None else "{:.0f}".format(float(traced) / count),
+        create_secs, pickle_secs, json_secs))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print("{} records".format(count))
+    print("{:<10} {:>10} {:>12} {:>10} {:>10} {:>10}".format(
+        "", "bytes/rec", "traced/rec", "create s", "pickle s", "json s"))
+    # The legacy object pickles its Miner reference too, which for a real
+    # ORM row would also drag the session state along.
+    measure("legacy", make_legacy, legacy_as_dict, count)
+    measure("slotted", make_slotted, lambda record: dict(zip(record._fields, record)), count)
+
+
+if __name__ == '__main__':
+    main()
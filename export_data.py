@@ -0,0 +1,60 @@
+"""
+Exports the miner events, the chain snapshots or the hashrate history
+(parsed again from RESPONSE_ARCHIVE_DIR) as CSV or JSON Lines, for reports.
+Rows are streamed from the database, so any time range exports in constant
+memory.
+
+    $ python export_data.py {events,chains,hashrate} [--format csv|jsonl] [--gzip]
+                            [--since TIME] [--until TIME] [--ip IP ...] [--output FILE]
+
+TIME is epoch seconds or 'YYYY-MM-DD[ HH:MM[:SS]]' (local time). The output
+goes to stdout unless --output is given, and is gzipped with --gzip or when
+FILE ends with .gz.
+"""
+import argparse
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export miner history as CSV or JSON Lines")
+    parser.add_argument('dataset', choices=('events', 'chains', 'hashrate'))
+    parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+    parser.add_argument('--gzip', action='store_true')
+    parser.add_argument('--since')
+    parser.add_argument('--until')
+    parser.add_argument('--ip', action='append', help="only these miners (repeatable)")
+    parser.add_argument('--output', '-o', help="file to write, stdout by default")
+    args = parser.parse_args()
+
+    from app import app
+    from app.views import config
+    from app.views.export import export_chunks, parse_time
+
+    try:
+        since = parse_time(args.since)
+        until = parse_time(args.until)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.dataset == 'hashrate' and not config.RESPONSE_ARCHIVE_DIR:
+        parser.error("the hashrate history is read from the response archive, RESPONSE_ARCHIVE_DIR is required")
+    gzip = args.gzip or (args.output or '').endswith('.gz')
+
+    if args.output:
+        out = open(args.output, 'wb')
+    else:
+        out = getattr(sys.stdout, 'buffer', sys.stdout)
+    written = 0
+    try:
+        with app.app_context():
+            for chunk in export_chunks(args.dataset, args.format, gzip, since, until, set(args.ip or [])):
+                out.write(chunk)
+                written += len(chunk)
+    finally:
+        if args.output:
+            out.close()
+    sys.stderr.write("{} bytes written\n".format(written))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Runs the miner_adapter parsers again over the cgminer replies archived by
+the agent (RESPONSE_ARCHIVE_DIR), as fast as the CPU allows.
+
+    $ python replay_archive.py [--dir DIR] [--since TIME] [--until TIME] [--ip IP ...]
+                               [--repeat N] [--print]
+
+TIME is epoch seconds or 'YYYY-MM-DD HH:MM[:SS]' (local time). --print
+writes one JSON line per poll with the parsed instances and findings, to
+diff two versions of a parser. The models and thresholds come from the
+local DB, so run it where the models of the archived miners exist.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import traceback
+from datetime import datetime
+
+
+def parse_time(value):
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return time.mktime(datetime.strptime(value, fmt).timetuple())
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError("invalid time: {}".format(value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay archived cgminer replies through the parsers")
+    parser.add_argument('--dir', help="archive directory, RESPONSE_ARCHIVE_DIR by default")
+    parser.add_argument('--since', type=parse_time)
+    parser.add_argument('--until', type=parse_time)
+    parser.add_argument('--ip', action='append', help="only these miners (repeatable)")
+    parser.add_argument('--repeat', type=int, default=1, help="parse everything N times (benchmarking)")
+    parser.add_argument('--print', dest='print_results', action='store_true',
+                        help="print the parsed result of every poll as JSON lines")
+    args = parser.parse_args()
+
+    from app import app
+    from app.models import Miner
+    from app.views import config
+    from app.views.archive import ReplayMiner, read_polls
+    from app.views.miner_adapter import parse_miner_status
+    from app.views.model_catalog import model_catalog
+
+    directory = args.dir or config.RESPONSE_ARCHIVE_DIR
+    if not directory:
+        parser.error("--dir or RESPONSE_ARCHIVE_DIR is required")
+
+    with app.app_context():
+        # Reading and decompressing is not part of the timing.
+        polls = list(read_polls(directory, args.since, args.until, set(args.ip or [])))
+        miner_ids = dict((miner.ip, miner.id) for miner in Miner.query.all())
+
+        miners = {}
+        unknown_models = set()
+        jobs = []
+        for poll in polls:
+            model = model_catalog.find(poll.model)
+            if model is None:
+                unknown_models.add(poll.model)
+                continue
+            key = (poll.ip, poll.miner_id, model.id)
+            if key not in miners:
+                # Per-miner thresholds are those of the local miner with the
+                # same IP, if any.
+                miners[key] = ReplayMiner(miner_ids.get(poll.ip, -poll.miner_id), poll.ip, model.id, poll.remarks,
+                                          poll.count)
+            jobs.append((poll, miners[key], model))
+
+        parsed = unreachable = 0
+        failures = {}
+        start = time.time()
+        for _ in range(args.repeat):
+            for poll, miner, model in jobs:
+                try:
+                    status = parse_miner_status(miner, model, poll.responses)
+                except Exception:
+                    failures.setdefault((poll.ip, poll.model), []).append((poll.time, traceback.format_exc()))
+                    continue
+                if status is None:
+                    unreachable += 1
+                    continue
+                parsed += 1
+                if args.print_results:
+                    print(json.dumps({
+                        "time": poll.time,
+                        "ip": poll.ip,
+                        "model": poll.model,
+                        "instances": [dict(zip(instance._fields, instance)) for instance in status.miner_instance_list],
+                        "errors": sorted(status.errors),
+                        "warnings": sorted(status.warnings),
+                    }, sort_keys=True))
+        elapsed = time.time() - start
+
+    count = len(jobs) * args.repeat
+    sys.stderr.write("{} poll(s) read, {} replayed in {:.3f}s ({:.0f} polls/s)\n".format(
+        len(polls), count, elapsed, count / elapsed if elapsed else 0))
+    sys.stderr.write("parsed: {}, unreachable: {}, failed: {}\n".format(
+        parsed, unreachable, sum(len(times) for times in failures.values())))
+    if unknown_models:
+        sys.stderr.write("skipped, model not in the DB: {}\n".format(", ".join(sorted(unknown_models))))
+    for (ip, model), times in sorted(failures.items()):
+        # The first traceback of every miner is enough to reproduce it.
+        sys.stderr.write("\n{} ({}) failed {} time(s), first at {:.3f}:\n{}".format(
+            ip, model, len(times), times[0][0], times[0][1]))
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+"""
+Runs the monitoring agent on a virtual clock against a fleet timeline, as
+fast as the CPU allows, and reports the alert latency, the emails and the
+DB writes. Use it to tune the intervals and the ALERT_* settings.
+
+    $ python simulate_agent.py [--config agent.env] [--days D] [--interval SECS] [--lightweight-interval SECS]
+                               [--miners N] [--model MODEL] [--flaps-per-day F] [--mean-failure-secs S] [--seed N]
+    $ python simulate_agent.py --timeline timeline.jsonl [--days D] ...
+    $ python simulate_agent.py --archive DIR [--since TIME] [--until TIME] ...
+
+Without --timeline or --archive, N miners fail at random: down, unreachable
+(cgminer API only), hot or slow. A timeline file holds JSON lines such as
+{"time": 3600, "ip": "10.0.0.1", "state": "down"} (time in seconds from
+the start, state one of up, down, unreachable, hot, slow). --archive plays
+the replies recorded by the agent in a RESPONSE_ARCHIVE_DIR.
+
+The agent runs against a throwaway database and files, the settings (e.g.
+ALERT_RAISE_AFTER_SECS) are read from the environment and --config.
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from antminer_agent import load_config_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a fleet timeline through the agent on a virtual clock")
+    parser.add_argument('--config', help="file with KEY=VALUE settings")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--timeline', help="JSON lines of {time, ip, state}")
+    source.add_argument('--archive', help="response archive directory to play")
+    parser.add_argument('--since', help="start of the archive to play")
+    parser.add_argument('--until', help="end of the archive to play")
+    parser.add_argument('--days', type=float, default=1, help="simulated time (timelines)")
+    parser.add_argument('--interval', type=int, help="seconds between cgminer sweeps, AGENT_INTERVAL_SECS by default")
+    parser.add_argument('--lightweight-interval', type=int, default=5, help="seconds between HTTP checks")
+    parser.add_argument('--miners', type=int, default=50, help="miners of the synthetic timeline")
+    parser.add_argument('--model', default='S9', help="model of the synthetic miners")
+    parser.add_argument('--flaps-per-day', type=float, default=4)
+    parser.add_argument('--mean-failure-secs', type=float, default=300)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    if args.config:
+        load_config_file(args.config)
+
+    # Nothing the simulated agent writes may end up next to the real ones.
+    directory = tempfile.mkdtemp(prefix='antminer-sim-')
+    os.environ.update(DATABASE_URI='sqlite:///' + os.path.join(directory, 'app.db'),
+                      AGENT_LOCK_FILE=os.path.join(directory, 'agent.lock'),
+                      AGENT_STATUS_FILE=os.path.join(directory, 'agent_status.json'),
+                      SNAPSHOT_FILE=os.path.join(directory, 'fleet.snapshot'),
+                      RULES_STAMP_FILE=os.path.join(directory, 'rules.stamp'),
+                      NOTIFICATION_SPOOL_DIR=os.path.join(directory, 'outbox'))
+    for key in ('RESPONSE_ARCHIVE_DIR', 'COLLECTOR_UPLINK_URL'):
+        os.environ.pop(key, None)
+
+    try:
+        from sqlalchemy import event
+        from sqlalchemy.engine import Engine
+
+        from app import app, db, logger
+        from app.migrations import SUPPORTED_MODELS
+        from app.models import Miner, MinerModel
+        from app.views import config
+        from app.views.archive import read_polls
+        from app.views.clock import VirtualClock
+        from app.views.export import parse_time
+        from app.views.model_catalog import model_catalog
+        from app.views.simulation import (ArchiveSource, SimulatedAgent, TimelineSource, WriteCounter,
+                                          read_timeline, report, synthetic_timeline)
+
+        # One debug line per simulated event would flood the log.
+        logger.setLevel(logging.WARNING)
+        try:
+            since = parse_time(args.since)
+            until = parse_time(args.until)
+        except ValueError as e:
+            parser.error(str(e))
+
+        with app.app_context():
+            db.create_all()
+            db.session.add_all(MinerModel(**fields) for fields in SUPPORTED_MODELS)
+            db.session.commit()
+
+            if args.archive:
+                # The miners and the time range of the archive, in one pass.
+                miners = {}
+                first = last = None
+                for poll in read_polls(args.archive, since, until):
+                    first = poll.time if first is None else first
+                    last = poll.time
+                    miners.setdefault(poll.ip, (poll.model, poll.remarks, poll.count))
+                if first is None:
+                    parser.error("nothing archived in {} for that time range".format(args.archive))
+                for ip, (model, remarks, count) in sorted(miners.items()):
+                    spec = model_catalog.find(model)
+                    if spec is not None:
+                        db.session.add(Miner(ip=ip, model_id=spec.id, remarks=remarks, count=count))
+                db.session.commit()
+                # Starts once every miner was polled.
+                clock = VirtualClock(min(first + (args.interval or config.AGENT_INTERVAL_SECS), last), last)
+                source = ArchiveSource(clock, args.archive, first, last)
+            else:
+                if args.timeline:
+                    events = read_timeline(args.timeline)
+                    ips = sorted(set(timeline_event.ip for timeline_event in events))
+                else:
+                    ips = ['10.0.{}.{}'.format(i // 250, i % 250 + 1) for i in range(args.miners)]
+                    events = synthetic_timeline(ips, args.days * 86400, args.flaps_per_day, args.mean_failure_secs,
+                                                seed=args.seed)
+                spec = model_catalog.find(args.model)
+                if spec is None:
+                    parser.error("unknown model {}".format(args.model))
+                db.session.add_all(Miner(ip=ip, model_id=spec.id, remarks='', count=1) for ip in ips)
+                db.session.commit()
+                start = time.time()
+                clock = VirtualClock(start, start + args.days * 86400)
+                source = TimelineSource(clock, start, events)
+
+            writes = WriteCounter()
+            event.listen(Engine, 'before_cursor_execute', writes)
+            agent = SimulatedAgent(clock, source, interval_secs=args.interval,
+                                   lightweight_interval_secs=args.lightweight_interval)
+            started = clock.time()
+            wall_start = time.time()
+            agent.run()
+            wall_secs = time.time() - wall_start
+            event.remove(Engine, 'before_cursor_execute', writes)
+
+        print("\n".join(report(agent, source, writes, clock.time() - started, wall_secs)))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())